@@ -13,88 +13,81 @@
 ## Running
 # python finna_kuvasiskot_collection.py
 
-import urllib
 import pywikibot
 import json
-import time
-import imagehash
-from PIL import Image
+import os
+import sys
 
-
-# urlencode Finna parameters
-def finna_api_parameter(name, value):
-   return "&" + urllib.parse.quote_plus(name) + "=" + urllib.parse.quote_plus(value)
-
-# Perceptual hashing 
-# http://www.hackerfactor.com/blog/index.php?/archives/432-Looks-Like-It.html
-
-def calculate_phash(im):
-    hash = imagehash.phash(im)
-    hash_int=int(str(hash),16)
-    return hash_int
-
-# difference hashing
-# http://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
-
-def calculate_dhash(im):
-    hash = imagehash.dhash(im)
-    hash_int=int(str(hash),16)
-    return hash_int
+# shared Finna client is in scripts directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from finnaapi import iter_finna_search, FinnaError
+from hashpipeline import fingerprint_urls
 
 # Finna search url filter ui parameters can be generated using web UI https://finna.fi 
 # and then click "Finna API" link on bottom of the page.
+#
+# Records are yielded while the rest of the result pages are still being loaded
  
-def get_finna_by_filter(page):
-    data = None
-    url="https://api.finna.fi/v1/search?" 
-    url+= finna_api_parameter('filter[]', '~format_ext_str_mv:"0/Image/"') 
-    url+= finna_api_parameter('filter[]', 'free_online_boolean:"1"') 
-    url+= finna_api_parameter('filter[]', '~hierarchy_parent_title:"Studio Kuvasiskojen kokoelma"')  
-    url+= finna_api_parameter('filter[]', '~usage_rights_str_mv:"usage_B"') 
-    url+= finna_api_parameter('type','AllFields')
-    url+= finna_api_parameter('field[]', 'id')
-    url+= finna_api_parameter('field[]', 'title')
-    url+= finna_api_parameter('field[]', 'subTitle')
-    url+= finna_api_parameter('field[]', 'summary')
-    url+= finna_api_parameter('field[]', 'imageRights')
-    url+= finna_api_parameter('field[]', 'images')
-    url+= finna_api_parameter('field[]', 'imagesExtended')
-    url+= finna_api_parameter('field[]', 'onlineUrls')
-    url+= finna_api_parameter('field[]', 'openUrl')
-    url+= finna_api_parameter('field[]', 'nonPresenterAuthors')
-    url+= finna_api_parameter('field[]', 'onlineUrls')
-    url+= finna_api_parameter('limit','100') 
-    url+= finna_api_parameter('page',str(page)) 
-
-    with urllib.request.urlopen(url) as file:
-        try:
-            data = json.loads(file.read().decode())
-        except:
-            data = None
-    return data
-
-images=[]
-for page in range(1,101):
-    data=get_finna_by_filter(page)
-    if not data or not 'records' in data:
-        break
-
-    for record in data['records']:
-        r={}
-        r['id']=record['id']
-        r['copyright']=record['imageRights']['copyright']
-        r['thumbnail']="https://finna.fi" + record['imagesExtended'][0]['urls']['small']
-
-        # Open the image1 with Pillow
-        im = Image.open(urllib.request.urlopen(r['thumbnail']))
-        r['phash_int']=calculate_phash(im)
-        r['dhash_int']=calculate_dhash(im)
-        images.append(r)
-        print(r)
-        time.sleep(0.01)
-
-    print(".")
-    time.sleep(1)    
-
-
-print(images)
+def get_finna_by_filter():
+    filters = [
+        '~format_ext_str_mv:"0/Image/"',
+        'free_online_boolean:"1"',
+        '~hierarchy_parent_title:"Studio Kuvasiskojen kokoelma"',
+        '~usage_rights_str_mv:"usage_B"',
+    ]
+    # only fields which are used below
+    fields = ['id', 'imageRights', 'imagesExtended']
+    try:
+        yield from iter_finna_search(search_type='AllFields', filters=filters, fields=fields, refresh=True)
+    except FinnaError as e:
+        print(e)
+
+# Images are downloaded in threads and hashed in worker processes, see
+# scripts/hashpipeline.py
+# (phash: http://www.hackerfactor.com/blog/index.php?/archives/432-Looks-Like-It.html
+#  dhash: http://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html)
+#
+# Results are appended to OUTPUT_FILE as json lines while they are ready,
+# records already in the file are skipped when the script is run again.
+OUTPUT_FILE = 'kuvasiskot_hashes.jsonl'
+
+def read_done_ids(filename):
+    done = set()
+    if os.path.exists(filename):
+        with open(filename) as f:
+            for line in f:
+                if line.strip():
+                    done.add(json.loads(line)['id'])
+    return done
+
+if __name__ == '__main__':
+    done = read_done_ids(OUTPUT_FILE)
+
+    # items are read in the download thread of the pipeline, the record
+    # is passed along as the key so no state is shared with the loop below
+    def get_items():
+        seen = set()
+        for record in get_finna_by_filter():
+            if record.id in done or record.id in seen or not record.images:
+                continue
+            seen.add(record.id)
+            r={}
+            r['id']=record.id
+            r['copyright']=record.copyright
+            r['thumbnail']=record.images[0].small_url
+            yield r, r['thumbnail']
+
+    count = 0
+    with open(OUTPUT_FILE, 'a') as output:
+        for r, fingerprint, error in fingerprint_urls(get_items()):
+            if fingerprint is None:
+                print("Could not hash " + r['id'] + ": " + error)
+                continue
+            r['phash_int']=fingerprint.phash
+            r['dhash_int']=fingerprint.dhash
+            output.write(json.dumps(r) + "\n")
+            output.flush()
+            count += 1
+            print(r)
+
+    print("Hashed " + str(count) + " images, already done " + str(len(done)) + ", results in " + OUTPUT_FILE)
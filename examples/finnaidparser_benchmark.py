@@ -0,0 +1,166 @@
+# Micro-benchmark: finnaidparser.py compared to the old id parsing functions
+#
+# Old functions (regex loop per link + stripid(), getlinksourceid() +
+# getrecordid()) are copied below as they were in setcommonssdc.py,
+# update_kuvasiskot.py and add_person_subjects.py. Both are run over the
+# same corpus of Source fields and link lists and results are compared.
+#
+## Running
+# python finnaidparser_benchmark.py
+# python finnaidparser_benchmark.py 20000     # number of repeats
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from finnaidparser import extract_finna_ids, get_source_id
+
+# Source fields like in Commons file pages
+SOURCES = [
+    "https://www.finna.fi/Record/museovirasto.3A2F5E3F9B5A4E1B4E4C3E3A2A8D6D0F",
+    "[https://finna.fi/Record/museovirasto.AC8E1FA6B3A1E8E4B1B0D6F1E3E8E4B1 Museovirasto, Historian kuvakokoelma]",
+    "{{Finna|museovirasto.AC8E1FA6B3A1E8E4B1B0D6F1E3E8E4B1}}<br>Image record page in Finna: [https://finna.fi/Record/museovirasto.AC8E1FA6B3A1E8E4B1B0D6F1E3E8E4B1 museovirasto.AC8E1FA6B3A1E8E4B1B0D6F1E3E8E4B1]\n",
+    "https://finna.fi/Cover/Show?id=museovirasto.F1C9D8F0B0A2C44E8E1DB0B7FCA2BD8D&index=0&size=large",
+    "Museovirasto – Musketti: https://www.finna.fi/Record/musketti.M012:HK19671111:7-1141 Kuvasiskot",
+    "https://finna.fi/Record/hkm.HKMS000005:km0000penx#image",
+    "http://www.finna.fi/Record/musketti.M012%3AHK7155%3A219-65-1?lng=fi",
+    "Helsingin kaupunginmuseo<br>[https://www.finna.fi/Record/hkm.HKMS000005:00000fkf Finna]",
+    "own work",
+    "[http://kuvakokoelmat.fi/pictures/view/HK7155_219-65-1 Museovirasto]",
+]
+
+# external links of file pages
+LINK_LISTS = [
+    [
+        "https://www.finna.fi/Record/museovirasto.3A2F5E3F9B5A4E1B4E4C3E3A2A8D6D0F",
+        "https://finna.fi/Cover/Show?id=museovirasto.3A2F5E3F9B5A4E1B4E4C3E3A2A8D6D0F&index=0&size=large",
+        "https://creativecommons.org/licenses/by/4.0/deed.en",
+    ],
+    [
+        "https://www.finna.fi/thumbnail.php?id=museovirasto.F1C9D8F0B0A2C44E8E1DB0B7FCA2BD8D&size=small",
+        "https://finna.fi/Cover/Download?id=museovirasto.F1C9D8F0B0A2C44E8E1DB0B7FCA2BD8D&index=0",
+        "https://www.wikidata.org/wiki/Q118976025",
+    ],
+    [
+        "https://finna.fi/Record/hkm.HKMS000005:km0000penx#image",
+        "http://www.kuvakokoelmat.fi/pictures/small/HK71/HK7155_58-1_3.jpg",
+        "http://kuvakokoelmat.fi/pictures/view/HK7155_219-65-1",
+    ],
+    [
+        "https://commons.wikimedia.org/wiki/Category:Kuvasiskot",
+    ],
+]
+
+# ----- old functions
+
+def old_stripid(oldsource):
+    for char in (" ", "<", ">", "[", "]", "{", "}", "|", "&", "#", "?"):
+        indexend = oldsource.find(char)
+        if (indexend > 0):
+            oldsource = oldsource[:indexend]
+    if (oldsource.endswith("\n")):
+        oldsource = oldsource[:len(oldsource)-1]
+    return oldsource
+
+def old_getlinksourceid(oldsource):
+    strlen = len("id=")
+    indexid = oldsource.find("id=")
+    if (indexid < 0):
+        return ""
+    oldsource = oldsource[indexid+strlen:]
+    return old_stripid(oldsource)
+
+def old_getrecordid(oldsource):
+    strlen = len("/Record/")
+    indexid = oldsource.find("/Record/")
+    if (indexid < 0):
+        return ""
+    oldsource = oldsource[indexid+strlen:]
+    return old_stripid(oldsource)
+
+def old_get_source_id(source):
+    finnaid = old_getlinksourceid(source)
+    if (finnaid == ""):
+        finnaid = old_getrecordid(source)
+    # getfinnaidforpage() removes text after newline
+    index = finnaid.find("\n")
+    if (index > 0):
+        finnaid = finnaid[:index]
+    return finnaid
+
+def old_get_finna_ids(links):
+    finna_ids=[]
+
+    for url in links:
+        if "finna.fi" in url:
+            url = url.split('#')[0]
+            patterns = [
+                           r"finna\.fi/Record/([^?]+)",
+                           r"finna\.fi/Cover/Show\?id=([^&]+)",
+                           r"finna\.fi/thumbnail\.php\?id=([^&]+)",
+                           r"finna\.fi/Cover/Download\?id=([^&]+)",
+                       ]
+
+            for pattern in patterns:
+                match = re.search(pattern, url)
+                if match:
+                    id = old_stripid(match.group(1))
+                    if id not in finna_ids:
+                        finna_ids.append(id)
+                    break
+
+        if "kuvakokoelmat" in url:
+            patterns = [
+                           r"kuvakokoelmat\.fi/pictures/view/HK7155_([^?]+)",
+                           r"kuvakokoelmat\.fi/pictures/small/HK71/HK7155_([^?]+)\.jpg",
+                       ]
+
+            for pattern in patterns:
+                match = re.search(pattern, url)
+                if match:
+                    id = 'musketti.M012:HK7155:' + str(match.group(1)).replace('_', '-')
+                    if id not in finna_ids:
+                        finna_ids.append(id)
+                    break
+
+    return finna_ids
+
+# ----- new functions, same interface as above
+
+def new_get_source_id(source):
+    finnaid, kind = get_source_id(source)
+    return finnaid
+
+def new_get_finna_ids(links):
+    return [finnaid for finnaid, kind in extract_finna_ids("\n".join(links))]
+
+def compare(name, old, new, corpus):
+    same = 0
+    for item in corpus:
+        if old(item) == new(item):
+            same += 1
+        else:
+            print("  differs: " + repr(item) + "\n    old: " + repr(old(item)) + "\n    new: " + repr(new(item)))
+    print(name + ": " + str(same) + " / " + str(len(corpus)) + " same results")
+
+def bench(name, function, corpus, repeats):
+    seconds = min(timeit.repeat(lambda: [function(item) for item in corpus], number=repeats, repeat=3))
+    microseconds = seconds / (repeats * len(corpus)) * 1000000
+    print("  " + name + ": " + format(microseconds, '.2f') + " us per item")
+    return microseconds
+
+repeats = 10000
+if len(sys.argv) > 1:
+    repeats = int(sys.argv[1])
+
+compare("Source field", old_get_source_id, new_get_source_id, SOURCES)
+old = bench("old", old_get_source_id, SOURCES, repeats)
+new = bench("new", new_get_source_id, SOURCES, repeats)
+print("  speedup: " + format(old / new, '.1f') + "x")
+
+compare("External links", old_get_finna_ids, new_get_finna_ids, LINK_LISTS)
+old = bench("old", old_get_finna_ids, LINK_LISTS, repeats)
+new = bench("new", new_get_finna_ids, LINK_LISTS, repeats)
+print("  speedup: " + format(old / new, '.1f') + "x")
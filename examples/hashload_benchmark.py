@@ -0,0 +1,119 @@
+# Benchmark: opening images for hashing at full size compared to
+# openhashimage() in scripts/imagematch.py
+#
+# Each image is hashed in a separate process with both loaders so that
+# peak RSS of one does not hide the other. Reported are CPU time per image,
+# peak RSS of the process and growth of peak RSS while hashing, and
+# distance between the hashes given by the two loaders.
+#
+# Without arguments large synthetic JPEG and TIFF files are generated.
+#
+## Running
+# python hashload_benchmark.py
+# python hashload_benchmark.py photo.jpg scan.tif
+# python hashload_benchmark.py -repeats:10 photo.jpg
+
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from fingerprint import ImageFingerprint
+from imagematch import openhashimage
+
+from PIL import Image
+
+LOADERS = ['full', 'reduced']
+
+# peak resident set size in megabytes. On Linux ru_maxrss is inherited
+# over exec from the parent process, VmHWM is not
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def load(loader, content):
+    if loader == 'full':
+        return Image.open(io.BytesIO(content))
+    return openhashimage(content)
+
+# run in child process, prints json result
+def child(loader, path, repeats):
+    with open(path, 'rb') as f:
+        content = f.read()
+    rss_before = peak_rss()
+    cpu = time.process_time()
+    for i in range(repeats):
+        fingerprints = {}
+        for hash_size in (8, 24):
+            fingerprints[hash_size] = ImageFingerprint.from_image(load(loader, content), hash_size)
+    cpu = time.process_time() - cpu
+    print(json.dumps({
+        'cpu': cpu / repeats,
+        'rss': peak_rss(),
+        'rss_growth': peak_rss() - rss_before,
+        'hashes': {str(k): [v.phash_hex, v.dhash_hex] for k, v in fingerprints.items()},
+    }))
+
+def run(loader, path, repeats):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '-child', loader, path, str(repeats)],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+def distance(hashes1, hashes2, hash_size):
+    fp1 = ImageFingerprint(int(hashes1[0], 16), int(hashes1[1], 16), hash_size)
+    fp2 = ImageFingerprint(int(hashes2[0], 16), int(hashes2[1], 16), hash_size)
+    return fp1.distance(fp2)
+
+# smooth synthetic photo, random noise would not be compressed like photos
+def generate_images(directory):
+    import numpy
+    from PIL import ImageFilter
+    rng = numpy.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 255, (40, 60, 3), dtype=numpy.uint8))
+    image = image.resize((6000, 4000), Image.BICUBIC).filter(ImageFilter.GaussianBlur(4))
+    paths = [os.path.join(directory, 'synthetic.jpg'), os.path.join(directory, 'synthetic.tif')]
+    image.save(paths[0], 'JPEG', quality=90)
+    image.save(paths[1], 'TIFF')
+    return paths
+
+def main(args):
+    repeats = 3
+    paths = []
+    for arg in args:
+        if arg.startswith('-repeats:'):
+            repeats = int(arg[len('-repeats:'):])
+        else:
+            paths.append(arg)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if not paths:
+            paths = generate_images(directory)
+
+        for path in paths:
+            with Image.open(path) as image:
+                print(os.path.basename(path) + ": " + image.format + " " + str(image.size[0]) + "x" + str(image.size[1]) + ", " + str(os.path.getsize(path) // 1024) + " kB")
+            results = {loader: run(loader, path, repeats) for loader in LOADERS}
+            for loader in LOADERS:
+                result = results[loader]
+                print("  " + loader.ljust(8) + ": " + format(result['cpu'] * 1000, '.0f') + " ms cpu per image, peak RSS " + format(result['rss'], '.0f') + " MB (+" + format(result['rss_growth'], '.0f') + " MB)")
+            print("  speedup: " + format(results['full']['cpu'] / results['reduced']['cpu'], '.1f') + "x")
+            for hash_size in ('8', '24'):
+                phash_diff, dhash_diff = distance(results['full']['hashes'][hash_size], results['reduced']['hashes'][hash_size], int(hash_size))
+                print("  hash_size " + hash_size + " distance: phash " + str(phash_diff) + ", dhash " + str(dhash_diff))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '-child':
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main(sys.argv[1:])
@@ -5,12 +5,17 @@ import requests
 import imagehash
 from PIL import Image
 import json
-import sqlite3
 import io
 import os
 import tempfile
 from SPARQLWrapper import SPARQLWrapper, JSON
 
+from finnaapi import get_finna_record, FinnaError
+from finnaidparser import get_finna_ids
+from cascade import CascadeMatcher, PERSON_SUBJECTS_CASCADE
+from hashcache import HashCache
+from finnarecord import FinnaRecord
+
 def add_claim_if_not_exists(site, page, property_id, value_id):
     wikidata_site = pywikibot.Site('wikidata', 'wikidata')
     
@@ -70,228 +75,33 @@ def get_wikidata_item_by_property_value(property_id, value):
 
 
 
-### SQLITE Database ###
-
-def create_table():
-    c.execute('''CREATE TABLE IF NOT EXISTS urls (
-                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 url1 TEXT NOT NULL,
-                 url2 TEXT NOT NULL,
-                 hash_size INTEGER NOT NULL,
-                 phash_diff INTEGER NOT NULL,
-                 dhash_diff INTEGER NOT NULL)''')
-
-    conn.commit()
-
-def store_cached_diff(url1, url2, hash_size, phash_diff, dhash_diff):
-    c.execute("INSERT INTO urls (url1, url2, hash_size, phash_diff, dhash_diff) VALUES (?, ?, ?, ?, ?)", (url1, url2, hash_size, phash_diff, dhash_diff))
-
-    conn.commit()
-
-def get_cached_diff(url1, url2, hash_size=8):
-    c.execute("SELECT * FROM urls WHERE url1 = ? AND url2 = ? AND hash_size = ? LIMIT 1", (url1, url2, hash_size) )
-    data = c.fetchall()
-    if len(data)==1:
-        return data[0]
-    elif len(data)>0:
-        print("Error: Multiple rows")
-        exit(1)
-    return False
-
 ### PERCEPTUAL HASHING ###
 
+# Compares if the image is same using similarity hashing
+# method is to convert images to 64bit integers and then
+# calculate hamming distance. See fingerprint.py
+#
 # Perceptual hashing 
 # http://www.hackerfactor.com/blog/index.php?/archives/432-Looks-Like-It.html
-
-def calculate_phash(im, hash_size=8):
-    hash = imagehash.phash(im, hash_size)
-    hash_int=int(str(hash),16)
-    return hash_int
-
 # difference hashing
 # http://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
 
-def calculate_dhash(im, hash_size=8):
-    hash = imagehash.dhash(im, hash_size)
-    hash_int=int(str(hash),16)
-    return hash_int
-
-# Compares if the image is same using similarity hashing
-# method is to convert images to 64bit integers and then
-# calculate hamming distance. 
-
 # url1 = Finna small thubmnail
 # url2 = Commons thumbnail
 # url3 = Finna large thumbnail
+#
+# hashes of each url are cached in musketti.db (hashcache.py), so each image
+# is downloaded only once even if it is compared with many others
+#
+# Stages are in cascade.py PERSON_SUBJECTS_CASCADE: 8-bit hashes of the
+# small thumbnail reject clearly different images, if hashes are near
+# then confirm with longer hash and higher resolution images
 
-def is_same_image(url1, url2, url3, hash_size=8):
-
-    cached_diff = get_cached_diff(url1, url2, hash_size)
-    im1 = False
-    im2 = False
-    im3 = False
-
-    if cached_diff: 
-    #    print("cached")
-        phash_diff=cached_diff['phash_diff']
-        dhash_diff=cached_diff['dhash_diff']
-    else:
-        # Open the image1 with Pillow
-        im1 = Image.open(urllib.request.urlopen(url1))
-        phash1_int=calculate_phash(im1, hash_size)
-        dhash1_int=calculate_dhash(im1, hash_size)
-
-        # Open the image2 with Pillow
-        im2 = Image.open(urllib.request.urlopen(url2))
-        phash2_int=calculate_phash(im2, hash_size)
-        dhash2_int=calculate_dhash(im2, hash_size)
-
-        # Hamming distance difference
-        phash_diff = bin(phash1_int ^ phash2_int).count('1')
-        dhash_diff = bin(dhash1_int ^ dhash2_int).count('1') 
-        store_cached_diff(url1,url2, hash_size, phash_diff, dhash_diff)
-
-    # If hashes are near, then confirm with longer hash and higher resolution images
-
-    if phash_diff < 11 and dhash_diff < 11:
-        hash_size=24
-        cached_diff = get_cached_diff(url3, url2, hash_size)
-        if cached_diff:
-            #    print("cached")
-            phash_diff=cached_diff['phash_diff']
-            dhash_diff=cached_diff['dhash_diff']
-        else:
-
-            if not im2:
-                # Open the image2 with Pillow
-                im2 = Image.open(urllib.request.urlopen(url2))
-                phash2_int=calculate_phash(im2, hash_size)
-                dhash2_int=calculate_dhash(im2, hash_size)
-
-            im3 = Image.open(urllib.request.urlopen(url3))
-            phash1_int=calculate_phash(im3, hash_size)
-            dhash1_int=calculate_dhash(im3, hash_size)
-
-            phash_diff = bin(phash1_int ^ phash2_int).count('1')
-            dhash_diff = bin(dhash1_int ^ dhash2_int).count('1') 
-            store_cached_diff(url3,url2, hash_size, phash_diff, dhash_diff)
-
-
-    ## print hamming distance
-    # print("Phash diff: " + str(phash_diff))
-    # print("Dhash diff: " + str(dhash_diff))
-
-    # max distance for same is that least one is 0 and second is max 3
-
-    if phash_diff == 0 and dhash_diff < 10:
-        return True
-    elif phash_diff < 10 and dhash_diff == 0:
-        return True
-    elif phash_diff < 9 and dhash_diff < 9:
-        return True
-    else:
-        return False
+def is_same_image(url1, url2, url3):
+    return matcher.match({'small': url1, 'large': url3}, {'thumbnail': url2})
 
 ### FINNA Requests ###
 
-# urlencode Finna parameters
-def finna_api_parameter(name, value):
-   return "&" + urllib.parse.quote_plus(name) + "=" + urllib.parse.quote_plus(value)
-
-# Get finna API record with most of the information
-# Finna API documentation
-# * https://api.finna.fi
-# * https://www.kiwi.fi/pages/viewpage.action?pageId=53839221 
-
-def get_finna_record(id):
-
-    url="https://api.finna.fi/v1/record?id=" +  urllib.parse.quote_plus(id)
-
-    url+= finna_api_parameter('field[]', 'id')
-    url+= finna_api_parameter('field[]', 'title')
-    url+= finna_api_parameter('field[]', 'subTitle')
-    url+= finna_api_parameter('field[]', 'shortTitle')
-    url+= finna_api_parameter('field[]', 'summary')
-    url+= finna_api_parameter('field[]', 'imageRights')
-    url+= finna_api_parameter('field[]', 'images')
-    url+= finna_api_parameter('field[]', 'imagesExtended')
-    url+= finna_api_parameter('field[]', 'onlineUrls')
-    url+= finna_api_parameter('field[]', 'openUrl')
-    url+= finna_api_parameter('field[]', 'nonPresenterAuthors')
-    url+= finna_api_parameter('field[]', 'onlineUrls')
-    url+= finna_api_parameter('field[]', 'subjects')
-    url+= finna_api_parameter('field[]', 'subjectsExtendet')
-    url+= finna_api_parameter('field[]', 'subjectPlaces')
-    url+= finna_api_parameter('field[]', 'subjectActors')
-    url+= finna_api_parameter('field[]', 'subjectDetails')
-    url+= finna_api_parameter('field[]', 'geoLocations')
-    url+= finna_api_parameter('field[]', 'buildings')
-    url+= finna_api_parameter('field[]', 'identifierString')
-    url+= finna_api_parameter('field[]', 'collections')
-    url+= finna_api_parameter('field[]', 'institutions')
-    url+= finna_api_parameter('field[]', 'classifications')
-    url+= finna_api_parameter('field[]', 'events')
-    url+= finna_api_parameter('field[]', 'languages')
-    url+= finna_api_parameter('field[]', 'originalLanguages')
-    url+= finna_api_parameter('field[]', 'year')
-    url+= finna_api_parameter('field[]', 'hierarchicalPlaceNames')
-    url+= finna_api_parameter('field[]', 'formats')
-    url+= finna_api_parameter('field[]', 'physicalDescriptions')
-    url+= finna_api_parameter('field[]', 'measurements')
-    url+= finna_api_parameter('limit','100')
-    url+= finna_api_parameter('page',str(page))
-
-    try:
-        response = requests.get(url)
-        return response.json()
-    except e:
-        print(e)
-        print("Finna API query failed: " + url)
-        exit(1)
-
-# Find Finna ids from page.externallinks()
-
-def get_finna_ids(page):
-    finna_ids=[]
-
-    for url in page.extlinks():
-        if "finna.fi" in url:
-            id = None
-
-            url = url.split('#')[0]
-            # Parse id from url
-            patterns = [
-                           r"finna\.fi/Record/([^?]+)",
-                           r"finna\.fi/Cover/Show\?id=([^&]+)",
-                           r"finna\.fi/thumbnail\.php\?id=([^&]+)",
-                           r"finna\.fi/Cover/Download\?id=([^&]+)",
-                       ]
-
-            for pattern in patterns:
-                match = re.search(pattern, url)
-                if match:
-                    id = match.group(1)
-                    if id not in finna_ids:
-                        finna_ids.append(id)
-                    break
-
-        if "kuvakokoelmat" in url:
-            # Parse id from url
-            patterns = [
-                           r"kuvakokoelmat\.fi/pictures/view/HK7155_([^?]+)",
-                           r"kuvakokoelmat\.fi/pictures/small/HK71/HK7155_([^?]+)\.jpg",
-                       ]
-
-            for pattern in patterns:
-                match = re.search(pattern, url)
-                if match:
-                    id = 'musketti.M012:HK7155:' + str(match.group(1)).replace('_', '-')
-                    if id not in finna_ids:
-                        finna_ids.append(id)
-                    break
-
-    return finna_ids
-
 # Find correct Finna id for Commons image from multiple Finna ids
 def get_correct_finna_record(page, finna_ids):
     # Skip if there is no known ids
@@ -300,7 +110,11 @@ def get_correct_finna_record(page, finna_ids):
         return False
 
     for finna_id in finna_ids:
-        finna_record = get_finna_record(finna_id)
+        try:
+            finna_record = get_finna_record(finna_id, fields='person-subjects')
+        except FinnaError as e:
+            print("SKIP: Finna API query failed: " + finna_id + ", " + str(e))
+            return False
 
         if finna_record['status']!='OK':
             print("SKIP: Finna result not OK: " + finna_id)
@@ -310,14 +124,14 @@ def get_correct_finna_record(page, finna_ids):
             print("FAILED: Multiple results: " + finna_id)
             exit(1)
 
-        imagesExtended=finna_record['records'][0]['imagesExtended']
-        for imageExtended in imagesExtended:
-            finna_thumbnail_url="https://finna.fi" + imageExtended['urls']['small']
-            finna_thumbnail_url2="https://finna.fi" + imageExtended['urls']['large']
+        record=FinnaRecord(finna_record['records'][0])
+        for image in record.images:
+            finna_thumbnail_url=image.small_url
+            finna_thumbnail_url2=image.large_url
             commons_thumbnail_url=page.get_file_url(url_width=1024)
 
             if is_same_image(finna_thumbnail_url, commons_thumbnail_url, finna_thumbnail_url2):
-                return finna_record['records'][0]
+                return record
 
     return False    
 
@@ -530,10 +344,8 @@ def create_article_summary(page, wikidata_id):
     
 
 
-conn = sqlite3.connect('musketti.db')
-conn.row_factory = sqlite3.Row
-c = conn.cursor()
-create_table()
+hash_cache = HashCache('musketti.db')
+matcher = CascadeMatcher(PERSON_SUBJECTS_CASCADE, hash_cache)
 
 site = pywikibot.Site('commons', 'commons')  # The site we're working on
 pywikibot.config.socket_timeout = 120
@@ -561,15 +373,16 @@ for linked_page in page.linkedPages():
     if "cropped" in title:
         continue
 
-    finna_ids=get_finna_ids(linked_page)
+    # Find Finna ids from page.externallinks(), old kuvakokoelmat.fi links too
+    finna_ids=get_finna_ids(linked_page, kuvakokoelmat=True)
     finna_record=get_correct_finna_record(linked_page, finna_ids)
     if not finna_record:
         continue
 
     print('\n----')
-    print("Found " + finna_record['id'])
+    print("Found " + finna_record.id)
     print(title)
-    subjectActors=finna_record['subjectActors']
+    subjectActors=finna_record.subject_actors
 
     usage = linked_page.globalusage()
     wikidata_ids={}
@@ -595,8 +408,8 @@ for linked_page in page.linkedPages():
                       wikidata_ids[wikidata_id].add(create_article_summary(link, wikidata_id))
 
     print('')                              
-    print("Finna title: " + str(finna_record['title']))
-    print("Finna summary: " + str(finna_record['summary']))
+    print("Finna title: " + str(finna_record.title))
+    print("Finna summary: " + str(finna_record.summary))
     print('')
     print("Finna subjectActors: " + str(subjectActors))
     for subjectActor in subjectActors:
@@ -616,5 +429,6 @@ for linked_page in page.linkedPages():
     for wikidata_id in wikidata_ids:
         t=add_claim_if_not_exists(site, linked_page, 'P180', wikidata_id)
 
-conn.close()
+matcher.print_stats()
+hash_cache.close()
 
@@ -0,0 +1,86 @@
+# Perceptual and difference hashes for many images at once
+#
+# Same hashes as imagehash.phash() and imagehash.dhash(), but the images
+# are stacked to one numpy array and all of them are hashed with the same
+# array operations. phash DCT is done as matrix multiplication with the
+# DCT-II matrix (only the low frequency rows are needed).
+#
+# Hashes are returned as uint64 array of shape (number of images, words).
+# Bits are in the same order as in str(imagehash) and the first word is
+# the most significant, so with hash_size=8 the hash is one word which
+# equals int(str(imagehash.phash(im)), 16). hash_size=24 gives 9 words.
+#
+## Usage
+# phashes, dhashes = hash_images(images)
+# phash_int = int(phashes[0][0])
+
+import numpy
+from PIL import Image
+
+def hash_words(hash_size):
+    return (hash_size * hash_size + 63) // 64
+
+# Grayscale images resized to (width, height) stacked to array (N, height, width)
+def stack_images(images, size):
+    return numpy.stack([numpy.asarray(image.convert('L').resize(size, Image.LANCZOS)) for image in images])
+
+# bool array (N, bits) -> uint64 array (N, words), first bit is most significant
+def pack_bits(bits):
+    count, nbits = bits.shape
+    words = (nbits + 63) // 64
+    padded = numpy.zeros((count, words * 64), dtype=bool)
+    padded[:, words * 64 - nbits:] = bits
+    return numpy.packbits(padded, axis=1).view('>u8').astype(numpy.uint64)
+
+# Python int from one row of packed hash
+def hash_to_int(words):
+    value = 0
+    for word in words:
+        value = (value << 64) | int(word)
+    return value
+
+# hex string like str(imagehash)
+def hash_to_hex(words, hash_size):
+    width = (hash_size * hash_size + 3) // 4
+    return format(hash_to_int(words), '0' + str(width) + 'x')
+
+# rows of unnormalized DCT-II matrix (scipy.fftpack.dct type 2)
+_dct_matrices = {}
+
+def dct_matrix(rows, size):
+    key = (rows, size)
+    if key not in _dct_matrices:
+        k = numpy.arange(rows).reshape(-1, 1)
+        n = numpy.arange(size).reshape(1, -1)
+        _dct_matrices[key] = 2 * numpy.cos(numpy.pi * k * (2 * n + 1) / (2 * size))
+    return _dct_matrices[key]
+
+def phash_pixels(pixels, hash_size=8):
+    count, size = pixels.shape[0], pixels.shape[1]
+    dct = dct_matrix(hash_size, size)
+    # DCT along both axes, low frequencies only
+    lowfreq = dct @ pixels.astype(numpy.float64) @ dct.T
+    lowfreq = lowfreq.reshape(count, -1)
+    median = numpy.median(lowfreq, axis=1).reshape(-1, 1)
+    return pack_bits(lowfreq > median)
+
+def dhash_pixels(pixels):
+    count = pixels.shape[0]
+    # differences between columns
+    diff = pixels[:, :, 1:] > pixels[:, :, :-1]
+    return pack_bits(diff.reshape(count, -1))
+
+def phash_images(images, hash_size=8, highfreq_factor=4):
+    img_size = hash_size * highfreq_factor
+    return phash_pixels(stack_images(images, (img_size, img_size)), hash_size)
+
+def dhash_images(images, hash_size=8):
+    return dhash_pixels(stack_images(images, (hash_size + 1, hash_size)))
+
+# Returns tuple (phashes, dhashes), images are converted to grayscale only once
+def hash_images(images, hash_size=8, highfreq_factor=4):
+    grays = [image.convert('L') for image in images]
+    img_size = hash_size * highfreq_factor
+    phashes = phash_pixels(stack_images(grays, (img_size, img_size)), hash_size)
+    dhashes = dhash_pixels(stack_images(grays, (hash_size + 1, hash_size)))
+    return phashes, dhashes
@@ -0,0 +1,111 @@
+# sqlite storage for the local hash caches
+#
+# - WAL journal, reading does not block writing and several scripts can use
+#   the same database at the same time
+# - schema version is kept in PRAGMA user_version. Migrations are lists of
+#   SQL statements, the ones newer than the database are run in order when
+#   the database is opened
+# - writes are queued in memory and committed in batches in one short
+#   BEGIN IMMEDIATE transaction: after commit_every writes or when
+#   commit_interval seconds have passed since the last commit, and on close.
+#   The database is not locked between commits, so other processes can
+#   write to it
+# - reads don't commit the queue, they see committed rows only. Call
+#   commit() first when queued rows must be seen (counts, summaries)
+# - one connection is shared by threads, access is serialized with a lock
+#
+## Usage
+# MIGRATIONS = [
+#     # version 1
+#     ['CREATE TABLE items (key TEXT PRIMARY KEY, value TEXT)'],
+# ]
+# db = CacheDB('cache.db', MIGRATIONS)
+# db.write('INSERT OR REPLACE INTO items (key, value) VALUES (?, ?)', (key, value))
+# row = db.fetchone('SELECT value FROM items WHERE key = ?', (key,))
+# db.close()
+
+import sqlite3
+import threading
+import time
+
+COMMIT_EVERY = 100          # writes
+COMMIT_INTERVAL = 5.0       # seconds
+
+class CacheDB:
+    def __init__(self, path, migrations, commit_every=COMMIT_EVERY, commit_interval=COMMIT_INTERVAL):
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.lock = threading.RLock()
+        self.pending = 0
+        # (sql, list of params) waiting for commit
+        self.queued = []
+        self.last_commit = time.monotonic()
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # with WAL a commit is durable after checkpoint, enough for caches
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.migrate(migrations)
+
+    def version(self):
+        with self.lock:
+            return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self, migrations):
+        with self.lock:
+            self.commit()
+            # version is read again inside the transaction in case another
+            # process is migrating the same database
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+                for i in range(version, len(migrations)):
+                    for statement in migrations[i]:
+                        self.conn.execute(statement)
+                    self.conn.execute('PRAGMA user_version = ' + str(i + 1))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def fetchone(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def write(self, sql, params=()):
+        self.writemany(sql, [params])
+
+    def writemany(self, sql, rows):
+        rows = list(rows)
+        with self.lock:
+            self.queued.append((sql, rows))
+            self.pending += len(rows)
+            if self.pending >= self.commit_every or time.monotonic() - self.last_commit >= self.commit_interval:
+                self.commit()
+
+    def commit(self):
+        with self.lock:
+            queued = self.queued
+            self.queued = []
+            self.pending = 0
+            self.last_commit = time.monotonic()
+            if not queued:
+                return
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, rows in queued:
+                    self.conn.executemany(sql, rows)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.conn.close()
@@ -0,0 +1,101 @@
+# Cascaded image matcher
+#
+# Stages are tried in order. Each stage compares hashes of two images
+# (named sources, for example small and large Finna thumbnail) with its own
+# hash size and MatchPolicy: distance matching the policy rules accepts,
+# distance inside policy.near goes to the next stage and everything else is
+# rejected. Cheap stages (small thumbnails, short hashes) settle the clear
+# cases and larger images are fetched only for the close ones.
+#
+# Hashes come from HashCache, so each image is downloaded once. Matcher
+# counts for each stage how many comparisons it accepted, rejected and
+# escalated, and the downloads and CPU time it used, for tuning stages.
+#
+## Usage
+# from cascade import CascadeMatcher, PERSON_SUBJECTS_CASCADE
+#
+# matcher = CascadeMatcher(PERSON_SUBJECTS_CASCADE, hash_cache)
+# if matcher.match({'small': url1, 'large': url3}, {'thumbnail': url2}):
+#     print("same image")
+# matcher.print_stats()
+
+import time
+
+from fingerprint import MatchPolicy, PERSON_SUBJECTS_POLICY
+from hashcache import HashCache
+from imagematch import download_stats
+
+ACCEPT = 'accept'
+REJECT = 'reject'
+ESCALATE = 'escalate'
+
+class MatchStage:
+    __slots__ = ('name', 'source1', 'source2', 'hash_size', 'policy', 'kinds')
+
+    # kinds: hashes which are compared, distance of the other is taken as 0
+    def __init__(self, name, source1, source2, hash_size=8, policy=None, kinds=('phash', 'dhash')):
+        self.name = name
+        self.source1 = source1
+        self.source2 = source2
+        self.hash_size = hash_size
+        self.policy = policy
+        self.kinds = tuple(kinds)
+
+    def decide(self, phash_diff, dhash_diff, last=False):
+        if 'phash' not in self.kinds:
+            phash_diff = 0
+        if 'dhash' not in self.kinds:
+            dhash_diff = 0
+        if self.policy.is_match(phash_diff, dhash_diff):
+            return ACCEPT
+        if not last and self.policy.is_near(phash_diff, dhash_diff):
+            return ESCALATE
+        return REJECT
+
+# add_person_subjects.py: 8-bit hashes of small Finna thumbnail are used
+# only to reject, near ones are decided with 24-bit hashes of the large one
+PERSON_SUBJECTS_CASCADE = [
+    MatchStage('small', 'small', 'thumbnail', 8, MatchPolicy([], near=PERSON_SUBJECTS_POLICY.near)),
+    MatchStage('large', 'large', 'thumbnail', 24, PERSON_SUBJECTS_POLICY),
+]
+
+class CascadeMatcher:
+    def __init__(self, stages, hash_cache=None):
+        self.stages = stages
+        self.hash_cache = hash_cache if hash_cache is not None else HashCache()
+        self.stats = [{ACCEPT: 0, REJECT: 0, ESCALATE: 0, 'downloads': 0, 'bytes': 0, 'cpu': 0.0} for stage in stages]
+
+    # sources1 and sources2 are dicts source name -> url.
+    # Returns tuple (accepted, name of deciding stage)
+    def decide(self, sources1, sources2):
+        for index, stage in enumerate(self.stages):
+            stats = self.stats[index]
+            files = download_stats['files']
+            size = download_stats['bytes']
+            cpu = time.process_time()
+
+            fingerprint1 = self.hash_cache.fingerprint(sources1[stage.source1], stage.hash_size)
+            fingerprint2 = self.hash_cache.fingerprint(sources2[stage.source2], stage.hash_size)
+            phash_diff, dhash_diff = fingerprint1.distance(fingerprint2)
+            decision = stage.decide(phash_diff, dhash_diff, last=index == len(self.stages) - 1)
+
+            stats[decision] += 1
+            stats['downloads'] += download_stats['files'] - files
+            stats['bytes'] += download_stats['bytes'] - size
+            stats['cpu'] += time.process_time() - cpu
+            if decision != ESCALATE:
+                return decision == ACCEPT, stage.name
+        return False, None
+
+    def match(self, sources1, sources2):
+        accepted, stage_name = self.decide(sources1, sources2)
+        return accepted
+
+    def print_stats(self):
+        for stage, stats in zip(self.stages, self.stats):
+            comparisons = stats[ACCEPT] + stats[REJECT] + stats[ESCALATE]
+            print("Stage " + stage.name + " (" + str(stage.hash_size) + "-bit " + "+".join(stage.kinds) + "): "
+                  + str(comparisons) + " comparisons, accepted " + str(stats[ACCEPT])
+                  + ", rejected " + str(stats[REJECT]) + ", escalated " + str(stats[ESCALATE])
+                  + ", downloads " + str(stats['downloads']) + " (" + str(stats['bytes']) + " bytes)"
+                  + ", cpu " + format(stats['cpu'], '.2f') + " s")
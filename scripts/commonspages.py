@@ -0,0 +1,72 @@
+# Streaming page lists from Commons categories and list pages
+#
+# Pages are yielded as the API returns them, so processing starts
+# immediately and large category trees are not kept in memory. Each page is
+# yielded once (seen set of page ids) and each category is walked once, so
+# categories containing each other don't loop. Namespace filtering is done by
+# the API, only subcategories are requested in addition when walking deeper.
+#
+# depth is levels of subcategories walked: 0 only pages directly in the
+# category, 1 also pages in its subcategories and so on, None no limit.
+#
+## Usage
+# from commonspages import iter_category_pages, iter_linked_pages
+#
+# for page in iter_category_pages(commonssite, "Category:Kuvasiskot", depth=1):
+#     print(page.title())
+# for page in iter_linked_pages(commonssite, 'User:FinnaUploadBot/filelist'):
+#     print(page.title())
+
+from collections import deque
+
+import pywikibot
+
+FILE_NAMESPACE = 6
+CATEGORY_NAMESPACE = 14
+
+# pages without page id (missing pages) are identified by title
+def _page_key(page):
+    return page.pageid or page.title()
+
+# Generator of pages in category and its subcategories (breadth first).
+# skip(page) returning True leaves page out, for example isblockedimage
+def iter_category_pages(site, category, depth=0, namespaces=(FILE_NAMESPACE,), skip=None):
+    namespaces = list(namespaces) if namespaces is not None else None
+    root = pywikibot.Category(site, category)
+    seen = set()
+    walked = {root.title()}
+    categories = deque([(root, 0)])
+
+    while categories:
+        cat, level = categories.popleft()
+        walk_deeper = depth is None or level < depth
+        request_namespaces = namespaces
+        if walk_deeper and namespaces is not None and CATEGORY_NAMESPACE not in namespaces:
+            request_namespaces = namespaces + [CATEGORY_NAMESPACE]
+
+        for page in site.categorymembers(cat, namespaces=request_namespaces):
+            if walk_deeper and page.namespace() == CATEGORY_NAMESPACE and page.title() not in walked:
+                walked.add(page.title())
+                categories.append((pywikibot.Category(page), level + 1))
+            if namespaces is not None and page.namespace() not in namespaces:
+                continue
+            key = _page_key(page)
+            if key in seen:
+                continue
+            seen.add(key)
+            if skip is not None and skip(page):
+                continue
+            yield page
+
+# Generator of pages linked from the page, each once
+def iter_linked_pages(site, title, namespaces=(FILE_NAMESPACE,), skip=None):
+    listpage = pywikibot.Page(site, title)
+    seen = set()
+    for page in listpage.linkedPages(namespaces=list(namespaces) if namespaces is not None else None):
+        key = _page_key(page)
+        if key in seen:
+            continue
+        seen.add(key)
+        if skip is not None and skip(page):
+            continue
+        yield page
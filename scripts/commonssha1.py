@@ -0,0 +1,53 @@
+# File identity by SHA-1 of the raw bytes
+#
+# Commons reports sha1 of each file in imageinfo (FilePage.latest_file_info
+# in pywikibot) and files can be searched by it with list=allimages. A file
+# is identical to a Commons file if sha1 of its bytes is same, no need to
+# download or decode the Commons file. Digest of downloads is calculated
+# while they are streamed (imagematch.downloadimagefile).
+#
+## Usage
+# from commonssha1 import file_sha1, find_commons_files_by_sha1, is_commons_file
+#
+# sha1 = downloadimagefile(url, path)
+# if is_commons_file(sha1, filepage.latest_file_info):
+#     print("identical file")
+# names = find_commons_files_by_sha1(file_sha1(path))
+
+import hashlib
+
+import requests
+
+from ratelimit import limit
+
+COMMONS_API_URL = "https://commons.wikimedia.org/w/api.php"
+
+CHUNK_SIZE = 1024 * 1024
+
+# hex digest of file on disk, read in chunks
+def file_sha1(path, chunk_size=CHUNK_SIZE):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+# compare to sha1 reported by commons for the file
+def is_commons_file(sha1, file_info):
+    return bool(file_info.sha1) and file_info.sha1.lower() == sha1.lower()
+
+# Returns list of commons file names with the sha1
+def find_commons_files_by_sha1(sha1, session=None):
+    params = {
+        'action': 'query',
+        'list': 'allimages',
+        'aiprop': 'sha1',
+        'format': 'json',
+        'aisha1': sha1,
+    }
+    limit(COMMONS_API_URL)
+    response = (session or requests).get(COMMONS_API_URL, params=params)
+    if response.status_code != 200:
+        return []
+    data = response.json()
+    return [image['name'] for image in data.get('query', {}).get('allimages', [])]
@@ -18,6 +18,9 @@
 import pywikibot
 import json
 
+from commonspages import iter_linked_pages
+from pageprefetch import prefetch_pages
+
 # Create SDC MediaInfo statement using pywikibot simple_request
 def createMediainfoClaim(site, media_identifier, property, value):
 
@@ -45,39 +48,26 @@ def createMediainfoClaim(site, media_identifier, property, value):
       print('Error: {}'.format(e))
       exit(1)
 
-# Reads image mime type from API
-def get_mime_type(file_title):
-    mime_type=False
-
-    request = site.simple_request(
-        action='query',
-        titles=file_title,
-        prop='imageinfo', 
-        iiprop='mime'
-    )
-    # Execute the request
-    result = request.submit()
-      
-    # Extract the MIME type from the result
-    pages = result['query']['pages']
-    for page_id, page_data in pages.items():
-        mime_type = page_data['imageinfo'][0]['mime']
-    return mime_type
+# Image mime type from imageinfo, loaded by prefetch_pages()
+def get_mime_type(page):
+    return page.latest_file_info.mime
     
 def add_P1163_mime_type(site, page):
      media_identifier='M' + str(page.pageid)
      property='P1163'  # P1163 = Mime type
-     mime_type = get_mime_type(page.title())
+     mime_type = get_mime_type(page)
    
      pywikibot.output(f"Adding {property} (MIME type) = '{mime_type}' to ':c:{page.title()}' ({media_identifier})")
      createMediainfoClaim(site, media_identifier, property, mime_type)
 
 site = pywikibot.Site('commons', 'commons')  # The site we're working on
-page = pywikibot.Page(site, 'user:FinnaUploadBot/filelist')  # The page you're interested in
 
-# Get all linked pages from the page
-for page in page.linkedPages():
-    
+# Get all linked pages from the page, revisions and imageinfo are loaded
+# in batches ahead of the loop
+for page in prefetch_pages(site, iter_linked_pages(site, 'user:FinnaUploadBot/filelist')):
+    if page.namespace() != 6:  # 6 is the namespace ID for files
+        continue
+
     # Create new mediainfo with one statement if there is no mediainfo at all
     if not 'mediainfo' in page.latest_revision.slots:
         add_P1163_mime_type(site, page)
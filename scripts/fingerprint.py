@@ -0,0 +1,167 @@
+# Image fingerprints and match policies
+#
+# ImageFingerprint holds phash and dhash of one image as packed integers
+# (64 bits with hash_size 8, 576 bits with hash_size 24). FingerprintArray
+# holds hashes of many images as numpy uint64 arrays so that one image can
+# be compared against all of them with a few array operations.
+#
+# Thresholds for "same image" are in MatchPolicy objects so that every
+# script uses the same definition. A policy is a list of rules
+# (max phash distance, max dhash distance); distance matches if any rule
+# matches. near is the area where a match should be confirmed with larger
+# images or longer hashes.
+#
+## Usage
+# fingerprint = ImageFingerprint.from_image(image)
+# candidates = FingerprintArray.from_images(finna_images)
+# phash_diffs, dhash_diffs = candidates.distances(fingerprint)
+# matching = candidates.matches(fingerprint, SAME_IMAGE_POLICY)     # indices
+
+import numpy
+
+from batchhash import hash_images, hash_to_int, hash_words
+
+class MatchPolicy:
+    __slots__ = ('rules', 'near')
+
+    def __init__(self, rules, near=None):
+        self.rules = tuple(rules)
+        self.near = near
+
+    # works with ints and numpy arrays of distances
+    def is_match(self, phash_diff, dhash_diff):
+        ret = False
+        for max_phash, max_dhash in self.rules:
+            ret = ret | ((phash_diff <= max_phash) & (dhash_diff <= max_dhash))
+        return ret
+
+    # inside the near area, match or not
+    def is_near(self, phash_diff, dhash_diff):
+        if self.near is None:
+            return False
+        return (phash_diff <= self.near[0]) & (dhash_diff <= self.near[1])
+
+    # not a match but near enough to be checked again
+    def is_borderline(self, phash_diff, dhash_diff):
+        return self.is_near(phash_diff, dhash_diff) & ~numpy.asarray(self.is_match(phash_diff, dhash_diff))
+
+# max distance for same is that least one is 0 and second is max 3
+SAME_IMAGE_POLICY = MatchPolicy([(0, 3), (3, 0)], near=(9, 9))
+
+# add_person_subjects.py: small Finna thumbnails against Commons thumbnails,
+# near matches are confirmed with 24-bit hashes of larger images
+PERSON_SUBJECTS_POLICY = MatchPolicy([(0, 9), (9, 0), (8, 8)], near=(10, 10))
+
+def popcount(value):
+    return value.bit_count()
+
+# popcount for each byte value, used if numpy has no bitwise_count
+_POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+# number of set bits in each row of uint64 array (N, words)
+def popcount_rows(words):
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(words).sum(axis=1, dtype=numpy.int64)
+    return _POPCOUNT_TABLE[words.view(numpy.uint8)].reshape(words.shape[0], -1).sum(axis=1, dtype=numpy.int64)
+
+# Python int -> uint64 words, first word is most significant
+def int_to_words(value, words):
+    return numpy.array([(value >> (64 * (words - 1 - i))) & 0xFFFFFFFFFFFFFFFF for i in range(words)], dtype=numpy.uint64)
+
+class ImageFingerprint:
+    __slots__ = ('phash', 'dhash', 'hash_size')
+
+    def __init__(self, phash, dhash, hash_size=8):
+        self.phash = phash
+        self.dhash = dhash
+        self.hash_size = hash_size
+
+    @classmethod
+    def from_image(cls, image, hash_size=8):
+        return cls.from_images([image], hash_size)[0]
+
+    @classmethod
+    def from_images(cls, images, hash_size=8):
+        phashes, dhashes = hash_images(images, hash_size)
+        return [cls(hash_to_int(phashes[i]), hash_to_int(dhashes[i]), hash_size) for i in range(len(images))]
+
+    def __repr__(self):
+        return 'ImageFingerprint(' + self.phash_hex + ', ' + self.dhash_hex + ')'
+
+    def __eq__(self, other):
+        return isinstance(other, ImageFingerprint) and (self.phash, self.dhash, self.hash_size) == (other.phash, other.dhash, other.hash_size)
+
+    def __hash__(self):
+        return hash((self.phash, self.dhash, self.hash_size))
+
+    # hex strings like str(imagehash)
+    @property
+    def phash_hex(self):
+        return format(self.phash, '0' + str((self.hash_size * self.hash_size + 3) // 4) + 'x')
+
+    @property
+    def dhash_hex(self):
+        return format(self.dhash, '0' + str((self.hash_size * self.hash_size + 3) // 4) + 'x')
+
+    # Returns tuple (phash distance, dhash distance)
+    def distance(self, other):
+        if self.hash_size != other.hash_size:
+            raise ValueError("Can't compare fingerprints of different hash sizes")
+        return popcount(self.phash ^ other.phash), popcount(self.dhash ^ other.dhash)
+
+    def matches(self, other, policy=SAME_IMAGE_POLICY):
+        phash_diff, dhash_diff = self.distance(other)
+        return policy.is_match(phash_diff, dhash_diff)
+
+class FingerprintArray:
+    __slots__ = ('phashes', 'dhashes', 'hash_size')
+
+    # phashes and dhashes are uint64 arrays (N, words)
+    def __init__(self, phashes, dhashes, hash_size=8):
+        self.phashes = phashes
+        self.dhashes = dhashes
+        self.hash_size = hash_size
+
+    @classmethod
+    def from_images(cls, images, hash_size=8):
+        phashes, dhashes = hash_images(images, hash_size)
+        return cls(phashes, dhashes, hash_size)
+
+    @classmethod
+    def from_fingerprints(cls, fingerprints, hash_size=8):
+        words = hash_words(hash_size)
+        phashes = numpy.zeros((len(fingerprints), words), dtype=numpy.uint64)
+        dhashes = numpy.zeros((len(fingerprints), words), dtype=numpy.uint64)
+        for i, fingerprint in enumerate(fingerprints):
+            phashes[i] = int_to_words(fingerprint.phash, words)
+            dhashes[i] = int_to_words(fingerprint.dhash, words)
+        return cls(phashes, dhashes, hash_size)
+
+    def __len__(self):
+        return self.phashes.shape[0]
+
+    def __getitem__(self, index):
+        return ImageFingerprint(hash_to_int(self.phashes[index]), hash_to_int(self.dhashes[index]), self.hash_size)
+
+    # Returns tuple of int arrays (phash distances, dhash distances) to fingerprint
+    def distances(self, fingerprint):
+        if fingerprint.hash_size != self.hash_size:
+            raise ValueError("Can't compare fingerprints of different hash sizes")
+        words = self.phashes.shape[1]
+        phash_diffs = popcount_rows(self.phashes ^ int_to_words(fingerprint.phash, words))
+        dhash_diffs = popcount_rows(self.dhashes ^ int_to_words(fingerprint.dhash, words))
+        return phash_diffs, dhash_diffs
+
+    # indices of matching fingerprints
+    def matches(self, fingerprint, policy=SAME_IMAGE_POLICY):
+        phash_diffs, dhash_diffs = self.distances(fingerprint)
+        return numpy.flatnonzero(policy.is_match(phash_diffs, dhash_diffs))
+
+    # Returns tuple (index, phash distance, dhash distance) of the closest
+    # fingerprint by phash + dhash distance, None if array is empty
+    def closest(self, fingerprint):
+        if len(self) == 0:
+            return None
+        phash_diffs, dhash_diffs = self.distances(fingerprint)
+        index = int(numpy.argmin(phash_diffs + dhash_diffs))
+        return index, int(phash_diffs[index]), int(dhash_diffs[index])
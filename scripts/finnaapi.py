@@ -0,0 +1,441 @@
+# Shared client for the Finna API
+#
+# Finna API documentation
+# * https://api.finna.fi
+# * https://www.kiwi.fi/pages/viewpage.action?pageId=53839221
+#
+# All requests go through one requests.Session so the connection to
+# api.finna.fi is kept alive and reused between records instead of opening
+# a new TLS connection for every file. Failed requests are retried with
+# backoff and errors are raised as FinnaError so that the calling script
+# can skip the file instead of exiting.
+#
+# Responses are cached on disk (see finnacache.py) so that repeated runs
+# over the same files are mostly served locally. Use refresh=True to
+# bypass the cache and store fresh copy. Search results change when records
+# are added, they are fresh only for SEARCH_CACHE_TTL.
+#
+# fields can be list of Finna fields or name of a field profile
+# (see FIELD_PROFILES in finnarecord.py). Bytes received from Finna are
+# counted per profile, see get_payload_stats().
+#
+## Usage
+# from finnaapi import get_finna_record, get_finna_records, FinnaError
+#
+# try:
+#     finna_record = get_finna_record(finnaid)
+# except FinnaError as e:
+#     print(e)
+#
+# # many records with few requests
+# finna_records, finna_statuses = get_finna_records(finnaids, fields='sdc')
+# finna_record = finna_records[finnaid]     # FinnaRecord
+#
+# # search, one page of results
+# data = search_finna(filters=['~format_ext_str_mv:"0/Image/"'], page=1)
+#
+# # search, all pages. Records are yielded as soon as their page arrives
+# for record in iter_finna_search(filters=['~format_ext_str_mv:"0/Image/"']):
+#     print(record.id)
+
+import math
+import threading
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from finnacache import FinnaCache, make_key
+from finnarecord import FinnaRecord, FIELD_PROFILES
+from ratelimit import get_limiter
+
+FINNA_API_URL = "https://api.finna.fi/v1/"
+USER_AGENT = "pywikibot-fiwiki-scripts (https://github.com/Wikimedia-Suomi/pywikibot-fiwiki-scripts)"
+
+# Fields requested by default (profile 'full'), most of the information in the record
+DEFAULT_FIELDS = [
+    'id',
+    'title',
+    'subTitle',
+    'shortTitle',
+    'summary',
+    'imageRights',
+    'images',
+    'imagesExtended',
+    'onlineUrls',
+    'openUrl',
+    'nonPresenterAuthors',
+    'subjects',
+    'subjectsExtendet',
+    'subjectPlaces',
+    'subjectActors',
+    'subjectDetails',
+    'geoLocations',
+    'buildings',
+    'identifierString',
+    'collections',
+    'institutions',
+    'classifications',
+    'events',
+    'languages',
+    'originalLanguages',
+    'year',
+    'hierarchicalPlaceNames',
+    'formats',
+    'physicalDescriptions',
+    'measurements',
+]
+
+# Number of ids asked with one record request, keeps the url at sane length
+RECORD_BATCH_SIZE = 50
+
+# HTTP status codes which are worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Search paging: Finna returns max 100 records per page and the old scripts
+# never read past page 100
+SEARCH_PAGE_LIMIT = 100
+SEARCH_MAX_PAGES = 100
+SEARCH_WORKERS = 4
+
+# search pages are served from the cache only this long (seconds), enough
+# for rerunning a stopped script but new records are found on later runs
+SEARCH_CACHE_TTL = 3600
+
+# Returns tuple (profile name, list of fields)
+def resolve_fields(fields):
+    if fields is None:
+        return 'full', DEFAULT_FIELDS
+    if isinstance(fields, str):
+        if fields not in FIELD_PROFILES:
+            raise ValueError("Unknown Finna field profile: " + fields)
+        return fields, FIELD_PROFILES[fields]
+    return 'custom', list(fields)
+
+class FinnaError(Exception):
+    pass
+
+# network failure or timeout, still failing after retries
+class FinnaConnectionError(FinnaError):
+    pass
+
+# Finna answered but the answer is not usable (http error, invalid json)
+class FinnaResponseError(FinnaError):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+# 4xx caused by the request itself, not rate limiting
+def is_request_error(status_code):
+    return status_code is not None and 400 <= status_code < 500 and status_code != 429
+
+class FinnaClient:
+    # timeout is (connect timeout, read timeout) in seconds for each request,
+    # retries are done with exponential backoff: backoff_factor * 2^(retry-1)
+    #
+    # cache is FinnaCache or None for no caching, refresh=True ignores
+    # cached responses for all requests of this client
+    #
+    # rate_limiter is shared by all threads using the client, None
+    # disables limiting
+    def __init__(self, timeout=(10, 60), retries=5, backoff_factor=1, pool_size=10, cache=None, refresh=False, rate_limiter=None):
+        self.timeout = timeout
+        self.cache = cache
+        self.refresh = refresh
+        self.rate_limiter = rate_limiter
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # profile name -> {'requests': n, 'bytes': n}
+        self.payload_stats = {}
+        self.stats_lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    # params is list of (name, value) tuples since Finna uses repeated
+    # parameters like field[]
+    # ttl overrides the ttl of the cache for this request
+    def request(self, endpoint, params, refresh=False, profile='custom', ttl=None):
+        if self.cache is None:
+            data, response = self._fetch(endpoint, params, profile=profile)
+            return data
+
+        key = make_key(endpoint, params)
+        cached = None
+        headers = {}
+        if not (refresh or self.refresh):
+            cached = self.cache.get(key, ttl)
+            if cached is not None:
+                if cached['fresh']:
+                    return cached['data']
+                # stale: ask Finna if it has changed
+                if cached['etag']:
+                    headers['If-None-Match'] = cached['etag']
+                if cached['last_modified']:
+                    headers['If-Modified-Since'] = cached['last_modified']
+
+        data, response = self._fetch(endpoint, params, headers, profile)
+        if data is None:
+            # 304 Not Modified
+            self.cache.touch(key)
+            return cached['data']
+
+        if data.get('status') == 'OK':
+            self.cache.put(key, data, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return data
+
+    # Returns tuple (data, response), data is None if server answered
+    # 304 Not Modified to conditional request
+    def _fetch(self, endpoint, params, headers=None, profile='custom'):
+        url = FINNA_API_URL + endpoint
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        try:
+            response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise FinnaConnectionError("Finna API query failed: " + url + ": " + str(e)) from e
+
+        with self.stats_lock:
+            stats = self.payload_stats.setdefault(profile, {'requests': 0, 'bytes': 0})
+            stats['requests'] += 1
+            stats['bytes'] += len(response.content)
+
+        if response.status_code == 304 and headers:
+            return None, response
+
+        if response.status_code != 200:
+            raise FinnaResponseError("Finna API query failed with HTTP " + str(response.status_code) + ": " + response.url, response.status_code)
+
+        try:
+            return response.json(), response
+        except ValueError as e:
+            raise FinnaResponseError("Finna API returned invalid JSON: " + response.url, response.status_code) from e
+
+    # Get finna API record, returns the API response as is
+    def get_record(self, id, fields=None, refresh=False):
+        profile, fields = resolve_fields(fields)
+
+        params = [('id', id)]
+        for field in fields:
+            params.append(('field[]', field))
+
+        return self.request('record', params, refresh, profile)
+
+    # Get several records using one request per chunk of ids (id[] parameter
+    # can be repeated in the record request).
+    #
+    # Returns tuple (records, statuses):
+    # - records maps requested id to the FinnaRecord found for it
+    # - statuses maps every requested id to 'OK', 'not found' or error message
+    def get_records(self, ids, fields=None, chunk_size=RECORD_BATCH_SIZE, refresh=False):
+        profile, fields = resolve_fields(fields)
+        # id is needed for mapping the records back to requested ids
+        if 'id' not in fields:
+            fields = ['id'] + list(fields)
+
+        records = {}
+        statuses = {}
+
+        # remove duplicates but keep order
+        unique_ids = list(dict.fromkeys(ids))
+
+        # records found from cache are not requested again,
+        # they are cached one by one so get_record() finds them too
+        missing = []
+        for id in unique_ids:
+            cached = None
+            if self.cache is not None and not (refresh or self.refresh):
+                cached = self.cache.get(self._record_key(id, fields))
+            if cached is not None and cached['fresh'] and cached['data'].get('records'):
+                records[id] = FinnaRecord(cached['data']['records'][0])
+                statuses[id] = 'OK'
+            else:
+                missing.append(id)
+
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            self._get_records_chunk(chunk, fields, records, statuses, profile)
+
+        return records, statuses
+
+    def _record_key(self, id, fields):
+        params = [('id', id)]
+        for field in fields:
+            params.append(('field[]', field))
+        return make_key('record', params)
+
+    def _get_records_chunk(self, chunk, fields, records, statuses, profile):
+        params = []
+        for id in chunk:
+            params.append(('id[]', id))
+        for field in fields:
+            params.append(('field[]', field))
+
+        try:
+            data, response = self._fetch('record', params, profile=profile)
+        except FinnaResponseError as e:
+            # one broken id makes Finna reject the whole request (400, 414)
+            # -> ask ids one by one to find out status of each. Overload and
+            # server errors (429, 5xx) fail the whole chunk, splitting would
+            # only multiply the requests
+            if len(chunk) > 1 and is_request_error(e.status_code):
+                for id in chunk:
+                    self._get_records_chunk([id], fields, records, statuses, profile)
+                return
+            for id in chunk:
+                statuses[id] = str(e)
+            return
+        except FinnaError as e:
+            for id in chunk:
+                statuses[id] = str(e)
+            return
+
+        if data.get('status') != 'OK':
+            for id in chunk:
+                statuses[id] = "status not OK: " + str(data.get('status'))
+            return
+
+        # ids in old links may be url encoded
+        found = {}
+        for record in data.get('records', []):
+            found[record['id']] = record
+            found[urllib.parse.unquote(record['id'])] = record
+
+        for id in chunk:
+            record = found.get(id) or found.get(urllib.parse.unquote(id))
+            if record is None:
+                statuses[id] = 'not found'
+            else:
+                records[id] = FinnaRecord(record)
+                statuses[id] = 'OK'
+                if self.cache is not None:
+                    self.cache.put(self._record_key(id, fields), {'status': 'OK', 'resultCount': 1, 'records': [record]})
+
+    # Search records
+    # filters is list of filter[] values, search_type is for example
+    # 'AllFields' or 'Subjects'
+    def search(self, lookfor=None, search_type=None, filters=(), fields=None, page=1, limit=100, refresh=False):
+        profile, fields = resolve_fields(fields)
+
+        params = []
+        for filter in filters:
+            params.append(('filter[]', filter))
+        if lookfor is not None:
+            params.append(('lookfor', lookfor))
+        if search_type is not None:
+            params.append(('type', search_type))
+        for field in fields:
+            params.append(('field[]', field))
+        params.append(('limit', str(limit)))
+        params.append(('page', str(page)))
+
+        return self.request('search', params, refresh, profile, SEARCH_CACHE_TTL)
+
+    # Search all result pages. Number of pages is read from resultCount of
+    # the first page and the rest are fetched concurrently by `workers`
+    # threads (requests still go through the rate limiter), at most `workers`
+    # pages are requested or waiting at a time. Records are
+    # yielded as FinnaRecord objects as soon as their page is ready, so
+    # order between pages is not preserved.
+    #
+    # Stopping the iteration early cancels the pages not yet requested.
+    #
+    # max_pages=None reads all pages. With complete=True all pages are read
+    # and FinnaResponseError is raised at the end if fewer different records
+    # than resultCount were received, for callers which must see every record.
+    def iter_search(self, lookfor=None, search_type=None, filters=(), fields=None, limit=SEARCH_PAGE_LIMIT,
+                    max_pages=SEARCH_MAX_PAGES, workers=SEARCH_WORKERS, refresh=False, complete=False):
+        def get_page(page):
+            data = self.search(lookfor, search_type, filters, fields, page, limit, refresh)
+            if data.get('status') != 'OK':
+                raise FinnaResponseError("Finna search page " + str(page) + " status not OK: " + str(data.get('status')))
+            return data
+
+        data = get_page(1)
+        result_count = data.get('resultCount', 0)
+        received = set()
+        for record in data.get('records', []):
+            received.add(record.get('id'))
+            yield FinnaRecord(record)
+
+        pages = math.ceil(result_count / limit)
+        if max_pages is not None and not complete:
+            pages = min(max_pages, pages)
+
+        remaining = iter(range(2, pages + 1))
+        pending = set()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for page in remaining:
+                pending.add(executor.submit(get_page, page))
+                if len(pending) >= workers:
+                    break
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                # next page is requested when one is finished
+                for future in finished:
+                    page = next(remaining, None)
+                    if page is not None:
+                        pending.add(executor.submit(get_page, page))
+                for future in finished:
+                    for record in future.result().get('records', []):
+                        received.add(record.get('id'))
+                        yield FinnaRecord(record)
+        finally:
+            # only the pages already requested are waited for
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        if complete and len(received) < result_count:
+            raise FinnaResponseError("Finna search incomplete: received " + str(len(received)) + " of " + str(result_count) + " records")
+
+# client shared by the functions below, created on first use
+_client = None
+
+def get_client():
+    global _client
+    if _client is None:
+        # limit is shared with other scripts running at the same time,
+        # cached responses are not counted
+        _client = FinnaClient(cache=FinnaCache(), rate_limiter=get_limiter('api.finna.fi'))
+    return _client
+
+def get_finna_record(id, fields=None, refresh=False):
+    return get_client().get_record(id, fields, refresh)
+
+def get_finna_records(ids, fields=None, chunk_size=RECORD_BATCH_SIZE, refresh=False):
+    return get_client().get_records(ids, fields, chunk_size, refresh)
+
+def search_finna(lookfor=None, search_type=None, filters=(), fields=None, page=1, limit=100, refresh=False):
+    return get_client().search(lookfor, search_type, filters, fields, page, limit, refresh)
+
+def iter_finna_search(lookfor=None, search_type=None, filters=(), fields=None, limit=SEARCH_PAGE_LIMIT,
+                      max_pages=SEARCH_MAX_PAGES, workers=SEARCH_WORKERS, refresh=False, complete=False):
+    return get_client().iter_search(lookfor, search_type, filters, fields, limit, max_pages, workers, refresh, complete)
+
+# bytes received from Finna per field profile
+def get_payload_stats():
+    return get_client().payload_stats
+
+def print_payload_stats():
+    for profile, stats in get_payload_stats().items():
+        print("Finna payload (" + profile + "): " + str(stats['requests']) + " requests, " + str(stats['bytes']) + " bytes")
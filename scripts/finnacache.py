@@ -0,0 +1,203 @@
+# Persistent on-disk cache for Finna API responses
+#
+# Scripts are run many times over the same file lists so most of the Finna
+# records are same as in the previous run. Responses are stored in sqlite
+# database and served from there until they are older than ttl. Stale
+# entries are revalidated with If-None-Match / If-Modified-Since when Finna
+# has given ETag or Last-Modified for them, otherwise they are fetched again.
+#
+# Size of the cache is bounded: when stored responses take more than
+# max_size bytes least recently used entries are removed.
+#
+# Database is in WAL mode so that reading does not block other scripts.
+# Cache hits don't write: access times are kept in memory and written with
+# the next put or after ACCESS_WRITE_INTERVAL seconds.
+#
+## Usage
+# cache = FinnaCache('finnacache.db', ttl=7*24*3600)
+# client = FinnaClient(cache=cache)
+#
+## Maintenance
+# python finnacache.py            # show statistics
+# python finnacache.py --expire   # remove entries older than ttl
+# python finnacache.py --clear    # remove everything
+
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+DEFAULT_CACHE_PATH = 'finnacache.db'
+DEFAULT_TTL = 7 * 24 * 3600             # seconds
+DEFAULT_MAX_SIZE = 500 * 1024 * 1024    # bytes
+ACCESS_WRITE_INTERVAL = 60.0            # seconds
+
+# Cache key from endpoint and request parameters.
+# Order of fields does not matter, so same field set gives same key
+# regardless of how it was listed. Records are keyed as
+# record:<id>:<hash of fields> so they are easy to find by id.
+def make_key(endpoint, params):
+    values = []
+    ids = []
+    for name, value in params:
+        if endpoint == 'record' and name in ('id', 'id[]'):
+            ids.append(value)
+        else:
+            values.append(name + '=' + value)
+    digest = hashlib.sha1('&'.join(sorted(values)).encode('utf-8')).hexdigest()
+
+    if endpoint == 'record' and len(ids) == 1:
+        return 'record:' + ids[0] + ':' + digest
+    return endpoint + ':' + ':'.join(sorted(ids)) + ':' + digest
+
+class FinnaCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # same cache is used by concurrent requests from worker threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                             key TEXT PRIMARY KEY,
+                             fetched REAL NOT NULL,
+                             accessed REAL NOT NULL,
+                             size INTEGER NOT NULL,
+                             etag TEXT,
+                             last_modified TEXT,
+                             body TEXT NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.conn.commit()
+
+        self.total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+        # key -> access time not written yet
+        self.accessed = {}
+        self.accessed_written = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self._write_accessed()
+            self.conn.commit()
+            self.conn.close()
+
+    # queued access times to the current transaction, caller commits
+    def _write_accessed(self):
+        if self.accessed:
+            self.conn.executemany('UPDATE responses SET accessed = ? WHERE key = ?',
+                                  [(accessed, key) for key, accessed in self.accessed.items()])
+            self.accessed = {}
+        self.accessed_written = time.monotonic()
+
+    # Returns dict with keys data, fresh, etag and last_modified
+    # or None if key is not in cache. ttl overrides self.ttl for freshness
+    def get(self, key, ttl=None):
+        with self.lock:
+            row = self.conn.execute('SELECT fetched, etag, last_modified, body FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self.accessed[key] = now
+            if time.monotonic() - self.accessed_written >= ACCESS_WRITE_INTERVAL:
+                self._write_accessed()
+                self.conn.commit()
+
+        fetched, etag, last_modified, body = row
+        return {
+            'data': json.loads(body),
+            'fresh': now - fetched < (self.ttl if ttl is None else ttl),
+            'etag': etag,
+            'last_modified': last_modified,
+        }
+
+    def put(self, key, data, etag=None, last_modified=None):
+        body = json.dumps(data, ensure_ascii=False)
+        size = len(body.encode('utf-8'))
+        now = time.time()
+
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.total_size -= row[0]
+            self.conn.execute('INSERT OR REPLACE INTO responses (key, fetched, accessed, size, etag, last_modified, body) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (key, now, now, size, etag, last_modified, body))
+            self.accessed.pop(key, None)
+            self._write_accessed()
+            self.total_size += size
+            if self.total_size > self.max_size:
+                self._evict()
+            self.conn.commit()
+
+    # response was still valid (HTTP 304), start ttl from beginning
+    def touch(self, key):
+        now = time.time()
+        with self.lock:
+            self.accessed.pop(key, None)
+            self.conn.execute('UPDATE responses SET fetched = ?, accessed = ? WHERE key = ?', (now, now, key))
+            self.conn.commit()
+
+    def delete(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.total_size -= row[0]
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.conn.commit()
+
+    # remove all cached versions of one record (all field sets)
+    def delete_record(self, id):
+        with self.lock:
+            pattern = 'record:' + id.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + ':%'
+            self.conn.execute("DELETE FROM responses WHERE key LIKE ? ESCAPE '\\'", (pattern,))
+            self.conn.commit()
+            self.total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    # remove entries older than ttl
+    def expire(self):
+        with self.lock:
+            cursor = self.conn.execute('DELETE FROM responses WHERE fetched < ?', (time.time() - self.ttl,))
+            self.conn.commit()
+            self.total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            return cursor.rowcount
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM responses')
+            self.conn.commit()
+            self.conn.execute('VACUUM')
+            self.total_size = 0
+
+    def stats(self):
+        with self.lock:
+            count, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+            stale = self.conn.execute('SELECT COUNT(*) FROM responses WHERE fetched < ?', (time.time() - self.ttl,)).fetchone()[0]
+        return {'entries': count, 'size': size, 'stale': stale}
+
+    # drop least recently used entries until cache is under 90% of max_size
+    # so that eviction is not needed again right after next insert
+    def _evict(self):
+        target = self.max_size * 0.9
+        rows = self.conn.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall()
+        removed = []
+        for key, size in rows:
+            if self.total_size <= target:
+                break
+            removed.append((key,))
+            self.total_size -= size
+        self.conn.executemany('DELETE FROM responses WHERE key = ?', removed)
+
+if __name__ == '__main__':
+    cache = FinnaCache()
+    if '--clear' in sys.argv:
+        cache.clear()
+        print("Cache cleared: " + cache.path)
+    elif '--expire' in sys.argv:
+        print("Expired entries removed: " + str(cache.expire()))
+    stats = cache.stats()
+    print("Entries: " + str(stats['entries']) + ", stale: " + str(stats['stale']) + ", size: " + str(stats['size']) + " bytes")
+    cache.close()
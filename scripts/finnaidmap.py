@@ -0,0 +1,294 @@
+# Persistent mapping from obsolete Finna ids to current ids
+#
+# Old musketti and hkm.HKM ids in Commons source links do not work with
+# the Finna API. Current id can be found only from the html record page,
+# which is large, so each old id is resolved once and the result is stored
+# in sqlite database shared by all scripts.
+#
+# Record page is read in chunks and the download is stopped as soon as the
+# id has been found. Id is near the top of the page so usually only first
+# chunks are transferred and decoded.
+#
+# Ids which can't be resolved (page not found, no id in the page) are
+# stored too and not retried before FAILURE_TTL has passed. Network errors
+# are not stored, those are tried again on next run.
+#
+## Usage
+# from finnaidmap import resolve_finna_id, resolve_finna_ids
+#
+# newid = resolve_finna_id(oldid)               # "" if not found
+# newids = resolve_finna_ids(oldids)            # dict old id -> new id or ""
+#
+## Bulk resolving and statistics
+# python finnaidmap.py ids.txt        # resolve ids listed one per line
+# python finnaidmap.py                # show statistics
+
+import codecs
+import sqlite3
+import sys
+import threading
+import time
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from finnaapi import USER_AGENT
+from ratelimit import get_limiter
+
+DEFAULT_IDMAP_PATH = 'finnaidmap.db'
+FINNA_RECORD_URL = "https://www.finna.fi/Record/"
+FAILURE_TTL = 30 * 24 * 3600    # seconds
+
+RESOLVE_WORKERS = 4
+
+# seconds for connecting and for each read of the record page
+RECORD_PAGE_TIMEOUT = 60
+
+# bytes read from record page at a time
+SCAN_CHUNK_SIZE = 16 * 1024
+
+# id is searched after these, see parse functions below
+API_ID_MARKER = ';api.finna.fi&'
+RECORD_ID_MARKER = 'data-record-id="'
+MARKER_OVERLAP = max(len(API_ID_MARKER), len(RECORD_ID_MARKER)) - 1
+
+# pages and bytes read from finna record pages
+page_stats = {'pages': 0, 'bytes': 0}
+page_stats_lock = threading.Lock()
+
+# ids which are not accepted by Finna API anymore
+def isobsoletefinnaid(finnaid):
+    return finnaid.find("musketti") >= 0 or finnaid.find("hkm.HKM") >= 0
+
+# https&#x3A;&#x2F;&#x2F;api.finna.fi&#x2F;v1&#x2F;record&#x3F;id&#x3D;
+def parseapiidfromfinnapage(finnapage):
+    index = finnapage.find(API_ID_MARKER)
+    if (index < 0):
+        return ""
+    finnapage = finnapage[index:]
+
+    index = finnapage.find('id')
+    if (index < 0):
+        return ""
+    index = finnapage.find('&#x3D;')
+    if (index < 0):
+        return ""
+    index = index + len("&#x3D;")
+    finnapage = finnapage[index:]
+
+    indexend = finnapage.find('"')
+    if (indexend < 0):
+        indexend = finnapage.find('>')
+        if (indexend < 0):
+            return ""
+    finnapage = finnapage[:indexend]
+
+    # convert html code to character (if any)
+    finnapage = finnapage.replace("&#x25;3A", ":")
+
+    indexend = finnapage.find('&amp')
+    if (indexend < 0):
+        indexend = finnapage.find('&')
+        if (indexend < 0):
+            return ""
+    finnapage = finnapage[:indexend]
+    return finnapage
+
+def parsedatarecordidfromfinnapage(finnapage):
+    attrlen = len(RECORD_ID_MARKER)
+    indexid = finnapage.find(RECORD_ID_MARKER)
+    if (indexid < 0):
+        return ""
+
+    indexid = indexid+attrlen
+    indexend = finnapage.find('"', indexid)
+    if (indexend < 0):
+        return ""
+
+    return finnapage[indexid:indexend]
+
+# Read html page in chunks until id is found. Text which can't contain
+# start of a marker is dropped, so the page is never kept in memory as a
+# whole and the marker or id can be split between chunks.
+#
+# The id which is complete first is returned. Both markers give the
+# current id of the record.
+def scanfinnapage(response, chunk_size=SCAN_CHUNK_SIZE):
+    decoder = codecs.getincrementaldecoder("utf8")()
+    buffer = ""
+    bytesread = 0
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            bytesread += len(chunk)
+            buffer += decoder.decode(chunk, final=not chunk)
+
+            newid = parseapiidfromfinnapage(buffer)
+            if (len(newid) > 0):
+                # sometimes finna has this html code instead of url encoding..
+                return newid.replace("&#x25;3A", ":")
+            newid = parsedatarecordidfromfinnapage(buffer)
+            if (len(newid) > 0):
+                return newid
+
+            if not chunk:
+                return ""
+
+            # keep from the first marker found (id is not complete yet)
+            # or the tail which may have beginning of a marker
+            start = len(buffer) - MARKER_OVERLAP
+            for marker in (API_ID_MARKER, RECORD_ID_MARKER):
+                index = buffer.find(marker)
+                if (index >= 0 and index < start):
+                    start = index
+            buffer = buffer[max(start, 0):]
+    finally:
+        with page_stats_lock:
+            page_stats['pages'] += 1
+            page_stats['bytes'] += bytesread
+
+# Fetch record page from finna and parse current id from it.
+# Returns tuple (newid, error, permanent):
+# - newid is "" when id was not found
+# - permanent is True when retrying will not help (page missing, no id in page)
+def fetchcurrentfinnaid(finnaurl):
+    try:
+        request = urllib.request.Request(finnaurl, headers={'User-Agent': USER_AGENT})
+        # closing the response drops rest of the page
+        with urllib.request.urlopen(request, timeout=RECORD_PAGE_TIMEOUT) as response:
+            newid = scanfinnapage(response)
+    except urllib.error.HTTPError as e:
+        # 404 and 410 are for good, 5xx and 429 might work later
+        return "", "HTTP " + str(e.code), e.code in (404, 410)
+    except urllib.error.URLError as e:
+        return "", str(e.reason), False
+    except OSError as e:
+        # connection lost while reading
+        return "", str(e), False
+    except UnicodeDecodeError as e:
+        return "", str(e), True
+
+    if (len(newid) > 0):
+        return newid, None, False
+    return "", "no id in page", True
+
+# fetch metapage from finna and try to parse current ID from the page
+# since we might have obsolete ID.
+# new ID is needed API query.
+def parsemetaidfromfinnapage(finnaurl):
+    print("request: " + finnaurl)
+    newid, error, permanent = fetchcurrentfinnaid(finnaurl)
+    if (newid == ""):
+        print("could not get id from " + finnaurl + ": " + error)
+        return ""
+    print("new id from finna: " + newid)
+    return newid
+
+class FinnaIdMap:
+    def __init__(self, path=DEFAULT_IDMAP_PATH, failure_ttl=FAILURE_TTL, rate_limiter=None):
+        self.path = path
+        self.failure_ttl = failure_ttl
+        self.rate_limiter = rate_limiter
+        self.conn = sqlite3.connect(path)
+        # new_id is "" for failed ids
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS idmap (
+                             old_id TEXT PRIMARY KEY,
+                             new_id TEXT NOT NULL,
+                             resolved REAL NOT NULL,
+                             error TEXT,
+                             attempts INTEGER NOT NULL DEFAULT 1)''')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # Returns new id, "" for known failure or None if id has not been
+    # resolved yet (or failure has expired)
+    def lookup(self, old_id):
+        row = self.conn.execute('SELECT new_id, resolved FROM idmap WHERE old_id = ?', (old_id,)).fetchone()
+        if row is None:
+            return None
+        new_id, resolved = row
+        if new_id == "" and time.time() - resolved > self.failure_ttl:
+            return None
+        return new_id
+
+    def store(self, old_id, new_id, error=None):
+        self.conn.execute('''INSERT INTO idmap (old_id, new_id, resolved, error) VALUES (?, ?, ?, ?)
+                             ON CONFLICT(old_id) DO UPDATE SET new_id = excluded.new_id, resolved = excluded.resolved,
+                             error = excluded.error, attempts = attempts + 1''',
+                          (old_id, new_id, time.time(), error))
+        self.conn.commit()
+
+    def _fetch(self, old_id):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return fetchcurrentfinnaid(FINNA_RECORD_URL + old_id)
+
+    def resolve(self, old_id):
+        return self.resolve_many([old_id], workers=1)[old_id]
+
+    # Resolve list of old ids, pages of unknown ids are fetched concurrently.
+    # Returns dict old id -> new id, "" for ids which could not be resolved
+    def resolve_many(self, old_ids, workers=RESOLVE_WORKERS):
+        ret = {}
+        missing = []
+        for old_id in dict.fromkeys(old_ids):
+            new_id = self.lookup(old_id)
+            if new_id is None:
+                missing.append(old_id)
+            else:
+                ret[old_id] = new_id
+
+        if not missing:
+            return ret
+
+        print("Resolving " + str(len(missing)) + " obsolete finna ids")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._fetch, old_id): old_id for old_id in missing}
+            # database is written only from this thread
+            for future in as_completed(futures):
+                old_id = futures[future]
+                new_id, error, permanent = future.result()
+                ret[old_id] = new_id
+                if new_id != "":
+                    print("new id from finna: " + old_id + " -> " + new_id)
+                    self.store(old_id, new_id)
+                else:
+                    print("could not resolve " + old_id + ": " + error)
+                    if permanent:
+                        self.store(old_id, "", error)
+        return ret
+
+    def stats(self):
+        resolved, failed = self.conn.execute("SELECT COALESCE(SUM(new_id != ''), 0), COALESCE(SUM(new_id = ''), 0) FROM idmap").fetchone()
+        return {'resolved': resolved, 'failed': failed}
+
+# id map shared by the functions below, created on first use
+_idmap = None
+
+def get_idmap():
+    global _idmap
+    if _idmap is None:
+        # html pages are heavier than API requests, see HOST_LIMITS
+        _idmap = FinnaIdMap(rate_limiter=get_limiter('www.finna.fi'))
+    return _idmap
+
+def resolve_finna_id(old_id):
+    return get_idmap().resolve(old_id)
+
+def resolve_finna_ids(old_ids, workers=RESOLVE_WORKERS):
+    return get_idmap().resolve_many(old_ids, workers)
+
+if __name__ == '__main__':
+    idmap = get_idmap()
+    for filename in sys.argv[1:]:
+        with open(filename) as f:
+            old_ids = [line.strip() for line in f if line.strip()]
+        newids = idmap.resolve_many(old_ids)
+        print("Resolved " + str(sum(1 for new_id in newids.values() if new_id)) + " / " + str(len(newids)) + " ids from " + filename)
+    stats = idmap.stats()
+    print("Resolved ids: " + str(stats['resolved']) + ", failed: " + str(stats['failed']))
+    if page_stats['pages']:
+        print("Record pages read: " + str(page_stats['pages']) + ", " + str(page_stats['bytes']) + " bytes")
+    idmap.close()
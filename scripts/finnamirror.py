@@ -0,0 +1,259 @@
+# Local mirror of Finna collections
+#
+# Scripts ask Finna again and again for the same collections. The mirror
+# stores every record of a predefined Finna search in sqlite database so
+# that they can be read by id, subject or collection without paging the
+# live API.
+#
+# Refresh is incremental: all result pages are still read from Finna, but
+# only records whose content hash has changed are written to the database.
+# Records which are not in the search results anymore are removed from the
+# mirror. All result pages are read, and if fewer records than resultCount of
+# the search were received nothing is removed and the refresh fails. Search
+# pages of the refresh are not stored to the Finna response cache, the
+# mirror has them already.
+#
+# find() matches whole subjects (case-insensitive), it is not the Finna
+# full text search: lookfor "professorit" with type Subjects also finds
+# records with subject like "Helsingin yliopiston professorit" or another
+# inflected form of the word, find(subjects=['professorit']) does not.
+#
+## Usage
+# mirror = FinnaMirror()
+# finna_record = mirror.get_record(finnaid)                     # FinnaRecord or None
+# for finna_record in mirror.find(subjects=['professorit'], mirror='kuvasiskot'):
+#     print(finna_record.id)
+#
+## Updating
+# python finnamirror.py kuvasiskot      # refresh one mirror
+# python finnamirror.py --all           # refresh all mirrors
+# python finnamirror.py                 # show mirrors and statistics
+
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+
+from finnaapi import FinnaClient, FinnaError
+from finnarecord import FinnaRecord
+from ratelimit import get_limiter
+
+DEFAULT_MIRROR_PATH = 'finnamirror.db'
+
+# Predefined searches. Filters can be generated using web UI https://finna.fi
+# and then clicking "Finna API" link on bottom of the page.
+MIRRORS = {
+    # same filters as in upload_kuvasiskot.py
+    'kuvasiskot': {
+        'search_type': 'AllFields',
+        'filters': [
+            '~format_ext_str_mv:"0/Image/"',
+            'free_online_boolean:"1"',
+            '~hierarchy_parent_title:"Studio Kuvasiskojen kokoelma"',
+            '~usage_rights_str_mv:"usage_B"',
+        ],
+    },
+    'historian-kuvakokoelma': {
+        'search_type': 'AllFields',
+        'filters': [
+            '~format_ext_str_mv:"0/Image/"',
+            'free_online_boolean:"1"',
+            '~hierarchy_parent_title:"Historian kuvakokoelma"',
+        ],
+    },
+}
+
+# Finna subjects are list of lists of strings (or strings in old records)
+def flatten_subjects(subjects):
+    ret = []
+    for subject in subjects:
+        if isinstance(subject, list):
+            ret.extend(subject)
+        else:
+            ret.append(subject)
+    return ret
+
+# Hash of the record content, key order does not change it
+def record_hash(record):
+    body = json.dumps(record, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+class FinnaMirror:
+    def __init__(self, path=DEFAULT_MIRROR_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS records (
+                             id TEXT PRIMARY KEY,
+                             hash TEXT NOT NULL,
+                             updated REAL NOT NULL,
+                             body TEXT NOT NULL)''')
+        # which mirror contains the record, seen is time of last refresh
+        # where record was in the search results
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS mirror_records (
+                             mirror TEXT NOT NULL,
+                             id TEXT NOT NULL,
+                             seen REAL NOT NULL,
+                             PRIMARY KEY (mirror, id))''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS record_subjects (
+                             id TEXT NOT NULL,
+                             subject TEXT NOT NULL COLLATE NOCASE)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS record_collections (
+                             id TEXT NOT NULL,
+                             collection TEXT NOT NULL COLLATE NOCASE)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS mirrors (
+                             mirror TEXT PRIMARY KEY,
+                             refreshed REAL NOT NULL,
+                             count INTEGER NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS mirror_records_id ON mirror_records (id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS record_subjects_subject ON record_subjects (subject)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS record_subjects_id ON record_subjects (id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS record_collections_collection ON record_collections (collection)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS record_collections_id ON record_collections (id)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # Read all records of the mirror from Finna and store changed ones.
+    # Returns dict with counts of new, changed, unchanged and removed records
+    def refresh(self, name, client=None):
+        search = MIRRORS[name]
+        started = time.time()
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+
+        # mirror must see current data, not cached search pages, and all of
+        # it: records missing from the results are removed below.
+        # Default client has no cache so pages are not written to it.
+        own_client = client is None
+        if own_client:
+            client = FinnaClient(rate_limiter=get_limiter('api.finna.fi'))
+        records = client.iter_search(search_type=search.get('search_type'), filters=search['filters'],
+                                     max_pages=None, refresh=True, complete=True)
+
+        try:
+            self._refresh_records(name, records, counts)
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            if own_client:
+                client.close()
+
+        # records which were not in this refresh have been removed from Finna
+        # or do not match the filters anymore
+        cursor = self.conn.execute('DELETE FROM mirror_records WHERE mirror = ? AND seen < ?', (name, started))
+        counts['removed'] = cursor.rowcount
+        self._delete_orphans()
+
+        count = self.conn.execute('SELECT COUNT(*) FROM mirror_records WHERE mirror = ?', (name,)).fetchone()[0]
+        self.conn.execute('INSERT OR REPLACE INTO mirrors (mirror, refreshed, count) VALUES (?, ?, ?)', (name, time.time(), count))
+        self.conn.commit()
+        return counts
+
+    def _refresh_records(self, name, records, counts):
+        for finna_record in records:
+            record = finna_record.raw
+            id = record['id']
+            hash = record_hash(record)
+
+            row = self.conn.execute('SELECT hash FROM records WHERE id = ?', (id,)).fetchone()
+            if row is None:
+                counts['new'] += 1
+                self._store(id, hash, record)
+            elif row[0] != hash:
+                counts['changed'] += 1
+                self._store(id, hash, record)
+            else:
+                counts['unchanged'] += 1
+
+            self.conn.execute('INSERT OR REPLACE INTO mirror_records (mirror, id, seen) VALUES (?, ?, ?)', (name, id, time.time()))
+
+    def _store(self, id, hash, record):
+        self.conn.execute('INSERT OR REPLACE INTO records (id, hash, updated, body) VALUES (?, ?, ?, ?)',
+                          (id, hash, time.time(), json.dumps(record, ensure_ascii=False)))
+        self.conn.execute('DELETE FROM record_subjects WHERE id = ?', (id,))
+        self.conn.execute('DELETE FROM record_collections WHERE id = ?', (id,))
+        self.conn.executemany('INSERT INTO record_subjects (id, subject) VALUES (?, ?)',
+                              [(id, subject) for subject in set(flatten_subjects(record.get('subjects', [])))])
+        self.conn.executemany('INSERT INTO record_collections (id, collection) VALUES (?, ?)',
+                              [(id, collection) for collection in set(record.get('collections', []))])
+
+    def _delete_orphans(self):
+        orphans = 'SELECT id FROM records WHERE id NOT IN (SELECT id FROM mirror_records)'
+        self.conn.execute('DELETE FROM record_subjects WHERE id IN (' + orphans + ')')
+        self.conn.execute('DELETE FROM record_collections WHERE id IN (' + orphans + ')')
+        self.conn.execute('DELETE FROM records WHERE id NOT IN (SELECT id FROM mirror_records)')
+
+    # time of last refresh or None if mirror has not been loaded
+    def refreshed(self, name):
+        row = self.conn.execute('SELECT refreshed FROM mirrors WHERE mirror = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_record(self, id):
+        row = self.conn.execute('SELECT body FROM records WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            return None
+        return FinnaRecord(json.loads(row[0]))
+
+    # Returns dict id -> FinnaRecord of ids found in the mirror
+    def get_records(self, ids):
+        ret = {}
+        ids = list(ids)
+        # stay under sqlite variable limit
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            query = 'SELECT id, body FROM records WHERE id IN (' + ','.join('?' * len(chunk)) + ')'
+            for id, body in self.conn.execute(query, chunk):
+                ret[id] = FinnaRecord(json.loads(body))
+        return ret
+
+    # Records which have all given subjects and collections (case-insensitive,
+    # whole subject), optionally only from one mirror. See the note on
+    # subject search at the top.
+    def find(self, subjects=(), collections=(), mirror=None):
+        query = 'SELECT body FROM records r WHERE 1'
+        params = []
+        for subject in subjects:
+            query += ' AND EXISTS (SELECT 1 FROM record_subjects s WHERE s.id = r.id AND s.subject = ?)'
+            params.append(subject)
+        for collection in collections:
+            query += ' AND EXISTS (SELECT 1 FROM record_collections c WHERE c.id = r.id AND c.collection = ?)'
+            params.append(collection)
+        if mirror is not None:
+            query += ' AND EXISTS (SELECT 1 FROM mirror_records m WHERE m.id = r.id AND m.mirror = ?)'
+            params.append(mirror)
+
+        for body, in self.conn.execute(query, params):
+            yield FinnaRecord(json.loads(body))
+
+    def stats(self):
+        ret = {}
+        for name, refreshed, count in self.conn.execute('SELECT mirror, refreshed, count FROM mirrors ORDER BY mirror'):
+            ret[name] = {'refreshed': refreshed, 'count': count}
+        return ret
+
+if __name__ == '__main__':
+    mirror = FinnaMirror()
+    names = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if '--all' in sys.argv:
+        names = list(MIRRORS)
+
+    for name in names:
+        if name not in MIRRORS:
+            print("Unknown mirror: " + name + ", known mirrors: " + ", ".join(MIRRORS))
+            exit(1)
+        print("Refreshing " + name)
+        try:
+            counts = mirror.refresh(name)
+        except FinnaError as e:
+            print(e)
+            exit(1)
+        print("new: " + str(counts['new']) + ", changed: " + str(counts['changed']) +
+              ", unchanged: " + str(counts['unchanged']) + ", removed: " + str(counts['removed']))
+
+    for name, stats in mirror.stats().items():
+        print(name + ": " + str(stats['count']) + " records, refreshed " + time.strftime('%Y-%m-%d %H:%M', time.localtime(stats['refreshed'])))
+    mirror.close()
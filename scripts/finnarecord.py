@@ -0,0 +1,193 @@
+# Compact model for records returned by the Finna API
+#
+# FinnaRecord wraps the record dict from the API. Nested structures like
+# imagesExtended are turned into FinnaImage objects only when they are
+# accessed, so records which are skipped early (wrong collection,
+# copyright..) don't pay for it. Both classes use __slots__ to keep large
+# record lists small in memory.
+#
+# Field profiles list the fields each script actually reads so that the
+# API does not need to send everything (subjectsExtendet,
+# physicalDescriptions etc. are large).
+#
+## Usage
+# finna_records, finna_statuses = get_finna_records(finnaids, fields='sdc')
+# finna_record = finna_records[finnaid]
+# print(finna_record.copyright)
+# print(finna_record.images[0].large_url)
+
+FINNA_URL = "https://finna.fi"
+
+FIELD_PROFILES = {
+    # setcommonssdc.py
+    'sdc': [
+        'id',
+        'collections',
+        'images',
+        'imagesExtended',
+    ],
+    # update_kuvasiskot.py
+    'hires-update': [
+        'id',
+        'collections',
+        'images',
+        'imagesExtended',
+    ],
+    # upload_kuvasiskot.py
+    'upload': [
+        'id',
+        'title',
+        'shortTitle',
+        'imageRights',
+        'imagesExtended',
+        'collections',
+        'institutions',
+        'identifierString',
+        'subjects',
+        'subjectPlaces',
+        'subjectActors',
+        'events',
+        'measurements',
+        'year',
+        'nonPresenterAuthors',
+    ],
+    # add_person_subjects.py
+    'person-subjects': [
+        'id',
+        'title',
+        'summary',
+        'subjectActors',
+        'imagesExtended',
+    ],
+}
+
+# one image in imagesExtended
+class FinnaImage:
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def _url(self, size):
+        urls = self._data.get('urls', {})
+        if size not in urls:
+            return None
+        return FINNA_URL + urls[size]
+
+    @property
+    def small_url(self):
+        return self._url('small')
+
+    @property
+    def medium_url(self):
+        return self._url('medium')
+
+    @property
+    def large_url(self):
+        return self._url('large')
+
+    @property
+    def copyright(self):
+        return self._data.get('rights', {}).get('copyright')
+
+    @property
+    def rights_description(self):
+        description = self._data.get('rights', {}).get('description')
+        if not description:
+            return None
+        return description[0]
+
+    # first 'original' entry of highResolution (dict with url, format and
+    # data) or None. Note: url may point to different server than other urls
+    @property
+    def original(self):
+        originals = self._data.get('highResolution', {}).get('original')
+        if not originals:
+            return None
+        return originals[0]
+
+class FinnaRecord:
+    __slots__ = ('_data', '_images')
+
+    def __init__(self, data):
+        self._data = data
+        self._images = None
+
+    def __repr__(self):
+        return 'FinnaRecord(' + repr(self._data.get('id')) + ')'
+
+    # dict-like access to the raw fields still works
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    @property
+    def raw(self):
+        return self._data
+
+    @property
+    def id(self):
+        return self._data.get('id')
+
+    @property
+    def title(self):
+        return self._data.get('title')
+
+    @property
+    def short_title(self):
+        return self._data.get('shortTitle')
+
+    @property
+    def summary(self):
+        return self._data.get('summary')
+
+    @property
+    def collections(self):
+        return self._data.get('collections', [])
+
+    @property
+    def subject_actors(self):
+        return self._data.get('subjectActors', [])
+
+    @property
+    def subject_places(self):
+        return self._data.get('subjectPlaces', [])
+
+    # urls in 'images' field, relative to finna.fi
+    @property
+    def image_urls(self):
+        return self._data.get('images', [])
+
+    # imagesExtended as FinnaImage objects, created on first access
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = [FinnaImage(image) for image in self._data.get('imagesExtended', [])]
+        return self._images
+
+    # license of the record: imageRights or rights of the first image
+    @property
+    def copyright(self):
+        if 'imageRights' in self._data:
+            return self._data['imageRights'].get('copyright')
+        if self.images:
+            return self.images[0].copyright
+        return None
+
+    @property
+    def record_url(self):
+        return FINNA_URL + "/Record/" + self.id
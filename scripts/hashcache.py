@@ -0,0 +1,154 @@
+# Per-image hash cache
+#
+# phash and dhash of each downloaded image are stored by url and hash
+# size, so every image is downloaded and hashed only once. Distance of any
+# pair of images is calculated from the stored hashes, comparing N commons
+# files with M finna images needs N + M downloads instead of N * M.
+#
+# ETag and sha1 of the downloaded file are stored with the hashes. With
+# revalidate=True cached url is checked with If-None-Match and hashed again
+# only if the file has changed. Files with same sha1 (same image behind
+# different urls) are not hashed again.
+#
+# Recently downloaded images are kept in memory so that one image can be
+# hashed with another hash size without downloading it again. Images are
+# opened with openhashimage(), large files are not decoded at full size.
+#
+## Usage
+# from hashcache import HashCache
+#
+# cache = HashCache()
+# phash_diff, dhash_diff = cache.distance(finna_url, commons_url)
+# fingerprint = cache.fingerprint(url, hash_size=24)
+
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from cachedb import CacheDB
+from fingerprint import ImageFingerprint
+from imagematch import downloadimagedata, openhashimage
+
+DEFAULT_HASHCACHE_PATH = 'musketti.db'
+
+# images kept in memory
+RECENT_IMAGES = 8
+
+# schema versions, see cachedb.py
+MIGRATIONS = [
+    # 1: hashes by url and hash size
+    [
+        '''CREATE TABLE IF NOT EXISTS image_hashes (
+           url TEXT NOT NULL,
+           hash_size INTEGER NOT NULL,
+           phash TEXT NOT NULL,
+           dhash TEXT NOT NULL,
+           etag TEXT,
+           sha1 TEXT,
+           updated INTEGER NOT NULL,
+           PRIMARY KEY (url, hash_size))''',
+        'CREATE INDEX IF NOT EXISTS image_hashes_sha1 ON image_hashes (sha1, hash_size)',
+    ],
+    # 2: pairwise distances of add_person_subjects.py are not used anymore
+    [
+        'DROP TABLE IF EXISTS urls',
+    ],
+    # 3: images are opened with openhashimage() at reduced resolution, hashes
+    # of earlier full size decodes differ by a few bits and can't be mixed
+    [
+        'DELETE FROM image_hashes',
+    ],
+]
+
+class HashCache:
+    def __init__(self, path=DEFAULT_HASHCACHE_PATH):
+        self.path = path
+        self.db = CacheDB(path, MIGRATIONS)
+        # url -> (image, etag, sha1)
+        self.images = OrderedDict()
+        self.images_lock = threading.Lock()
+        # (url, hash_size) -> fingerprint stored in this run, the rows may
+        # still be in the write queue of the database
+        self.stored = {}
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def close(self):
+        self.db.close()
+
+    # Returns cached ImageFingerprint or None
+    def get(self, url, hash_size=8):
+        if (url, hash_size) in self.stored:
+            return self.stored[(url, hash_size)]
+        row = self.db.fetchone('SELECT phash, dhash FROM image_hashes WHERE url = ? AND hash_size = ?', (url, hash_size))
+        if row is None:
+            return None
+        return ImageFingerprint(int(row[0], 16), int(row[1], 16), hash_size)
+
+    def store(self, url, fingerprint, etag=None, sha1=None):
+        self.db.write('''INSERT OR REPLACE INTO image_hashes (url, hash_size, phash, dhash, etag, sha1, updated)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                      (url, fingerprint.hash_size, fingerprint.phash_hex, fingerprint.dhash_hex, etag, sha1, int(time.time())))
+        self.stored[(url, fingerprint.hash_size)] = fingerprint
+
+    def _get_by_sha1(self, sha1, hash_size):
+        row = self.db.fetchone('SELECT phash, dhash FROM image_hashes WHERE sha1 = ? AND hash_size = ? LIMIT 1', (sha1, hash_size))
+        if row is None:
+            return None
+        return ImageFingerprint(int(row[0], 16), int(row[1], 16), hash_size)
+
+    # Returns tuple (image, etag, sha1), image is None if etag was given
+    # and file has not changed
+    def _download(self, url, etag=None):
+        with self.images_lock:
+            if url in self.images:
+                self.images.move_to_end(url)
+                return self.images[url]
+        content, headers = downloadimagedata(url, etag)
+        if content is None:
+            return None, etag, None
+        sha1 = hashlib.sha1(content).hexdigest()
+        entry = (openhashimage(content), headers.get('ETag'), sha1)
+        with self.images_lock:
+            self.images[url] = entry
+            while len(self.images) > RECENT_IMAGES:
+                self.images.popitem(last=False)
+        return entry
+
+    # Fingerprint of image in url, downloaded and hashed if not in cache
+    def fingerprint(self, url, hash_size=8, revalidate=False):
+        if (url, hash_size) in self.stored:
+            self.stats['hits'] += 1
+            return self.stored[(url, hash_size)]
+        row = self.db.fetchone('SELECT phash, dhash, etag FROM image_hashes WHERE url = ? AND hash_size = ?', (url, hash_size))
+        if row is not None and not (revalidate and row[2]):
+            self.stats['hits'] += 1
+            return ImageFingerprint(int(row[0], 16), int(row[1], 16), hash_size)
+
+        image, etag, sha1 = self._download(url, row[2] if row is not None else None)
+        if image is None:
+            # not modified
+            self.stats['hits'] += 1
+            return ImageFingerprint(int(row[0], 16), int(row[1], 16), hash_size)
+
+        self.stats['misses'] += 1
+        fingerprint = self._get_by_sha1(sha1, hash_size)
+        if fingerprint is None:
+            fingerprint = ImageFingerprint.from_image(image, hash_size)
+        self.store(url, fingerprint, etag, sha1)
+        return fingerprint
+
+    # Returns tuple (phash distance, dhash distance)
+    def distance(self, url1, url2, hash_size=8):
+        return self.fingerprint(url1, hash_size).distance(self.fingerprint(url2, hash_size))
+
+    def count(self):
+        self.db.commit()
+        return self.db.fetchone('SELECT COUNT(*) FROM image_hashes')[0]
+
+if __name__ == '__main__':
+    cache = HashCache(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_HASHCACHE_PATH)
+    for hash_size, count in cache.db.fetchall('SELECT hash_size, COUNT(*) FROM image_hashes GROUP BY hash_size'):
+        print("Hash size " + str(hash_size) + ": " + str(count) + " images")
+    cache.close()
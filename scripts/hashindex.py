@@ -0,0 +1,232 @@
+# Local index of Commons image hashes for duplicate checks
+#
+# phash and dhash of known Commons files are stored in sqlite database and
+# loaded to a BK-tree in memory, so that images can be checked against
+# all of them without a query to imagehash.toolforge.org for each image.
+#
+# BK-tree is keyed by phash. Search walks only the subtrees which can have
+# phash within the largest phash distance of the policy, dhash is checked
+# for the found entries. With SAME_IMAGE_POLICY radius is 3 bits which
+# visits only a small part of the tree.
+#
+# Index is filled from Commons categories and lists of file pages,
+# upload_kuvasiskot.py adds the files it uploads.
+#
+## Usage
+# from hashindex import HashIndex
+#
+# index = HashIndex()
+# for title, phash_diff, dhash_diff in index.search(fingerprint):
+#     print("duplicate: " + title)
+#
+## Filling the index
+# python hashindex.py Category:Kuvasiskot          # files in category and subcategories
+# python hashindex.py -file:titles.txt              # file page titles one per line
+# python hashindex.py                               # show statistics
+
+import sys
+import threading
+import time
+
+import pywikibot
+
+from cachedb import CacheDB
+from fingerprint import ImageFingerprint, SAME_IMAGE_POLICY
+from imagematch import downloadhashimage
+
+DEFAULT_HASHINDEX_PATH = 'hashindex.db'
+
+# commons files are hashed using thumbnails of this width
+INDEX_THUMBNAIL_WIDTH = 500
+
+# schema versions, see cachedb.py
+MIGRATIONS = [
+    # 1: hashes as hex strings, sqlite integers are signed 64-bit
+    [
+        '''CREATE TABLE IF NOT EXISTS commons_hashes (
+           title TEXT PRIMARY KEY,
+           phash TEXT NOT NULL,
+           dhash TEXT NOT NULL,
+           updated INTEGER NOT NULL)''',
+    ],
+    # 2: thumbnails are opened with openhashimage() at reduced resolution,
+    # hashes of earlier full size decodes differ by a few bits and can't be
+    # mixed. Index has to be filled again.
+    [
+        'DELETE FROM commons_hashes',
+    ],
+]
+
+# progress is printed after this many files
+PROGRESS_INTERVAL = 100
+
+class BKTree:
+    # node is list [key, values, children], children is dict distance -> node
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, [value], {}]
+            return
+        node = self.root
+        while True:
+            distance = (node[0] ^ key).bit_count()
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    # Returns list of (distance, key, value) with distance <= radius
+    def search(self, key, radius):
+        ret = []
+        if self.root is None:
+            return ret
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = (node[0] ^ key).bit_count()
+            if distance <= radius:
+                for value in node[1]:
+                    ret.append((distance, node[0], value))
+            # triangle inequality: only children in [distance - radius, distance + radius]
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return ret
+
+class HashIndex:
+    def __init__(self, path=DEFAULT_HASHINDEX_PATH):
+        self.path = path
+        self.db = CacheDB(path, MIGRATIONS)
+        # tree is shared by threads
+        self.lock = threading.Lock()
+        self.tree = None
+        # title -> (phash, dhash) of entries in the tree
+        self.current = {}
+
+    def close(self):
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def __len__(self):
+        self.db.commit()
+        return self.db.fetchone('SELECT COUNT(*) FROM commons_hashes')[0]
+
+    def __contains__(self, title):
+        return self.db.fetchone('SELECT 1 FROM commons_hashes WHERE title = ?', (title,)) is not None
+
+    # tree is built on first search, called with lock held
+    def _load(self):
+        if self.tree is None:
+            # entries added before the first search are in the queue
+            self.db.commit()
+            self.tree = BKTree()
+            for title, phash, dhash in self.db.fetchall('SELECT title, phash, dhash FROM commons_hashes'):
+                self.current[title] = (int(phash, 16), int(dhash, 16))
+                self.tree.add(int(phash, 16), (int(dhash, 16), title))
+        return self.tree
+
+    def add(self, title, fingerprint):
+        if fingerprint.hash_size != 8:
+            raise ValueError("Only 64-bit hashes are indexed")
+        self.db.write('INSERT OR REPLACE INTO commons_hashes (title, phash, dhash, updated) VALUES (?, ?, ?, ?)',
+                      (title, fingerprint.phash_hex, fingerprint.dhash_hex, int(time.time())))
+        # replaced entries stay in the tree, search skips them
+        with self.lock:
+            if self.tree is not None and self.current.get(title) != (fingerprint.phash, fingerprint.dhash):
+                self.current[title] = (fingerprint.phash, fingerprint.dhash)
+                self.tree.add(fingerprint.phash, (fingerprint.dhash, title))
+
+    # Returns list of (title, phash distance, dhash distance) of matching
+    # files, closest first
+    def search(self, fingerprint, policy=SAME_IMAGE_POLICY):
+        radius = max(max_phash for max_phash, max_dhash in policy.rules)
+        ret = []
+        with self.lock:
+            for phash_diff, phash, (dhash, title) in self._load().search(fingerprint.phash, radius):
+                if self.current[title] != (phash, dhash):
+                    continue
+                dhash_diff = (dhash ^ fingerprint.dhash).bit_count()
+                if policy.is_match(phash_diff, dhash_diff):
+                    ret.append((title, phash_diff, dhash_diff))
+        return sorted(ret, key=lambda x: x[1] + x[2])
+
+    # Hash thumbnail of commons file page and add it to the index.
+    # Returns the fingerprint or None if file is not an image
+    def add_filepage(self, filepage, width=INDEX_THUMBNAIL_WIDTH):
+        file_info = filepage.latest_file_info
+        if not file_info.width:
+            return None
+        if file_info.width > width:
+            url = filepage.get_file_url(url_width=width)
+        else:
+            url = filepage.get_file_url()
+        fingerprint = ImageFingerprint.from_image(downloadhashimage(url))
+        self.add(filepage.title(), fingerprint)
+        return fingerprint
+
+    # Add file pages which are not in the index yet. Returns number of
+    # hashed files
+    def add_filepages(self, filepages, refresh=False):
+        count = 0
+        for filepage in filepages:
+            if not refresh and filepage.title() in self:
+                continue
+            try:
+                if self.add_filepage(filepage) is None:
+                    continue
+            except Exception as e:
+                print("Could not hash " + filepage.title() + ": " + str(e))
+                continue
+            count += 1
+            if count % PROGRESS_INTERVAL == 0:
+                print("Hashed " + str(count) + " files")
+        self.commit()
+        return count
+
+    def stats(self):
+        self.db.commit()
+        count, updated = self.db.fetchone('SELECT COUNT(*), MAX(updated) FROM commons_hashes')
+        return {'files': count, 'updated': updated}
+
+# pywikibot.FilePage objects of files in category and its subcategories
+def get_category_filepages(site, category_name):
+    category = pywikibot.Category(site, category_name)
+    for page in category.articles(recurse=True, namespaces=[6]):
+        yield pywikibot.FilePage(page)
+
+def get_list_filepages(site, filename):
+    with open(filename) as f:
+        for line in f:
+            title = line.strip()
+            if title:
+                yield pywikibot.FilePage(site, title)
+
+if __name__ == '__main__':
+    index = HashIndex()
+    site = pywikibot.Site("commons", "commons")
+    for arg in sys.argv[1:]:
+        if arg.startswith('-file:'):
+            filepages = get_list_filepages(site, arg[len('-file:'):])
+        else:
+            filepages = get_category_filepages(site, arg)
+        count = index.add_filepages(filepages)
+        print(arg + ": hashed " + str(count) + " files")
+
+    stats = index.stats()
+    print("Files in index: " + str(stats['files']))
+    if stats['updated']:
+        print("Last updated: " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats['updated'])))
+    index.close()
@@ -0,0 +1,156 @@
+# Fingerprinting pipeline for whole collections
+#
+# Downloads are I/O bound and run in a thread pool, decoding and hashing
+# are CPU bound and run in a process pool so that all cores are used.
+# Stages are connected with bounded queues: when hashing can't keep up
+# downloads wait, and when downloads are slow hashing waits, so memory use
+# stays constant regardless of size of the collection.
+#
+#   items -> download threads -> queue -> batches -> hash processes -> results
+#
+# Results are yielded as soon as batches are ready, not in input order,
+# so they can be written to a file or an index incrementally.
+#
+# key can be any picklable value, it is passed through the worker process
+# and returned with the result (for example the record the url is from).
+#
+## Usage
+# from hashpipeline import fingerprint_urls
+#
+# items = ((record.id, record.images[0].small_url) for record in records)
+# for key, fingerprint, error in fingerprint_urls(items):
+#     if fingerprint is not None:
+#         print(key, fingerprint.phash_hex, fingerprint.dhash_hex)
+#
+# Scripts using this must have the usual if __name__ == '__main__': guard
+# since the worker processes may import the main module.
+
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from batchhash import hash_images, hash_to_int
+from fingerprint import ImageFingerprint
+from imagematch import downloadimagedata, openhashimage
+
+DOWNLOAD_WORKERS = 8
+HASH_BATCH_SIZE = 100
+
+# end of downloads
+_DONE = object()
+
+# Run in worker process. Returns list of (key, phash, dhash, error)
+def hash_contents(batch, hash_size=8):
+    ret = []
+    images = []
+    keys = []
+    for key, content in batch:
+        try:
+            image = openhashimage(content)
+            image.load()
+        except Exception as e:
+            ret.append((key, None, None, str(e)))
+            continue
+        images.append(image)
+        keys.append(key)
+    if images:
+        phashes, dhashes = hash_images(images, hash_size)
+        for i, key in enumerate(keys):
+            ret.append((key, hash_to_int(phashes[i]), hash_to_int(dhashes[i]), None))
+    return ret
+
+def _download(key, url):
+    try:
+        content, headers = downloadimagedata(url)
+        return key, content, None
+    except Exception as e:
+        return key, None, str(e)
+
+# Generator of (key, ImageFingerprint or None, error message or None) for
+# (key, url) items
+def fingerprint_urls(items, hash_size=8, download_workers=DOWNLOAD_WORKERS, hash_workers=None, batch_size=HASH_BATCH_SIZE):
+    if hash_workers is None:
+        hash_workers = os.cpu_count() or 1
+    downloaded = queue.Queue(maxsize=batch_size * 2)
+    stop = threading.Event()
+    errors = []
+
+    def produce():
+        # at most this many downloads are waiting for the queue
+        slots = threading.BoundedSemaphore(download_workers * 2)
+
+        def finished(future):
+            downloaded.put(future.result())
+            slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=download_workers) as downloads:
+                for key, url in items:
+                    slots.acquire()
+                    if stop.is_set():
+                        break
+                    downloads.submit(_download, key, url).add_done_callback(finished)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            downloaded.put(_DONE)
+
+    def results(futures):
+        for future in futures:
+            for key, phash, dhash, error in future.result():
+                if error is None:
+                    yield key, ImageFingerprint(phash, dhash, hash_size), None
+                else:
+                    yield key, None, error
+
+    with ProcessPoolExecutor(max_workers=hash_workers) as processes:
+        # worker processes are started before the download threads,
+        # forking a process with running threads is not safe
+        processes.submit(int).result()
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        pending = set()
+        batch = []
+        done = False
+        try:
+            while not done or batch:
+                item = downloaded.get()
+                if item is _DONE:
+                    done = True
+                else:
+                    key, content, error = item
+                    if content is None:
+                        yield key, None, error
+                    else:
+                        batch.append((key, content))
+
+                if batch and (len(batch) >= batch_size or done):
+                    # at most two batches per process waiting
+                    while len(pending) >= hash_workers * 2:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        yield from results(finished)
+                    pending.add(processes.submit(hash_contents, batch, hash_size))
+                    batch = []
+
+                finished = {future for future in pending if future.done()}
+                pending -= finished
+                yield from results(finished)
+
+            finished, pending = wait(pending)
+            yield from results(finished)
+        finally:
+            # generator closed early: stop downloading and let the
+            # download threads finish
+            stop.set()
+            while producer.is_alive():
+                try:
+                    downloaded.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            for future in pending:
+                future.cancel()
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,265 @@
+# Image comparison shared by the Finna scripts
+#
+# Images are compared using similarity hashing: images are converted to
+# 64bit integers and the hamming distance between them is calculated.
+# Limits for same image are in SAME_IMAGE_POLICY (fingerprint.py).
+#
+# Perceptual hashing
+# http://www.hackerfactor.com/blog/index.php?/archives/432-Looks-Like-It.html
+# difference hashing
+# http://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
+#
+# Commons files are compared using a thumbnail of the same width as the
+# Finna image instead of the original, which is often a large tiff. Only
+# if the distance is near the limit the original is downloaded and
+# compared again.
+#
+## Usage
+# commons_image = CommonsImage(filepage)
+# finna_image = downloadimage(finna_record.images[0].large_url)
+# if commons_image.matches(finna_image):
+#     print("same image")
+#
+# # record with many images: best match of all of them
+# try:
+#     match = match_candidates(commons_image, candidate_urls)
+# except CandidateDownloadError:
+#     match = None    # not known, try again later
+# if match is not None:
+#     index, finna_image, phash_diff, dhash_diff = match
+
+import hashlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+
+from fingerprint import ImageFingerprint, FingerprintArray, SAME_IMAGE_POLICY
+from ratelimit import limit
+
+# parallel downloads of candidate images of one record
+CANDIDATE_WORKERS = 4
+
+# smallest side of images opened with openhashimage()
+HASH_DECODE_SIZE = 512
+
+# (connect timeout, read timeout) in seconds, read timeout is for each
+# read so large files are not cut off
+DOWNLOAD_TIMEOUT = (10, 60)
+
+# files and bytes downloaded by downloadimage()
+download_stats = {'files': 0, 'bytes': 0}
+download_stats_lock = threading.Lock()
+
+# note: commons at least once has thrown error due to client policy?
+# "Client Error: Forbidden. Please comply with the User-Agent policy"
+# keep an eye out for problems..
+#
+# Returns tuple (content, response headers), content is None if etag
+# is given and the file has not changed
+def downloadimagedata(url, etag=None):
+    headers={'User-Agent': 'pywikibot'}
+    if etag:
+        headers['If-None-Match'] = etag
+    # Image.open(urllib.request.urlopen(url, headers=headers))
+
+    limit(url)
+    response = requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    if response.status_code == 304:
+        return None, response.headers
+
+    content = response.content
+    with download_stats_lock:
+        download_stats['files'] += 1
+        download_stats['bytes'] += len(content)
+    return content, response.headers
+
+# Stream download to file without keeping it in memory, SHA-1 of the
+# bytes is calculated at the same time (see commonssha1.py).
+# Returns hex digest
+def downloadimagefile(url, path, chunk_size=1024*1024):
+    headers={'User-Agent': 'pywikibot'}
+
+    limit(url)
+    size = 0
+    sha1 = hashlib.sha1()
+    with requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                sha1.update(chunk)
+                size += len(chunk)
+    with download_stats_lock:
+        download_stats['files'] += 1
+        download_stats['bytes'] += size
+    return sha1.hexdigest()
+
+def downloadimage(url):
+    content, headers = downloadimagedata(url)
+    return Image.open(io.BytesIO(content))
+
+# Open image only for hashing: grayscale and not much larger than
+# HASH_DECODE_SIZE. Hashes are not always bit-identical with hashes of the
+# full image but differ at most by a couple of bits.
+# - JPEG is decoded with DCT scaling (draft mode) straight to grayscale
+#   at 1/2, 1/4 or 1/8 size
+# - multi-page (pyramidal) TIFF: smallest page which is still large enough
+# - others are decoded fully and reduced with box filter to at least twice
+#   HASH_DECODE_SIZE, box filter is not as close to LANCZOS as DCT scaling
+#
+# content is bytes or file name.
+# Image width is not the original width, don't use for thumbnail sizes.
+def openhashimage(content, size=HASH_DECODE_SIZE):
+    if isinstance(content, bytes):
+        content = io.BytesIO(content)
+    image = Image.open(content)
+    if image.format == 'JPEG':
+        image.draft('L', (size, size))
+    elif image.format == 'TIFF' and getattr(image, 'n_frames', 1) > 1:
+        best = 0
+        best_pixels = image.size[0] * image.size[1]
+        for frame in range(1, image.n_frames):
+            image.seek(frame)
+            pixels = image.size[0] * image.size[1]
+            if min(image.size) >= size and pixels < best_pixels:
+                best, best_pixels = frame, pixels
+        image.seek(best)
+
+    jpeg = image.format == 'JPEG'
+    image = image.convert('L')
+    factor = min(image.size) // size
+    if not jpeg:
+        factor = factor // 2
+    if factor > 1:
+        image = image.reduce(factor)
+    return image
+
+def downloadhashimage(url, size=HASH_DECODE_SIZE):
+    content, headers = downloadimagedata(url)
+    return openhashimage(content, size)
+
+def print_download_stats():
+    print("Images downloaded: " + str(download_stats['files']) + ", " + str(download_stats['bytes']) + " bytes")
+
+# Returns tuple (phash distance, dhash distance)
+def image_distances(img1, img2, hashlen=8):
+    # both images are hashed with one call
+    fingerprint1, fingerprint2 = ImageFingerprint.from_images([img1, img2], hashlen)
+
+    # Hamming distance difference
+    phash_diff, dhash_diff = fingerprint1.distance(fingerprint2)
+
+    # print hamming distance
+    if (phash_diff == 0 and dhash_diff == 0):
+        print("Both hashes are equal")
+    else:
+        print("Phash diff: " + str(phash_diff) + ", image1: " + fingerprint1.phash_hex + ", image2: " + fingerprint2.phash_hex)
+        print("Dhash diff: " + str(dhash_diff) + ", image1: " + fingerprint1.dhash_hex + ", image2: " + fingerprint2.dhash_hex)
+
+    return phash_diff, dhash_diff
+
+# Compares if the image is same using similarity hashing
+def is_same_image(img1, img2, hashlen=8, policy=SAME_IMAGE_POLICY):
+    phash_diff, dhash_diff = image_distances(img1, img2, hashlen)
+    return policy.is_match(phash_diff, dhash_diff)
+
+# Image of a commons file page for comparisons. Thumbnails are downloaded
+# once per width and the original only when it is needed.
+class CommonsImage:
+    def __init__(self, filepage):
+        self.filepage = filepage
+        self.file_info = filepage.latest_file_info
+        # width -> image, None is the original
+        self.images = {}
+
+    # Image scaled to width, original if it is not larger than width
+    def get(self, width=None):
+        if width is not None and width >= self.file_info.width:
+            width = None
+        if width not in self.images:
+            if width is None:
+                url = self.filepage.get_file_url()
+            else:
+                url = self.filepage.get_file_url(url_width=width)
+            self.images[width] = downloadimage(url)
+        return self.images[width]
+
+    def original(self):
+        return self.get(None)
+
+    # Compare to thumbnail of same width as image, borderline cases are
+    # checked again using the original file
+    def matches(self, image, hashlen=8, policy=SAME_IMAGE_POLICY):
+        thumbnail = self.get(image.width)
+        phash_diff, dhash_diff = image_distances(image, thumbnail, hashlen)
+        if policy.is_match(phash_diff, dhash_diff):
+            return True
+
+        # thumbnail was used
+        if image.width < self.file_info.width and policy.is_borderline(phash_diff, dhash_diff):
+            print("Borderline distance with thumbnail, comparing to original")
+            return is_same_image(image, self.original(), hashlen, policy)
+        return False
+
+# no candidate matched, but some of them could not be downloaded so the
+# right one might be among them
+class CandidateDownloadError(Exception):
+    pass
+
+def _downloadcandidate(url):
+    try:
+        return downloadimage(url)
+    except (requests.exceptions.RequestException, OSError) as e:
+        print("Could not load candidate image " + url + ": " + str(e))
+        return None
+
+# Download and hash all candidate images concurrently and compare them to
+# the commons image. Best match (smallest phash + dhash distance) is
+# returned instead of the first one under the limit.
+#
+# Returns tuple (index, image, phash distance, dhash distance) or None if
+# no candidate matches. Raises CandidateDownloadError if there is no match
+# and some candidates failed to download.
+def match_candidates(commons_image, urls, hashlen=8, policy=SAME_IMAGE_POLICY, workers=CANDIDATE_WORKERS):
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(urls)))) as executor:
+        images = list(executor.map(_downloadcandidate, urls))
+
+    indexes = [i for i in range(len(urls)) if images[i] is not None]
+    if not indexes:
+        raise CandidateDownloadError("none of " + str(len(urls)) + " candidates could be downloaded")
+    candidates = FingerprintArray.from_images([images[i] for i in indexes], hashlen)
+
+    # thumbnail of commons image for each candidate width (usually just one)
+    phash_diffs = [0] * len(indexes)
+    dhash_diffs = [0] * len(indexes)
+    for width in set(images[i].width for i in indexes):
+        commons_fingerprint = ImageFingerprint.from_image(commons_image.get(width), hashlen)
+        width_phash_diffs, width_dhash_diffs = candidates.distances(commons_fingerprint)
+        for k, i in enumerate(indexes):
+            if images[i].width == width:
+                phash_diffs[k] = int(width_phash_diffs[k])
+                dhash_diffs[k] = int(width_dhash_diffs[k])
+
+    # borderline candidates compared thumbnail is checked against the original
+    original_fingerprint = None
+    for k, i in enumerate(indexes):
+        if images[i].width < commons_image.file_info.width and policy.is_borderline(phash_diffs[k], dhash_diffs[k]):
+            if original_fingerprint is None:
+                print("Borderline distance with thumbnail, comparing to original")
+                original_fingerprint = ImageFingerprint.from_image(commons_image.original(), hashlen)
+            phash_diffs[k], dhash_diffs[k] = candidates[k].distance(original_fingerprint)
+
+    best = None
+    for k, i in enumerate(indexes):
+        print("Candidate " + str(i) + ": phash diff " + str(phash_diffs[k]) + ", dhash diff " + str(dhash_diffs[k]))
+        if not policy.is_match(phash_diffs[k], dhash_diffs[k]):
+            continue
+        if best is None or phash_diffs[k] + dhash_diffs[k] < best[2] + best[3]:
+            best = (i, images[i], phash_diffs[k], dhash_diffs[k])
+    if best is None and len(indexes) < len(urls):
+        raise CandidateDownloadError(str(len(urls) - len(indexes)) + " of " + str(len(urls)) + " candidates could not be downloaded")
+    return best
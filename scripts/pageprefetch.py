@@ -0,0 +1,215 @@
+# Bulk prefetch of Commons page metadata
+#
+# File-list loops read page.text, isRedirectPage(), latest_file_info,
+# extlinks() and data_item() of every file, each of them is a separate API
+# request in pywikibot. prefetch_pages() wraps a page list or generator
+# (commonspages.iter_linked_pages, iter_category_pages) and loads all of
+# these for a batch of titles with one query (continued if needed):
+# prop=info|revisions|imageinfo|extlinks with content of all slots, so
+# MediaInfo comes from the mediainfo slot of the file page revision, and
+# imageinfo size, mime, sha1 and url.
+#
+# Batch is 50 titles, 500 with apihighlimits right. Next batches are loaded
+# in a background thread while the consumer is working on the current one.
+# Pages are yielded in input order, file pages as FilePage objects. Use
+# them as they are (or as_filepage()): pywikibot.FilePage(page) starts
+# with empty file info and would request it again.
+#
+# Loaded data is used by pywikibot itself for text, isRedirectPage() and
+# latest_file_info. pywikibot always requests extlinks() and data_item(),
+# use page_extlinks() and page_mediainfo() (or finnaidparser.get_finna_ids)
+# instead, they fall back to pywikibot for pages which weren't prefetched.
+#
+## Usage
+# from pageprefetch import prefetch_pages, page_mediainfo
+#
+# for page in prefetch_pages(commonssite, iter_linked_pages(commonssite, listpage)):
+#     print(page.title(), page.latest_file_info.sha1, len(page.text))
+#     data = page_mediainfo(page).get()
+
+import json
+import queue
+import threading
+
+import pywikibot
+from pywikibot.data import api
+
+FILE_NAMESPACE = 6
+
+PREFETCH_BATCHES = 2
+
+QUERY_PROPS = ['info', 'revisions', 'imageinfo', 'extlinks']
+REVISION_PROPS = ['ids', 'timestamp', 'flags', 'comment', 'user', 'size', 'sha1', 'contentmodel', 'content']
+IMAGEINFO_PROPS = ['timestamp', 'user', 'comment', 'url', 'size', 'sha1', 'mime']
+
+# end of pages
+_DONE = object()
+
+def batch_size(site):
+    if site.has_right('apihighlimits'):
+        return 500
+    return 50
+
+# FilePage of the page, the page itself if it is one already so that
+# loaded file info is kept
+def as_filepage(page):
+    if isinstance(page, pywikibot.FilePage):
+        return page
+    return pywikibot.FilePage(page)
+
+# Page objects of file namespace are converted to FilePage so that imageinfo
+# can be stored to them
+def _as_loadable_page(page):
+    if page.namespace() == FILE_NAMESPACE:
+        return as_filepage(page)
+    return page
+
+# Runs query until it is complete. Continued responses have the rest of
+# revisions, imageinfo and extlinks of the pages (content of large batches
+# does not fit to one response), they are merged to the earlier data.
+# Returns dict pageid or title -> page data
+def _query_pages(site, titles):
+    params = {
+        'action': 'query',
+        'titles': titles,
+        'prop': QUERY_PROPS,
+        'rvprop': REVISION_PROPS,
+        'rvslots': '*',
+        'iiprop': IMAGEINFO_PROPS,
+        'ellimit': 'max',
+        'continue': '',
+    }
+    pages = {}
+    while True:
+        result = site.simple_request(**params).submit()
+        for key, pagedata in result.get('query', {}).get('pages', {}).items():
+            if key not in pages:
+                pages[key] = pagedata
+                continue
+            merged = pages[key]
+            for prop, value in pagedata.items():
+                if isinstance(value, list) and isinstance(merged.get(prop), list):
+                    merged[prop].extend(value)
+                elif prop not in merged:
+                    merged[prop] = value
+        if 'continue' not in result:
+            return pages
+        params.update(result['continue'])
+
+# Entity in the format of wbgetentities from mediainfo slot of the latest
+# revision, {'id': ..., 'missing': ''} like wbgetentities if the file has no
+# structured data
+def _mediainfo_entity(pagedata):
+    media_id = 'M' + str(pagedata['pageid'])
+    revisions = pagedata.get('revisions') or [{}]
+    slot = revisions[0].get('slots', {}).get('mediainfo')
+    if slot is None:
+        return {'id': media_id, 'missing': ''}
+    entity = json.loads(slot.get('*', slot.get('content')))
+    entity.update({
+        'id': media_id,
+        'pageid': pagedata['pageid'],
+        'ns': pagedata['ns'],
+        'title': pagedata['title'],
+        'lastrevid': revisions[0]['revid'],
+        'modified': revisions[0]['timestamp'],
+    })
+    return entity
+
+def _set_mediainfo(site, page, pagedata):
+    entity = _mediainfo_entity(pagedata)
+    mediainfo = pywikibot.MediaInfo(site, entity['id'])
+    # same as pywikibot does when entities are preloaded, get() uses the
+    # content instead of requesting it
+    mediainfo._content = entity
+    page._prefetched_mediainfo = mediainfo
+
+def _load_batch(site, batch):
+    by_title = {page.title(): page for page in batch}
+    for pagedata in _query_pages(site, [page.title() for page in batch]).values():
+        page = by_title.get(pagedata['title'])
+        if page is None:
+            continue
+        api.update_page(page, pagedata, QUERY_PROPS)
+        links = pagedata.get('extlinks', [])
+        page._prefetched_extlinks = [link.get('*', link.get('url')) for link in links]
+        if isinstance(page, pywikibot.FilePage) and pagedata.get('pageid'):
+            _set_mediainfo(site, page, pagedata)
+
+# Generator of pages with metadata loaded, batches are loaded prefetch
+# batches ahead of the consumer
+def prefetch_pages(site, pages, groupsize=None, prefetch=PREFETCH_BATCHES):
+    if groupsize is None:
+        groupsize = batch_size(site)
+    loaded = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            batch = []
+            seen = set()
+            for page in pages:
+                if stop.is_set():
+                    break
+                page = _as_loadable_page(page)
+                if page.title() in seen:
+                    continue
+                seen.add(page.title())
+                batch.append(page)
+                if len(batch) >= groupsize:
+                    _load_batch(site, batch)
+                    loaded.put(batch)
+                    batch = []
+            if batch and not stop.is_set():
+                _load_batch(site, batch)
+                loaded.put(batch)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            loaded.put(_DONE)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            batch = loaded.get()
+            if batch is _DONE:
+                break
+            yield from batch
+    finally:
+        # generator closed early: let the producer finish its batch
+        stop.set()
+        while producer.is_alive():
+            try:
+                loaded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    if errors:
+        raise errors[0]
+
+# Lists of at most size items, for processing prefetched pages in chunks
+def iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# External link urls of the page
+def page_extlinks(page):
+    links = getattr(page, '_prefetched_extlinks', None)
+    if links is None:
+        return list(page.extlinks())
+    return links
+
+# MediaInfo entity of the file page, page.data_item() if it wasn't prefetched
+def page_mediainfo(page):
+    mediainfo = getattr(page, '_prefetched_mediainfo', None)
+    if mediainfo is None:
+        return page.data_item()
+    return mediainfo
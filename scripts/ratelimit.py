@@ -0,0 +1,140 @@
+# Rate limiting for API requests
+#
+# Token bucket: tokens are added at `rate` per second up to `capacity`.
+# Each request takes one token; if there is none left the caller sleeps
+# only as long as it takes for the next token to arrive. Unlike fixed
+# time.sleep() between requests this lets short bursts through without
+# waiting and still keeps the average under the limit.
+#
+# TokenBucket is for threads of one process. SharedTokenBucket keeps the
+# bucket in sqlite database so that all scripts running at the same time
+# share the same budget per host. Limits per host are in HOST_LIMITS.
+#
+## Usage
+# limiter = TokenBucket(rate=5)
+# for url in urls:
+#     limiter.acquire()
+#     requests.get(url)
+#
+# # shared between processes, limiter is selected by host of the url
+# limit(url)
+# requests.get(url)
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+
+DEFAULT_RATELIMIT_PATH = os.path.join(tempfile.gettempdir(), 'pywikibot-fiwiki-ratelimit.db')
+
+# host -> (requests per second, burst size)
+HOST_LIMITS = {
+    'api.finna.fi': (5, 5),
+    # html record pages and images
+    'finna.fi': (2, 4),
+    'www.finna.fi': (2, 4),
+    'commons.wikimedia.org': (5, 5),
+    'upload.wikimedia.org': (5, 10),
+    'imagehash.toolforge.org': (2, 2),
+    # one file in 8 seconds as before
+    'kuvapankki.valtioneuvosto.fi': (0.125, 1),
+}
+DEFAULT_HOST_LIMIT = (1, 1)
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        if capacity is None:
+            capacity = max(1, rate)
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # same bucket is shared by worker threads
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Token bucket stored in sqlite, shared by all processes using the same
+# database file. Bucket state is read and updated inside one write
+# transaction (BEGIN IMMEDIATE) so that two processes can't take the same
+# token. Wall clock is used since monotonic time is not comparable
+# between processes.
+class SharedTokenBucket:
+    def __init__(self, key, rate, capacity=None, path=DEFAULT_RATELIMIT_PATH):
+        if capacity is None:
+            capacity = max(1, rate)
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self.path = path
+
+        self.lock = threading.Lock()
+        # transactions are handled manually, timeout is for waiting other processes
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS buckets (
+                             key TEXT PRIMARY KEY,
+                             tokens REAL NOT NULL,
+                             updated REAL NOT NULL)''')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    # Take tokens if there are enough, otherwise returns seconds to wait
+    def _take(self, tokens):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (self.key,)).fetchone()
+                now = time.time()
+                if row is None:
+                    available = self.capacity
+                else:
+                    available = min(self.capacity, row[0] + max(0, now - row[1]) * self.rate)
+
+                wait = 0
+                if available >= tokens:
+                    available -= tokens
+                else:
+                    wait = (tokens - available) / self.rate
+                self.conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', (self.key, available, now))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return wait
+
+    def acquire(self, tokens=1):
+        while True:
+            wait = self._take(tokens)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+# shared limiters by host, created on first use
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(host):
+    with _limiters_lock:
+        if host not in _limiters:
+            rate, capacity = HOST_LIMITS.get(host, DEFAULT_HOST_LIMIT)
+            _limiters[host] = SharedTokenBucket(host, rate, capacity)
+        return _limiters[host]
+
+# wait until request to url is allowed
+def limit(url):
+    get_limiter(urllib.parse.urlparse(url).hostname).acquire()
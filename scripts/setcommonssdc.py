@@ -1,6 +1,7 @@
 # Purpose: add structured data to pictures from finna
 #
 # Running script: python <scriptname>
+# Only links added since the last run: python <scriptname> --incremental
 
 import pywikibot
 import mwparserfromhell
@@ -9,253 +10,25 @@ from urllib.request import urlopen
 
 import urllib.parse
 
-import re
 import urllib
-import requests
-import imagehash
-import io
 import os
-import tempfile
-from PIL import Image
+import sys
 
 import urllib3
 
+from finnaapi import get_finna_records, print_payload_stats
+from finnaidmap import get_idmap, isobsoletefinnaid, resolve_finna_ids
+from finnaidparser import get_finna_ids, get_source_id, geturlfromsource, stripid
+from worklist import WorkList
+from pageprefetch import as_filepage, iter_batches, page_mediainfo, prefetch_pages
+from imagematch import CandidateDownloadError, CommonsImage, downloadimage, match_candidates, print_download_stats
+
 
 # ----- FinnaData
 
 #class FinnaData:
-# Find (old) finna id's from file page urls
-def get_finna_ids(page):
-    finna_ids=[]
-
-    for url in page.extlinks():
-        if "finna.fi" in url:
-            id = None
-
-            # Parse id from url
-            patterns = [
-                           r"finna\.fi/Record/([^?]+)",
-                           r"finna\.fi/Cover/Show\?id=([^&]+)",
-                           r"finna\.fi/thumbnail\.php\?id=([^&]+)",
-                           r"finna\.fi/Cover/Download\?id=([^&]+)",
-                       ]
-
-            for pattern in patterns:
-                match = re.search(pattern, url)
-                if match:
-                    id = match.group(1)
-                    if id not in finna_ids:
-                        finna_ids.append(id)
-                    break
-
-    return finna_ids
-
-# urlencode Finna parameters
-def finna_api_parameter(name, value):
-   return "&" + urllib.parse.quote_plus(name) + "=" + urllib.parse.quote_plus(value)
-
-
-# Get finna API record with most of the information
-# Finna API documentation
-# * https://api.finna.fi
-# * https://www.kiwi.fi/pages/viewpage.action?pageId=53839221 
-
-def get_finna_record(id):
-
-    url="https://api.finna.fi/v1/record?id=" +  urllib.parse.quote_plus(id)
-    url+= finna_api_parameter('field[]', 'id')
-    url+= finna_api_parameter('field[]', 'title')
-    url+= finna_api_parameter('field[]', 'subTitle')
-    url+= finna_api_parameter('field[]', 'shortTitle')
-    url+= finna_api_parameter('field[]', 'summary')
-    url+= finna_api_parameter('field[]', 'imageRights')
-    url+= finna_api_parameter('field[]', 'images')
-    url+= finna_api_parameter('field[]', 'imagesExtended')
-    #url+= finna_api_parameter('field[]', 'onlineUrls')
-    url+= finna_api_parameter('field[]', 'openUrl')
-    url+= finna_api_parameter('field[]', 'nonPresenterAuthors')
-    url+= finna_api_parameter('field[]', 'onlineUrls')
-    url+= finna_api_parameter('field[]', 'subjects')
-    #url+= finna_api_parameter('field[]', 'subjectsExtendet')
-    url+= finna_api_parameter('field[]', 'subjectPlaces')
-    url+= finna_api_parameter('field[]', 'subjectActors')
-    url+= finna_api_parameter('field[]', 'subjectDetails')
-    # url+= finna_api_parameter('field[]', 'geoLocations')
-    url+= finna_api_parameter('field[]', 'buildings')
-    url+= finna_api_parameter('field[]', 'identifierString')
-    url+= finna_api_parameter('field[]', 'collections')
-    url+= finna_api_parameter('field[]', 'institutions')
-    url+= finna_api_parameter('field[]', 'classifications')
-    url+= finna_api_parameter('field[]', 'events')
-    url+= finna_api_parameter('field[]', 'languages')
-    url+= finna_api_parameter('field[]', 'originalLanguages')
-    url+= finna_api_parameter('field[]', 'year')
-    #url+= finna_api_parameter('field[]', 'hierarchicalPlaceNames')
-    url+= finna_api_parameter('field[]', 'formats')
-    #url+= finna_api_parameter('field[]', 'physicalDescriptions')
-    url+= finna_api_parameter('field[]', 'measurements')
-
-    try:
-        response = requests.get(url)
-        return response.json()
-    except:
-        print("Finna API query failed: " + url)
-        exit(1)
-
-# convert string to base 16 integer for calculating difference
-def converthashtoint(h, base=16):
-    return int(str(h), base)
-
-# Compares if the image is same using similarity hashing
-# method is to convert images to 64bit integers and then
-# calculate hamming distance. 
-#
-# Perceptual hashing 
-# http://www.hackerfactor.com/blog/index.php?/archives/432-Looks-Like-It.html
-# difference hashing
-# http://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
-#
-def is_same_image(img1, img2, hashlen=8):
-
-    phash1 = imagehash.phash(img1, hash_size=hashlen)
-    dhash1 = imagehash.dhash(img1, hash_size=hashlen)
-    phash1_int = converthashtoint(phash1)
-    dhash1_int = converthashtoint(dhash1)
-
-    phash2 = imagehash.phash(img2, hash_size=hashlen)
-    dhash2 = imagehash.dhash(img2, hash_size=hashlen)
-    phash2_int = converthashtoint(phash2)
-    dhash2_int = converthashtoint(dhash2)
-
-    # Hamming distance difference
-    phash_diff = bin(phash1_int ^ phash2_int).count('1')
-    dhash_diff = bin(dhash1_int ^ dhash2_int).count('1') 
-
-    # print hamming distance
-    if (phash_diff == 0 and dhash_diff == 0):
-        print("Both hashes are equal")
-    else:
-        print("Phash diff: " + str(phash_diff) + ", image1: " + str(phash1) + ", image2: " + str(phash2))
-        print("Dhash diff: " + str(dhash_diff) + ", image1: " + str(dhash1) + ", image2: " + str(dhash2))
-
-    # max distance for same is that least one is 0 and second is max 3
-
-    if phash_diff == 0 and dhash_diff < 4:
-        return True
-    elif phash_diff < 4 and dhash_diff == 0:
-        return True
-    else:
-        return False
-
-def convert_tiff_to_jpg(tiff_image):
-    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as fp:
-        tiff_image.convert('RGB').save(fp, "JPEG", quality=95)
-    return fp.name    
-
-# note: commons at least once has thrown error due to client policy?
-# "Client Error: Forbidden. Please comply with the User-Agent policy"
-# keep an eye out for problems..
-def downloadimage(url):
-    headers={'User-Agent': 'pywikibot'}
-    # Image.open(urllib.request.urlopen(url, headers=headers))
-
-    response = requests.get(url, headers=headers, stream=True)
-    response.raise_for_status()
-                            
-    return Image.open(io.BytesIO(response.content))
-
 # ----- /FinnaData
 
-# strip id from other things that may be after it:
-# there might be part of url or some html in same field..
-def stripid(oldsource):
-    # space after url?
-    indexend = oldsource.find(" ")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-
-    # html tag after url?
-    indexend = oldsource.find("<")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find(">")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-
-    # wikimarkup after url?
-    indexend = oldsource.find("[")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find("]")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find("{")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find("}")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find("|")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-
-    # some parameters in url?
-    indexend = oldsource.find("&")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find("#")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-
-    # some parameters in url?
-    indexend = oldsource.find("?")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-
-    # linefeed at end?
-    if (oldsource.endswith("\n")):
-        oldsource = oldsource[:len(oldsource)-1]
-
-    return oldsource
-
-# link might have "show?id=<id>" which we handle here
-# if it has "Record/<id>" handle it separately
-def getlinksourceid(oldsource):
-    strlen = len("id=")
-    indexid = oldsource.find("id=")
-    if (indexid < 0):
-        return ""
-    oldsource = oldsource[indexid+strlen:]
-    return stripid(oldsource)
-
-def getrecordid(oldsource):
-    strlen = len("/Record/")
-    indexid = oldsource.find("/Record/")
-    if (indexid < 0):
-        return ""
-    oldsource = oldsource[indexid+strlen:]
-    return stripid(oldsource)
-    
-# commons source may have human readable stuff in it
-# parse to plain url
-def geturlfromsource(source):
-    protolen = len("http://")
-    index = source.find("http://")
-    if (index < 0):
-        protolen = len("https://")
-        index = source.find("https://")
-        if (index < 0):
-            # no url in string
-            return ""
-
-    # try to find space or something            
-    indexend = source.find(" ", index+protolen)
-    if (indexend < 0):
-        # no space or other clear separator -> just use string length
-        indexend = len(source)-1
-        
-    return source[index:indexend]
-
 # input: kuvakokoelmat.fi url
 # output: old format id
 def getkuvakokoelmatidfromurl(source):
@@ -478,141 +251,14 @@ def addcollectiontostatements(pywikibot, wikidata_site, collection):
     coll_claim.setTarget(qualifier_targetcoll)
     return coll_claim
 
-# https&#x3A;&#x2F;&#x2F;api.finna.fi&#x2F;v1&#x2F;record&#x3F;id&#x3D;
-def parseapiidfromfinnapage(finnapage):
-    index = finnapage.find(';api.finna.fi&')
-    if (index < 0):
-        return ""
-    finnapage = finnapage[index:]        
-
-    index = finnapage.find('id')
-    if (index < 0):
-        return ""
-    index = finnapage.find('&#x3D;')
-    if (index < 0):
-        return ""
-    index = index + len("&#x3D;")
-    finnapage = finnapage[index:]
-
-    indexend = finnapage.find('"')
-    if (indexend < 0):
-        indexend = finnapage.find('>')
-        if (indexend < 0):
-            return ""
-    finnapage = finnapage[:indexend]
-    
-    # convert html code to character (if any)
-    finnapage = finnapage.replace("&#x25;3A", ":")
-    
-    indexend = finnapage.find('&amp')
-    if (indexend < 0):
-        indexend = finnapage.find('&')
-        if (indexend < 0):
-            return ""
-    finnapage = finnapage[:indexend]
-    return finnapage
-
-def parsedatarecordidfromfinnapage(finnapage):
-    attrlen = len('data-record-id="')
-    indexid = finnapage.find('data-record-id="')
-    if (indexid < 0):
-        return ""
-        
-    indexid = indexid+attrlen
-    indexend = finnapage.find('"', indexid)
-    if (indexend < 0):
-        return ""
-
-    return finnapage[indexid:indexend]
-
-# fetch metapage from finna and try to parse current ID from the page
-# since we might have obsolete ID.
-# new ID is needed API query.
-def parsemetaidfromfinnapage(finnaurl):
-
-    finnapage = ""
-
-    try:
-        request = urllib.request.Request(finnaurl)
-        print("request done: " + finnaurl)
-
-        response = urllib.request.urlopen(request)
-        if (response.readable() == False):
-            print("response not readable")
-
-        htmlbytes = response.read()
-        finnapage = htmlbytes.decode("utf8")
-
-        #print("page: " + finnapage)
-        
-    except urllib.error.HTTPError as e:
-        print(e.__dict__)
-        return ""
-    except urllib.error.URLError as e:
-        print(e.__dict__)
-        return ""
-    #except:
-        #print("failed to retrieve finna page")
-        #return ""
-
-    # try a new method to parse the id..
-    newid = parseapiidfromfinnapage(finnapage)
-    if (len(newid) > 0):
-        # sometimes finna has this html code instead of url encoding..
-        newid = newid.replace("&#x25;3A", ":")
-        print("new id from finna: " + newid)
-        return newid
-
-    newid = parsedatarecordidfromfinnapage(finnapage)
-    if (len(newid) > 0):
-        # in case there is url encoding in place..
-        #newid = newid.replace("%3A", ":")
-        print("new id from finna: " + newid)
-        return newid
-
-    return ""
-    
 def getnewsourceforfinna(finnarecord):
     return "<br>Image record page in Finna: [https://finna.fi/Record/" + finnarecord + " " + finnarecord + "]\n"
 
-# get pages immediately under cat
-# and upto depth of 1 in subcats
-def getcatpages(pywikibot, commonssite, maincat, recurse=False):
-    final_pages = list()
-    cat = pywikibot.Category(commonssite, maincat)
-    pages = list(commonssite.categorymembers(cat))
-
-    for page in pages:
-        if page not in final_pages:
-            final_pages.append(page)
-
-    # no recursion by default, just get into depth of 1
-    if (recurse == True):
-        subcats = list(cat.subcategories())
-        for subcat in subcats:
-            subpages = commonssite.categorymembers(subcat)
-            for subpage in subpages:
-                if subpage not in pages: # avoid duplicates
-                    final_pages.append(page)
-
-    return final_pages
-
-def getlinkedpages(pywikibot, commonssite, linkpage):
-    listpage = pywikibot.Page(commonssite, linkpage)  # The page you're interested in
-
-    pages = list()
-    # Get all linked pages from the page
-    for linked_page in listpage.linkedPages():
-        if linked_page not in pages: # avoid duplicates
-            pages.append(linked_page)
-
-    return pages
-
 # brute force check if wikibase exists for structured data:
 # need to add it manually for now if it doesn't
 def doessdcbaseexist(page):
     try:
-        wditem = page.data_item()  # Get the data item associated with the page
+        wditem = page_mediainfo(page)  # Get the data item associated with the page
         #if (wditem.exists() == False):
         data = wditem.get() # all the properties in json-format
         return True # no exception -> ok, we can use it
@@ -621,60 +267,10 @@ def doessdcbaseexist(page):
 
     return False
 
-# ------ main()
-
-# TODO: check wikidata for correct qcodes
-# 
-# qcode of collections -> label
-d_qcodetolabel = dict()
-d_qcodetolabel["Q118976025"] = "Studio Kuvasiskojen kokoelma"
-d_qcodetolabel["Q107388072"] = "Historian kuvakokoelma" # /Museovirasto/Historian kuvakokoelma/
-d_labeltoqcode = dict()
-d_labeltoqcode["Studio Kuvasiskojen kokoelma"] = "Q118976025"
-d_labeltoqcode["Historian kuvakokoelma"] = "Q107388072" # /Museovirasto/Historian kuvakokoelma/
-
-# Accessing wikidata properties and items
-wikidata_site = pywikibot.Site("wikidata", "wikidata")  # Connect to Wikidata
-
-# site = pywikibot.Site("fi", "wikipedia")
-commonssite = pywikibot.Site("commons", "commons")
-commonssite.login()
-
-# get list of pages upto depth of 1 
-#pages = getcatpages(pywikibot, commonssite, "Category:Kuvasiskot", True)
-#pages = getcatpages(pywikibot, commonssite, "Professors of University of Helsinki", True)
-#pages = getlinkedpages(pywikibot, commonssite, 'user:FinnaUploadBot/filelist')
-pages = getlinkedpages(pywikibot, commonssite, 'User:FinnaUploadBot/kuvakokoelmat.fi')
-
-#pages = getcatpages(pywikibot, commonssite, "Botanists from Finland")
-
-rowcount = 1
-#rowlimit = 10
-
-print("Pages found: " + str(len(pages)))
-
-for page in pages:
-    # 14 is category -> recurse into subcategories
-    #
-    if page.namespace() != 6:  # 6 is the namespace ID for files
-        continue
-
-    filepage = pywikibot.FilePage(page)
-    if filepage.isRedirectPage():
-        continue
-    file_info = filepage.latest_file_info
-
-    oldtext=page.text
-
-    print(" ////////", rowcount, ": [ " + page.title() + " ] ////////")
-    rowcount += 1
-
-    #site = pywikibot.Site("wikidata", "wikidata")
-    #repo = site.data_repository()
-    #item = pywikibot.ItemPage(repo, "Q2225")    
-    
+# find finna id from source of the file page:
+# returns tuple (finnaid, sourceurl) or empty strings if id could not be found
+def getfinnaidforpage(page):
     wikicode = mwparserfromhell.parse(page.text)
-    templatelist = wikicode.filter_templates()
 
     # should store new format id to picture source
     # -> use setfinnasource.py for these for now
@@ -693,9 +289,8 @@ for page in pages:
                     kkid = getkuvakokoelmatidfromurl(srcvalue)
                 if (srcvalue.find("finna.fi") > 0):
                     finnasource = srcvalue
-                    finnaid = getlinksourceid(srcvalue)
-                    if (finnaid == ""):
-                        finnaid = getrecordid(srcvalue)
+                    finnaid, idkind = get_source_id(srcvalue)
+                    if (idkind != 'id'):
                         if (finnaid == ""):
                             print("no id and no record found")
                         break
@@ -707,9 +302,8 @@ for page in pages:
                     kkid = getkuvakokoelmatidfromurl(srcvalue)
                 if (srcvalue.find("finna.fi") > 0):
                     finnasource = srcvalue
-                    finnaid = getlinksourceid(srcvalue)
-                    if (finnaid == ""):
-                        finnaid = getrecordid(srcvalue)
+                    finnaid, idkind = get_source_id(srcvalue)
+                    if (idkind != 'id'):
                         if (finnaid == ""):
                             print("no id and no record found")
                         break
@@ -730,15 +324,15 @@ for page in pages:
             # might have something usable..
         else:
             print("Could not find a finna id in " + page.title() + ", skipping.")
-        continue
+        return "", ""
  
     # kuvasiskot has "musketti" as part of identier, alternatively "museovirasto" may be used in some cases
     if (finnaid.find("musketti") < 0 and finnaid.find("museovirasto") < 0):
         print("WARN: unexpected id in: " + page.title() + ", id: " + finnaid)
-        #continue
+        #return "", ""
     if (finnaid.find("profium.com") > 0):
         print("WARN: unusable url (redirector) in: " + page.title() + ", id: " + finnaid)
-        continue
+        return "", ""
         
     if (len(finnaid) >= 50):
         print("WARN: finna id in " + page.title() + " is unusually long? bug or garbage in url? ")
@@ -763,20 +357,24 @@ for page in pages:
     print("finna ID found: " + finnaid)
     sourceurl = "https://www.finna.fi/Record/" + finnaid
 
-    if (finnaid.find("musketti") >= 0 or finnaid.find("hkm.HKM") >= 0):
+    if (isobsoletefinnaid(finnaid)):
         # check if the source has something other than url in it as well..
         # if it has some human-readable things try to parse real url
         if (len(finnasource) > 0):
             finnaurl = geturlfromsource(finnasource)
             if (finnaurl == ""):
                 print("WARN: could not parse finna url from source in " + page.title() + ", source: " + finnasource)
-                #continue
-    
-        # obsolete id -> try to fetch page and locate current ID
-        finnaid = parsemetaidfromfinnapage(sourceurl)
+                #return "", ""
+
+    return finnaid, sourceurl
+
+# obsolete id -> current id from newids (see finnaidmap.py)
+def getcurrentfinnaid(page, finnaid, sourceurl, newids):
+    if (isobsoletefinnaid(finnaid)):
+        finnaid = newids.get(finnaid, "")
         if (finnaid == ""):
             print("WARN: could not parse current finna id in " + page.title() + " , skipping, url: " + sourceurl)
-            continue
+            return "", ""
         if (finnaid.find("\n") > 0):
             finnaid = leftfrom(finnaid, "\n")
             print("WARN: removed newline from new finna id for: " + page.title() + ", " + finnaid )
@@ -786,31 +384,113 @@ for page in pages:
             sourceurl = "https://www.finna.fi/Record/" + finnaid
         else:
             print("WARN: unexpected finna id in " + page.title() + ", id from finna: " + finnaid)
-            #continue
+            #return "", ""
 
-    finna_record = get_finna_record(finnaid)
-    if (finna_record['status'] != 'OK'):
-        print("Skipping (status not OK): " + finnaid + " status: " + finna_record['status'])
-        continue
+    return finnaid, sourceurl
+
+# ------ main()
+
+# TODO: check wikidata for correct qcodes
+# 
+# qcode of collections -> label
+d_qcodetolabel = dict()
+d_qcodetolabel["Q118976025"] = "Studio Kuvasiskojen kokoelma"
+d_qcodetolabel["Q107388072"] = "Historian kuvakokoelma" # /Museovirasto/Historian kuvakokoelma/
+d_labeltoqcode = dict()
+d_labeltoqcode["Studio Kuvasiskojen kokoelma"] = "Q118976025"
+d_labeltoqcode["Historian kuvakokoelma"] = "Q107388072" # /Museovirasto/Historian kuvakokoelma/
 
-    if (finna_record['resultCount'] != 1):
-        print("Skipping (result not 1): " + finnaid + " count: " + str(finna_record['resultCount']))
+# Accessing wikidata properties and items
+wikidata_site = pywikibot.Site("wikidata", "wikidata")  # Connect to Wikidata
+
+# site = pywikibot.Site("fi", "wikipedia")
+commonssite = pywikibot.Site("commons", "commons")
+commonssite.login()
+
+# pages are yielded while the lists are still being loaded,
+# depth is levels of subcategories, needs
+# from commonspages import iter_category_pages, iter_linked_pages
+#pages = iter_category_pages(commonssite, "Category:Kuvasiskot", depth=1)
+#pages = iter_category_pages(commonssite, "Professors of University of Helsinki", depth=1)
+#pages = iter_linked_pages(commonssite, 'user:FinnaUploadBot/filelist')
+# --incremental: only links added to the list page since the last run and
+# the ones which failed, see worklist.py
+worklist = WorkList(commonssite, 'User:FinnaUploadBot/kuvakokoelmat.fi', incremental='--incremental' in sys.argv)
+pages = worklist.pages()
+
+#pages = iter_category_pages(commonssite, "Botanists from Finland")
+
+#rowlimit = 10
+
+# pages are handled in chunks: finna ids of a chunk are resolved and their
+# records fetched with a few requests, and the chunk is processed before
+# the next one is read
+PAGE_CHUNK_SIZE = 50
+
+# Generator of (page, filepage, finnaid, sourceurl, finna_records,
+# finna_statuses), records and statuses are for the chunk of the page
+def iterpageswithrecords(pages):
+    rowcount = 1
+    for chunk in iter_batches(pages, PAGE_CHUNK_SIZE):
+        pagestoprocess = list()
+        for page in chunk:
+            # 14 is category -> recurse into subcategories
+            #
+            if page.namespace() != 6:  # 6 is the namespace ID for files
+                continue
+
+            # prefetched FilePage, file info is already loaded
+            filepage = as_filepage(page)
+            if filepage.isRedirectPage():
+                continue
+
+            print(" ////////", rowcount, ": [ " + page.title() + " ] ////////")
+            rowcount += 1
+
+            finnaid, sourceurl = getfinnaidforpage(page)
+            if (finnaid == ""):
+                continue
+            pagestoprocess.append((page, filepage, finnaid, sourceurl))
+
+        # obsolete ids are resolved once and stored for later runs
+        newids = resolve_finna_ids([finnaid for page, filepage, finnaid, sourceurl in pagestoprocess if isobsoletefinnaid(finnaid)])
+
+        resolvedpages = list()
+        for page, filepage, oldid, sourceurl in pagestoprocess:
+            finnaid, sourceurl = getcurrentfinnaid(page, oldid, sourceurl, newids)
+            if (finnaid == ""):
+                # failures which are not stored to id map (network errors)
+                # are retried on the next run
+                if get_idmap().lookup(oldid) is None:
+                    worklist.mark_failed(page)
+                continue
+            resolvedpages.append((page, filepage, finnaid, sourceurl))
+
+        finna_records, finna_statuses = get_finna_records([finnaid for page, filepage, finnaid, sourceurl in resolvedpages], fields='sdc')
+        for page, filepage, finnaid, sourceurl in resolvedpages:
+            yield page, filepage, finnaid, sourceurl, finna_records, finna_statuses
+
+# text, redirect, file info, external links and mediainfo of the pages
+# are loaded in batches ahead of the loop
+for page, filepage, finnaid, sourceurl, finna_records, finna_statuses in iterpageswithrecords(prefetch_pages(commonssite, pages)):
+    print(" -- [ " + page.title() + " ] --")
+
+    if finnaid not in finna_records:
+        print("Skipping (" + finna_statuses[finnaid] + "): " + finnaid)
+        # temporary errors are retried on the next run
+        if finna_statuses[finnaid] != 'not found':
+            worklist.mark_failed(page)
         continue
 
+    finna_record = finna_records[finnaid]
     print("finna record ok: " + finnaid)
 
-    if "records" not in finna_record:
-        print("WARN: 'records' not found in finna record, skipping: " + finnaid)
-        continue
-    if (len(finna_record['records']) == 0):
-        print("WARN: empty array of 'records' for finna record, skipping: " + finnaid)
-        continue
-    if "collections" not in finna_record['records'][0]:
+    if "collections" not in finna_record:
         print("WARN: 'collections' not found in finna record, skipping: " + finnaid)
         continue
 
     # collections: expecting ['Historian kuvakokoelma', 'Studio Kuvasiskojen kokoelma']
-    finna_collections = finna_record['records'][0]['collections']
+    finna_collections = finna_record.collections
 
     #if ("Antellin kokoelma" in finna_collections):
         #print("Skipping collection (can't match by hash due similarities): " + finnaid)
@@ -822,34 +502,33 @@ for page in pages:
         if coll in d_labeltoqcode:
             collectionqcodes.append(d_labeltoqcode[coll])
 
-    if "imagesExtended" not in finna_record['records'][0]:
+    if not finna_record.images:
         print("WARN: 'imagesExtended' not found in finna record, skipping: " + finnaid)
         continue
 
     # Test copyright (old field: rights, but request has imageRights?)
-    # imageRights = finna_record['records'][0]['imageRights']
-    imagesExtended = finna_record['records'][0]['imagesExtended'][0]
-    if (imagesExtended['rights']['copyright'] != "CC BY 4.0"):
-        print("Incorrect copyright: " + imagesExtended['rights']['copyright'])
+    # imageRights = finna_record['imageRights']
+    imagesExtended = finna_record.images[0]
+    if (imagesExtended.copyright != "CC BY 4.0"):
+        print("Incorrect copyright: " + str(imagesExtended.copyright))
         continue
 
     # 'images' can have array of multiple images, need to select correct one
     # -> loop through them (they should have just different &index= in them)
     # and compare with the image in commons
-    imageList = finna_record['records'][0]['images']
+    imageList = finna_record.image_urls
 
     match_found = False
     if (len(imageList) == 1):
-        # get image from commons for comparison:
-        # try to use same size
-        commons_image_url = filepage.get_file_url()
-        commons_image = downloadimage(commons_image_url)
+        # image from commons for comparison, thumbnail
+        # of same size as finna image is used
+        commons_image = CommonsImage(filepage)
     
-        finna_image_url = "https://finna.fi" + imagesExtended['urls']['large']
+        finna_image_url = imagesExtended.large_url
         finna_image = downloadimage(finna_image_url)
         
         # Test if image is same using similarity hashing
-        if (is_same_image(finna_image, commons_image) == True):
+        if (commons_image.matches(finna_image) == True):
             match_found = True
 
     if (len(imageList) > 1):
@@ -857,24 +536,23 @@ for page in pages:
         # need to pick the one that is closest match
         print("Multiple images for same item: " + str(len(imageList)))
 
-        # get image from commons for comparison:
-        # try to use same size
-        commons_image_url = filepage.get_file_url()
-        commons_image = downloadimage(commons_image_url)
-        
-        f_imgindex = 0
-        for img in imageList:
-            finna_image_url = "https://finna.fi" + img
-            finna_image = downloadimage(finna_image_url)
-
-            # Test if image is same using similarity hashing
-            if (is_same_image(finna_image, commons_image) == True):
-                match_found = True
-                need_index = True
-                print("Matching image index: " + str(f_imgindex))
-                break
-            else:
-                f_imgindex = f_imgindex + 1
+        # all candidates are downloaded and hashed concurrently and
+        # compared to thumbnail of same size as finna image
+        commons_image = CommonsImage(filepage)
+        candidate_urls = ["https://finna.fi" + img for img in imageList]
+        try:
+            match = match_candidates(commons_image, candidate_urls)
+        except CandidateDownloadError as e:
+            # retried on the next run
+            print("Could not compare all images, skipping: " + finnaid + ", " + str(e))
+            worklist.mark_failed(page)
+            continue
+        if (match is not None):
+            f_imgindex, finna_image, phash_diff, dhash_diff = match
+            finna_image_url = candidate_urls[f_imgindex]
+            match_found = True
+            need_index = True
+            print("Matching image index: " + str(f_imgindex))
 
     if (match_found == False):
         print("No matching image found, skipping: " + finnaid)
@@ -887,7 +565,7 @@ for page in pages:
     if (doessdcbaseexist(page) == False):
         print("Wikibase item does not yet exist for: " + page.title() + ", id: " + finnaid)
         continue
-    wditem = page.data_item()  # Get the data item associated with the page
+    wditem = page_mediainfo(page)  # Get the data item associated with the page
     data = wditem.get() # all the properties in json-format
     
     if "statements" not in data:
@@ -1012,3 +690,7 @@ for page in pages:
     #    exit(1)
     #    break
 
+
+print_payload_stats()
+print_download_stats()
+worklist.finish()
@@ -1,15 +1,20 @@
 # Purpose: add metapage to source on pictures from finna
 #
 # Running script: python <scriptname>
+# Only links added since the last run: python <scriptname> --incremental
 
 import pywikibot
 import mwparserfromhell
 import json
+import sys
 import urllib
 from urllib.request import urlopen
 
 import urllib3
 
+from worklist import WorkList
+from pageprefetch import as_filepage, prefetch_pages
+
 def getnewfinnarecordurl(finnarecordid):
     if (len(finnarecordid) == 0):
         return ""
@@ -250,59 +255,34 @@ def isblockedimage(page):
 
     return False
 
-# get pages immediately under cat
-# and upto depth of 1 in subcats
-def getcatpages(pywikibot, commonssite, maincat, recurse=False):
-    cat = pywikibot.Category(commonssite, maincat)
-    pages = list(commonssite.categorymembers(cat))
-
-    # no recursion by default, just get into depth of 1
-    if (recurse == True):
-        subcats = list(cat.subcategories())
-        for subcat in subcats:
-            subpages = commonssite.categorymembers(subcat)
-            for subpage in subpages:
-                if isblockedimage(subpage) == False: 
-                    if subpage not in pages: # avoid duplicates
-                        pages.append(subpage)
-
-    return pages
-
-def getlinkedpages(pywikibot, commonssite, linkpage):
-    listpage = pywikibot.Page(commonssite, linkpage)  # The page you're interested in
-
-    pages = list()
-    # Get all linked pages from the page
-    for linked_page in listpage.linkedPages():
-        if isblockedimage(linked_page) == False: 
-            if linked_page not in pages: # avoid duplicates
-                pages.append(linked_page)
-
-    return pages
-
 # ------ main()
 
 # site = pywikibot.Site("fi", "wikipedia")
 commonssite = pywikibot.Site("commons", "commons")
 commonssite.login()
 
-# get list of pages upto depth of 1 
-#pages = getcatpages(pywikibot, commonssite, "Category:Kuvasiskot", True)
-#pages = getcatpages(pywikibot, commonssite, "Professors of University of Helsinki", True)
+# pages are yielded while the lists are still being loaded,
+# depth is levels of subcategories, needs
+# from commonspages import iter_category_pages, iter_linked_pages
+#pages = iter_category_pages(commonssite, "Category:Kuvasiskot", depth=1, skip=isblockedimage)
+#pages = iter_category_pages(commonssite, "Professors of University of Helsinki", depth=1, skip=isblockedimage)
 
-#pages = getlinkedpages(pywikibot, commonssite, 'user:FinnaUploadBot/filelist')
-pages = getlinkedpages(pywikibot, commonssite, 'User:FinnaUploadBot/kuvakokoelmat.fi')
+#pages = iter_linked_pages(commonssite, 'user:FinnaUploadBot/filelist', skip=isblockedimage)
+# --incremental: only links added to the list page since the last run and
+# the ones which failed, see worklist.py
+worklist = WorkList(commonssite, 'User:FinnaUploadBot/kuvakokoelmat.fi', incremental='--incremental' in sys.argv)
+pages = worklist.pages(skip=isblockedimage)
 
 rowcount = 1
 #rowlimit = 10
 
-print("Pages found: " + str(len(pages)))
-
-for page in pages:
+# text and redirect of the pages are loaded in batches ahead of the loop
+for page in prefetch_pages(commonssite, pages):
     if page.namespace() != 6:  # 6 is the namespace ID for files
         continue
 
-    filepage = pywikibot.FilePage(page)
+    # prefetched FilePage, file info is already loaded
+    filepage = as_filepage(page)
     if filepage.isRedirectPage():
         continue    
 
@@ -374,6 +354,7 @@ for page in pages:
         continue
     if (getfinnapage(newsourceurl) == False):
         print("Failed to get finna metapage with new url: " + newsourceurl)
+        worklist.mark_failed(page)
         continue
     print("Found finna metapage with new url: " + newsourceurl)
 
@@ -399,9 +380,11 @@ for page in pages:
     pywikibot.info(choice)
     if choice == 'q':
         print("Asked to exit. Exiting.")
+        # pages not processed yet stay pending for the next run
         exit()
 
     if choice == 'y':
         page.text=newtext
         page.save(summary)
 
+worklist.finish()
@@ -0,0 +1,261 @@
+# Memory-bounded TIFF -> JPEG conversion
+#
+# Large Finna scans are hundreds of megabytes when decoded, 16-bit and
+# floating point samples even more. Conversion here:
+# - streams the download to a temporary file instead of keeping it in memory
+# - reads uncompressed strip TIFFs in bands of strips directly from the file,
+#   at most memory_limit bytes of source samples at a time. Only the 8-bit
+#   output image is kept whole since Pillow can't encode JPEG in parts
+# - other TIFFs (compressed, tiled) are decoded by Pillow at once
+# - scales 16-bit and floating point samples to 8 bits. Pillow convert('RGB')
+#   clips them, floats in range 0..1 became black and 16-bit white
+#   (the "borked" conversions in update_kuvasiskot.py isblockedimage)
+#
+# Peak memory of each conversion is reported in the returned stats.
+#
+## Usage
+# from tiffconvert import convert_tiff_url_to_jpg
+#
+# jpg_file_name, stats = convert_tiff_url_to_jpg(url)
+# print("peak memory: " + str(stats['peak_rss']) + " MB")
+# os.unlink(jpg_file_name)
+#
+## Converting local files
+# python tiffconvert.py scan.tif [scan2.tif ...]
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+
+import numpy
+from PIL import Image
+
+from imagematch import downloadimagefile
+
+# bytes of source samples read at a time
+DEFAULT_MEMORY_LIMIT = 16 * 1024 * 1024
+
+JPEG_QUALITY = 95
+
+# TIFF tags
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_PLANAR_CONFIGURATION = 284
+TAG_BITS_PER_SAMPLE = 258
+TAG_SAMPLE_FORMAT = 339
+
+# peak RSS of this process can be reset on Linux so that peak of each
+# conversion can be measured separately
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+# megabytes
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+# numpy dtype of samples or None if not handled in strips
+def sample_dtype(bits, sample_format, byteorder):
+    if sample_format == 1 and bits in (8, 16):
+        return numpy.dtype(byteorder + 'u' + str(bits // 8))
+    if sample_format == 3 and bits in (32, 64):
+        return numpy.dtype(byteorder + 'f' + str(bits // 8))
+    return None
+
+# Samples to uint8. Floats are divided by scale, given by float_scale()
+def to_uint8(samples, scale=1.0):
+    if samples.dtype == numpy.uint8:
+        return samples
+    if samples.dtype.kind == 'u':
+        return (samples >> (8 * samples.dtype.itemsize - 8)).astype(numpy.uint8)
+    # in place, band is not copied more than once
+    samples = samples.astype(numpy.float32)
+    samples *= 255.0 / scale
+    numpy.nan_to_num(samples, copy=False)
+    numpy.clip(samples, 0, 255, out=samples)
+    return samples.astype(numpy.uint8)
+
+# Floats are usually in range 0..1, use the largest value if larger
+def float_scale(maximum):
+    if maximum <= 1.0:
+        return 1.0
+    return float(maximum)
+
+# Strip layout of uncompressed TIFF or None if it can't be read in strips
+def get_strip_layout(image, path):
+    tags = image.tag_v2
+    if tags.get(TAG_COMPRESSION, 1) != 1 or tags.get(TAG_PLANAR_CONFIGURATION, 1) != 1:
+        return None
+    if TAG_STRIP_OFFSETS not in tags or tags.get(TAG_PHOTOMETRIC) not in (0, 1, 2):
+        return None
+
+    samples = tags.get(TAG_SAMPLES_PER_PIXEL, 1)
+    bits = tags.get(TAG_BITS_PER_SAMPLE, (1,))
+    if not isinstance(bits, tuple):
+        bits = (bits,)
+    sample_format = tags.get(TAG_SAMPLE_FORMAT, (1,))
+    if not isinstance(sample_format, tuple):
+        sample_format = (sample_format,)
+    if len(set(bits)) != 1 or len(set(sample_format)) != 1:
+        return None
+
+    with open(path, 'rb') as f:
+        byteorder = '<' if f.read(2) == b'II' else '>'
+    dtype = sample_dtype(bits[0], sample_format[0], byteorder)
+    if dtype is None:
+        return None
+
+    photometric = tags[TAG_PHOTOMETRIC]
+    if photometric == 2 and samples < 3:
+        return None
+
+    offsets = tags[TAG_STRIP_OFFSETS]
+    if not isinstance(offsets, tuple):
+        offsets = (offsets,)
+    width, height = image.size
+    return {
+        'width': width,
+        'height': height,
+        'samples': samples,
+        'dtype': dtype,
+        'photometric': photometric,
+        'rows_per_strip': min(tags.get(TAG_ROWS_PER_STRIP, height), height),
+        'offsets': offsets,
+    }
+
+# Returns list of (first row, rows, offset) of strips
+def get_strips(layout):
+    strips = []
+    rows_per_strip = layout['rows_per_strip']
+    for index, offset in enumerate(layout['offsets']):
+        row = index * rows_per_strip
+        if row >= layout['height']:
+            break
+        strips.append((row, min(rows_per_strip, layout['height'] - row), offset))
+    return strips
+
+def read_strip(f, layout, rows, offset):
+    count = rows * layout['width'] * layout['samples']
+    f.seek(offset)
+    samples = numpy.fromfile(f, dtype=layout['dtype'], count=count)
+    return samples.reshape(rows, layout['width'], layout['samples'])
+
+# Rows grouped to bands of at most memory_limit bytes (at least one row
+# per band). Strips are uncompressed so they can be split at any row.
+# Band is list of (first row, rows, offset) parts of strips.
+def get_bands(layout, memory_limit):
+    row_bytes = layout['width'] * layout['samples'] * layout['dtype'].itemsize
+    band_rows = max(1, memory_limit // row_bytes)
+    bands = []
+    band = []
+    rows_in_band = 0
+    for row, rows, offset in get_strips(layout):
+        while rows > 0:
+            part = min(rows, band_rows - rows_in_band)
+            band.append((row, part, offset))
+            rows_in_band += part
+            row += part
+            rows -= part
+            offset += part * row_bytes
+            if rows_in_band == band_rows:
+                bands.append(band)
+                band = []
+                rows_in_band = 0
+    if band:
+        bands.append(band)
+    return bands
+
+def read_band(f, layout, band):
+    return numpy.concatenate([read_strip(f, layout, rows, offset) for row, rows, offset in band])
+
+def convert_strips(path, layout, memory_limit):
+    mode = 'RGB' if layout['photometric'] == 2 else 'L'
+    bands = get_bands(layout, memory_limit)
+
+    with open(path, 'rb') as f:
+        # floats: range from all samples first
+        scale = 1.0
+        if layout['dtype'].kind == 'f':
+            maximum = 0.0
+            for band in bands:
+                maximum = max(maximum, float(numpy.nanmax(read_band(f, layout, band))))
+            scale = float_scale(maximum)
+
+        output = Image.new(mode, (layout['width'], layout['height']))
+        for band in bands:
+            samples = to_uint8(read_band(f, layout, band), scale)
+            if mode == 'RGB':
+                samples = samples[:, :, :3]
+            else:
+                samples = samples[:, :, 0]
+                # WhiteIsZero
+                if layout['photometric'] == 0:
+                    samples = 255 - samples
+            output.paste(Image.fromarray(numpy.ascontiguousarray(samples), mode), (0, band[0][0]))
+    return output
+
+# Whole image decoded by Pillow, 16-bit and float modes scaled to 8 bits
+def convert_full(path):
+    image = Image.open(path)
+    if image.mode == 'F' or image.mode.startswith('I'):
+        samples = numpy.asarray(image)
+        scale = 1.0
+        if samples.dtype.kind == 'f':
+            scale = float_scale(float(numpy.nanmax(samples)))
+        elif samples.dtype.kind == 'i':
+            samples = numpy.clip(samples, 0, 65535).astype(numpy.uint16)
+        return Image.fromarray(to_uint8(samples, scale), 'L')
+    if image.mode in ('L', 'RGB'):
+        return image
+    return image.convert('RGB')
+
+# Convert TIFF file to temporary JPEG file.
+# Returns tuple (jpg file name, stats), stats has keys method ('strips' or
+# 'full') and peak_rss in megabytes
+def convert_tiff_to_jpg(path, memory_limit=DEFAULT_MEMORY_LIMIT, quality=JPEG_QUALITY):
+    reset_peak_rss()
+    with Image.open(path) as image:
+        layout = get_strip_layout(image, path)
+    if layout is not None:
+        output = convert_strips(path, layout, memory_limit)
+        method = 'strips'
+    else:
+        output = convert_full(path)
+        method = 'full'
+
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as fp:
+        output.save(fp, "JPEG", quality=quality)
+    output.close()
+    return fp.name, {'method': method, 'peak_rss': peak_rss()}
+
+# Download TIFF to temporary file and convert it
+def convert_tiff_url_to_jpg(url, memory_limit=DEFAULT_MEMORY_LIMIT, quality=JPEG_QUALITY):
+    with tempfile.NamedTemporaryFile(suffix=".tif", delete=False) as fp:
+        tiff_file_name = fp.name
+    try:
+        downloadimagefile(url, tiff_file_name)
+        return convert_tiff_to_jpg(tiff_file_name, memory_limit, quality)
+    finally:
+        os.unlink(tiff_file_name)
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        jpg_file_name, stats = convert_tiff_to_jpg(path)
+        target = os.path.splitext(path)[0] + '.jpg'
+        shutil.move(jpg_file_name, target)
+        print(path + " -> " + target + " (" + stats['method'] + ", peak memory " + str(stats['peak_rss']) + " MB)")
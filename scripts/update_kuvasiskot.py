@@ -12,216 +12,27 @@
 
 ## Running
 # python update_kuvasiskot.py
+# python update_kuvasiskot.py --incremental    # only links added since the last run
 
 import pywikibot
-import re
-import urllib
-import requests
-import hashlib
-import imagehash
-import io
 import os
+import sys
 import tempfile
 from PIL import Image
 
-# Find (old) finna id's from file page urls
-
-def get_finna_ids(page):
-    finna_ids=[]
-
-    for url in page.extlinks():
-        if "finna.fi" in url:
-            id = None
-
-            # Parse id from url
-            patterns = [
-                           r"finna\.fi/Record/([^?]+)",
-                           r"finna\.fi/Cover/Show\?id=([^&]+)",
-                           r"finna\.fi/thumbnail\.php\?id=([^&]+)",
-                           r"finna\.fi/Cover/Download\?id=([^&]+)",
-                       ]
-
-            for pattern in patterns:
-                match = re.search(pattern, url)
-                if match:
-                    id = match.group(1)
-                    if id not in finna_ids:
-                        finna_ids.append(id)
-                    break
-
-    return finna_ids
-
-# urlencode Finna parameters
-def finna_api_parameter(name, value):
-   return "&" + urllib.parse.quote_plus(name) + "=" + urllib.parse.quote_plus(value)
-
-
-# Get finna API record with most of the information
-# Finna API documentation
-# * https://api.finna.fi
-# * https://www.kiwi.fi/pages/viewpage.action?pageId=53839221 
-
-def get_finna_record(id):
-
-    url="https://api.finna.fi/v1/record?id=" +  urllib.parse.quote_plus(id)
-    url+= finna_api_parameter('field[]', 'id')
-    url+= finna_api_parameter('field[]', 'title')
-    url+= finna_api_parameter('field[]', 'subTitle')
-    url+= finna_api_parameter('field[]', 'summary')
-    url+= finna_api_parameter('field[]', 'imageRights')
-    url+= finna_api_parameter('field[]', 'images')
-    url+= finna_api_parameter('field[]', 'imagesExtended')
-    url+= finna_api_parameter('field[]', 'openUrl')
-    url+= finna_api_parameter('field[]', 'nonPresenterAuthors')
-    url+= finna_api_parameter('field[]', 'onlineUrls')
-    url+= finna_api_parameter('field[]', 'subjects')
-    url+= finna_api_parameter('field[]', 'geoLocations')
-    url+= finna_api_parameter('field[]', 'buildings')
-    url+= finna_api_parameter('field[]', 'identifierString')
-    url+= finna_api_parameter('field[]', 'collections')
-    url+= finna_api_parameter('field[]', 'institutions')
-    url+= finna_api_parameter('field[]', 'classifications')
-    url+= finna_api_parameter('field[]', 'events')
-    url+= finna_api_parameter('field[]', 'languages')
-    url+= finna_api_parameter('field[]', 'originalLanguages')
-    url+= finna_api_parameter('field[]', 'year')
-    url+= finna_api_parameter('field[]', 'formats')
-
-    try:
-        response = requests.get(url)
-        return response.json()
-    except:
-        print("Finna API query failed: " + url)
-        exit(1)
-
-# convert string to base 16 integer for calculating difference
-def converthashtoint(h, base=16):
-    return int(str(h), base)
-
-# Compares if the image is same using similarity hashing
-# method is to convert images to 64bit integers and then
-# calculate hamming distance. 
-#
-# Perceptual hashing 
-# http://www.hackerfactor.com/blog/index.php?/archives/432-Looks-Like-It.html
-# difference hashing
-# http://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
-#
-def is_same_image(img1, img2, hashlen=8):
-
-    phash1 = imagehash.phash(img1, hash_size=hashlen)
-    dhash1 = imagehash.dhash(img1, hash_size=hashlen)
-    phash1_int = converthashtoint(phash1)
-    dhash1_int = converthashtoint(dhash1)
-
-    phash2 = imagehash.phash(img2, hash_size=hashlen)
-    dhash2 = imagehash.dhash(img2, hash_size=hashlen)
-    phash2_int = converthashtoint(phash2)
-    dhash2_int = converthashtoint(dhash2)
+from finnaapi import get_finna_records, print_payload_stats
+from finnaidparser import get_finna_ids
+from worklist import WorkList
+from pageprefetch import as_filepage, iter_batches, prefetch_pages
+from imagematch import CandidateDownloadError, CommonsImage, downloadimage, downloadimagefile, is_same_image, match_candidates, print_download_stats
+from commonssha1 import file_sha1, is_commons_file
+from tiffconvert import convert_tiff_url_to_jpg
 
-    # Hamming distance difference
-    phash_diff = bin(phash1_int ^ phash2_int).count('1')
-    dhash_diff = bin(dhash1_int ^ dhash2_int).count('1') 
-
-    # print hamming distance
-    if (phash_diff == 0 and dhash_diff == 0):
-        print("Both hashes are equal")
-    else:
-        print("Phash diff: " + str(phash_diff) + ", image1: " + str(phash1) + ", image2: " + str(phash2))
-        print("Dhash diff: " + str(dhash_diff) + ", image1: " + str(dhash1) + ", image2: " + str(dhash2))
-
-    # max distance for same is that least one is 0 and second is max 3
-
-    if phash_diff == 0 and dhash_diff < 4:
-        return True
-    elif phash_diff < 4 and dhash_diff == 0:
-        return True
-    else:
-        return False
-
-def isidentical(img1, img2):
-    shaimg1 = hashlib.sha1()
-    shaimg1.update(img1.tobytes())
-    digest1 = shaimg1.digest()
-
-    shaimg2 = hashlib.sha1()
-    shaimg2.update(img2.tobytes())
-    digest2 = shaimg2.digest()
-
-    print("digest1: " + shaimg1.hexdigest() + " digest2: " + shaimg2.hexdigest())
-    
-    if (digest1 == digest2):
-        return True
-    return False
-
-def convert_tiff_to_jpg(tiff_image):
-    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as fp:
-        tiff_image.convert('RGB').save(fp, "JPEG", quality=95)
-    return fp.name    
-
-# note: commons at least once has thrown error due to client policy?
-# "Client Error: Forbidden. Please comply with the User-Agent policy"
-# keep an eye out for problems..
-def downloadimage(url):
-    headers={'User-Agent': 'pywikibot'}
-    # Image.open(urllib.request.urlopen(url, headers=headers))
-
-    response = requests.get(url, headers=headers, stream=True)
-    response.raise_for_status()
-                            
-    return Image.open(io.BytesIO(response.content))
-
-# strip id from other things that may be after it:
-# there might be part of url or some html in same field..
-def stripid(oldsource):
-    # space after url?
-    indexend = oldsource.find(" ")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-
-    # html tag after url?
-    indexend = oldsource.find("<")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find(">")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-
-    # wikimarkup after url?
-    indexend = oldsource.find("[")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find("]")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find("{")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find("}")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find("|")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-
-    # some parameters in url?
-    indexend = oldsource.find("&")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-    indexend = oldsource.find("#")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-
-    # some parameters in url?
-    indexend = oldsource.find("?")
-    if (indexend > 0):
-        oldsource = oldsource[:indexend]
-
-    # linefeed at end?
-    if (oldsource.endswith("\n")):
-        oldsource = oldsource[:len(oldsource)-1]
-
-    return oldsource
+# compare sha1 of file bytes to sha1 reported by commons,
+# commons file is not downloaded
+def isidentical(sha1, file_info):
+    print("digest1: " + sha1 + " digest2: " + str(file_info.sha1))
+    return is_commons_file(sha1, file_info)
 
 # if there's garbage in id, strip to where it ends
 def leftfrom(string, char):
@@ -231,31 +42,6 @@ def leftfrom(string, char):
 
     return string
 
-# get pages immediately under cat
-# and upto depth of 1 in subcats
-def getcatpages(pywikibot, commonssite, maincat, recurse=False):
-    final_pages = list()
-    cat = pywikibot.Category(commonssite, maincat)
-    pages = list(commonssite.categorymembers(cat))
-    
-    for page in pages:
-        if isblockedimage(page) == False:
-            if page not in final_pages:
-                final_pages.append(page)
-
-    # no recursion by default, just get into depth of 1
-    if (recurse == True):
-        subcats = list(cat.subcategories())
-        for subcat in subcats:
-            subpages = commonssite.categorymembers(subcat)
-            for subpage in subpages:
-                # avoid duplicates and those we are blocked from modifying (403 error)
-                if isblockedimage(subpage) == False:
-                    if subpage not in pages:
-                        final_pages.append(subpage)
-
-    return final_pages
-
 # check for list of images we are forbidden from changing (403 error)
 def isblockedimage(page):
     pagename = str(page)
@@ -297,108 +83,106 @@ def isblockedimage(page):
 
     return False
 
-def getlinkedpages(pywikibot, commonssite, linkpage):
-    listpage = pywikibot.Page(commonssite, linkpage)  # The page you're interested in
-
-    pages = list()
-    # Get all linked pages from the page
-    for linked_page in listpage.linkedPages():
-        # avoid duplicates and those we are blocked from modifying (403 error)
-        if isblockedimage(linked_page) == False: 
-            if linked_page not in pages:
-                pages.append(linked_page)
-
-    return pages
-
 # ------- main()
 
 commonssite = pywikibot.Site("commons", "commons")
 commonssite.login()
 
-# get list of pages upto depth of 1 
-#pages = getcatpages(pywikibot, commonssite, "Category:Kuvasiskot", True)
-#pages = getcatpages(pywikibot, commonssite, "Files from the Antellin kokoelma")
+# pages are yielded while the lists are still being loaded,
+# depth is levels of subcategories, needs
+# from commonspages import iter_category_pages, iter_linked_pages
+#pages = iter_category_pages(commonssite, "Category:Kuvasiskot", depth=1, skip=isblockedimage)
+#pages = iter_category_pages(commonssite, "Files from the Antellin kokoelma", skip=isblockedimage)
 
-#pages = getcatpages(pywikibot, commonssite, "Professors of University of Helsinki", True)
-#pages = getlinkedpages(pywikibot, commonssite, 'user:FinnaUploadBot/filelist')
-pages = getlinkedpages(pywikibot, commonssite, 'User:FinnaUploadBot/kuvakokoelmat.fi')
+#pages = iter_category_pages(commonssite, "Professors of University of Helsinki", depth=1, skip=isblockedimage)
+#pages = iter_linked_pages(commonssite, 'user:FinnaUploadBot/filelist', skip=isblockedimage)
+# --incremental: only links added to the list page since the last run and
+# the ones which failed, see worklist.py
+worklist = WorkList(commonssite, 'User:FinnaUploadBot/kuvakokoelmat.fi', incremental='--incremental' in sys.argv)
+pages = worklist.pages(skip=isblockedimage)
 
 #rowcount = 1
 #rowlimit = 100
 
-print("Pages found: " + str(len(pages)))
+# pages are handled in chunks: records of a chunk are fetched with a few
+# requests and the chunk is processed before the next one is read
+PAGE_CHUNK_SIZE = 50
+
+# Generator of (page, file_page, file_info, finna_ids, finna_records,
+# finna_statuses), records and statuses are for the chunk of the page
+def iter_pages_with_records(pages):
+    for chunk in iter_batches(pages, PAGE_CHUNK_SIZE):
+        pagestoprocess = list()
+        all_finna_ids = list()
+        for page in chunk:
+            if page.namespace() != 6:  # 6 is the namespace ID for files
+                continue
+
+            # prefetched FilePage, file info is already loaded
+            file_page = as_filepage(page)
+            if file_page.isRedirectPage():
+                continue
 
-for page in pages:
-    if page.namespace() != 6:  # 6 is the namespace ID for files
-        continue
+            file_info = file_page.latest_file_info
 
-    file_page = pywikibot.FilePage(page)
-    if file_page.isRedirectPage():
-        continue
-        
-    file_info = file_page.latest_file_info
+            # Check only low resolution images
+            if file_info.width > 2000 or file_info.height > 2000:
+                print("Skipping " + page.title() + ", width or height over 2000")
+                continue
 
-    # Check only low resolution images
-    if file_info.width > 2000 or file_info.height > 2000:
-        print("Skipping " + page.title() + ", width or height over 2000")
-        continue
+            # Find ids used in Finna
+            finna_ids=get_finna_ids(page)
 
-    print(" -- [ " + page.title() + " ] --")
+            # Skip if there is no known ids
+            if not finna_ids:
+                print("Skipping " + page.title() + " (no known finna ID)")
+                continue
 
-    # Find ids used in Finna
-    finna_ids=get_finna_ids(page)
-    
-    # Skip if there is no known ids
-    if not finna_ids:
-        print("Skipping " + page.title() + " (no known finna ID)")
-        continue
+            pagestoprocess.append((page, file_page, file_info, finna_ids))
+            all_finna_ids.extend(finna_ids)
+
+        # fetch metadata with finna API, many records per request
+        finna_records, finna_statuses = get_finna_records(all_finna_ids, fields='hires-update')
+        for page, file_page, file_info, finna_ids in pagestoprocess:
+            yield page, file_page, file_info, finna_ids, finna_records, finna_statuses
+
+# redirect, file info and external links of the pages are loaded in
+# batches ahead of the loop
+for page, file_page, file_info, finna_ids, finna_records, finna_statuses in iter_pages_with_records(prefetch_pages(commonssite, pages)):
+    print(" -- [ " + page.title() + " ] --")
 
     for finnaid in finna_ids:
 
-        if (finnaid.find("?") > 0 or finnaid.find("&") > 0 or finnaid.find("<") > 0 or finnaid.find(">") > 0 or finnaid.find("#") > 0 or finnaid.find("[") > 0 or finnaid.find("]") > 0 or finnaid.find("{") > 0 or finnaid.find("}") > 0):
-            print("WARN: finna id in " + page.title() + " has unexpected characters, bug or garbage in url? ")
-            
-            # strip pointless parts if any
-            finnaid = stripid(finnaid)
-            print("note: finna id in " + page.title() + " is " + finnaid)
-
-        # try to fetch metadata with finna API    
-        finna_record = get_finna_record(finnaid)
-        if (finna_record['status'] != 'OK'):
-            print("Skipping (status not OK): " + finnaid + " status: " + finna_record['status'])
+        if finnaid not in finna_records:
+            print("Skipping (" + finna_statuses[finnaid] + "): " + finnaid)
+            # temporary errors are retried on the next run
+            if finna_statuses[finnaid] != 'not found':
+                worklist.mark_failed(page)
             continue
 
-        if (finna_record['resultCount'] != 1):
-            print("Skipping (result not 1): " + finnaid + " count: " + str(finna_record['resultCount']))
-            continue
+        finna_record = finna_records[finnaid]
 
-        if "records" not in finna_record:
-            print("WARN: 'records' not found in finna record, skipping: " + finnaid)
-            continue
-        if (len(finna_record['records']) == 0):
-            print("WARN: empty array of 'records' for finna record, skipping: " + finnaid)
-            continue
-        if "collections" not in finna_record['records'][0]:
+        if "collections" not in finna_record:
             print("WARN: 'collections' not found in finna record, skipping: " + finnaid)
             continue
 
         # collections: expecting ['Historian kuvakokoelma', 'Studio Kuvasiskojen kokoelma']
         # skip coins in "Antellin kokoelma" as hashes will be too similar
-        finna_collections = finna_record['records'][0]['collections']
+        finna_collections = finna_record.collections
         if ("Antellin kokoelma" in finna_collections):
             print("Skipping collection (can't match by hash due similarities): " + finnaid)
             continue
 
-        if "imagesExtended" not in finna_record['records'][0]:
+        if not finna_record.images:
             print("WARN: 'imagesExtended' not found in finna record, skipping: " + finnaid)
             continue
 
-        imagesExtended = finna_record['records'][0]['imagesExtended'][0]
+        imagesExtended = finna_record.images[0]
 
         # Test copyright (old field: rights, but request has imageRights?)
-        # imageRights = finna_record['records'][0]['imageRights']
-        if imagesExtended['rights']['copyright'] != "CC BY 4.0":
-            print("Incorrect copyright: " + imagesExtended['rights']['copyright'])
+        # imageRights = finna_record['imageRights']
+        if imagesExtended.copyright != "CC BY 4.0":
+            print("Incorrect copyright: " + str(imagesExtended.copyright))
             continue
 
         finna_image_url = ""
@@ -407,28 +191,27 @@ for page in pages:
         
         # there is at least one case where this is not available?
         # -> save from further comparison by checking early
-        if "original" not in imagesExtended['highResolution']:
+        if imagesExtended.original is None:
             print("WARN: 'original' not found in hires image, skipping: " + finnaid)
             continue
         
         # 'images' can have array of multiple images, need to select correct one
         # -> loop through them (they should have just different &index= in them)
         # and compare with the image in commons
-        imageList = finna_record['records'][0]['images']
+        imageList = finna_record.image_urls
         if (len(imageList) == 0):
             print("no images for item")
 
         if (len(imageList) == 1):
-            # get image from commons for comparison:
-            # try to use same size
-            commons_image_url = file_page.get_file_url()
-            commons_image = downloadimage(commons_image_url)
+            # image from commons for comparison, thumbnail
+            # of same size as finna image is used
+            commons_image = CommonsImage(file_page)
         
-            finna_image_url = "https://finna.fi" + imagesExtended['urls']['large']
+            finna_image_url = imagesExtended.large_url
             finna_image = downloadimage(finna_image_url)
             
             # Test if image is same using similarity hashing
-            if (is_same_image(finna_image, commons_image) == True):
+            if (commons_image.matches(finna_image) == True):
                 match_found = True
 
         if (len(imageList) > 1):
@@ -436,24 +219,23 @@ for page in pages:
             # need to pick the one that is closest match
             print("Multiple images for same item: " + str(len(imageList)))
 
-            # get image from commons for comparison:
-            # try to use same size
-            commons_image_url = file_page.get_file_url()
-            commons_image = downloadimage(commons_image_url)
-            
-            f_imgindex = 0
-            for img in imageList:
-                finna_image_url = "https://finna.fi" + img
-                finna_image = downloadimage(finna_image_url)
-
-                # Test if image is same using similarity hashing
-                if (is_same_image(finna_image, commons_image) == True):
-                    match_found = True
-                    need_index = True
-                    print("Matching image index: " + str(f_imgindex))
-                    break
-                else:
-                    f_imgindex = f_imgindex + 1
+            # all candidates are downloaded and hashed concurrently and
+            # compared to thumbnail of same size as finna image
+            commons_image = CommonsImage(file_page)
+            candidate_urls = ["https://finna.fi" + img for img in imageList]
+            try:
+                match = match_candidates(commons_image, candidate_urls)
+            except CandidateDownloadError as e:
+                # retried on the next run
+                print("Could not compare all images, skipping: " + finnaid + ", " + str(e))
+                worklist.mark_failed(page)
+                continue
+            if (match is not None):
+                f_imgindex, finna_image, phash_diff, dhash_diff = match
+                finna_image_url = candidate_urls[f_imgindex]
+                match_found = True
+                need_index = True
+                print("Matching image index: " + str(f_imgindex))
 
         if (match_found == False):
             print("No matching image found, skipping: " + finnaid)
@@ -463,16 +245,9 @@ for page in pages:
         finna_record_url = "https://finna.fi/Record/" + finnaid
 
         # note! 'original' might point to different image than used above! different server in some cases
-        hires = imagesExtended['highResolution']
-
-        # there is at least one case where this is not available?
-        if "original" not in hires:
-            print("WARN: 'original' not found in hires image, skipping: " + finnaid)
-            continue
-            
         # TODO: try to use the one from "imagesExtended"
         # (see logic after this)
-        hires = imagesExtended['highResolution']['original'][0]
+        hires = imagesExtended.original
 
         # TODO: compare with "original" (whatever that is)
         #hiresurl = imagesExtended['highResolution']['original'][0]['url']
@@ -518,8 +293,8 @@ for page in pages:
             print("converting image from tiff to jpeg") # log it
             if (need_index == False):
                 finna_image_url = hires['url']
-            local_image = downloadimage(finna_image_url)
-            image_file_name = convert_tiff_to_jpg(local_image)
+            image_file_name, convert_stats = convert_tiff_url_to_jpg(finna_image_url)
+            print("converted with " + convert_stats['method'] + ", peak memory " + str(convert_stats['peak_rss']) + " MB")
             local_file=True    
         elif hires["format"] == "jpg" and file_info.mime == 'image/jpeg':
             if (need_index == False):
@@ -527,7 +302,7 @@ for page in pages:
         elif file_info.mime == 'image/jpeg':
             if (need_index == False):
                 # this is already same from earlier -> we can remove this
-                finna_image_url = "https://finna.fi" + imagesExtended['urls']['large']
+                finna_image_url = imagesExtended.large_url
         else:
             print("Exit: Unhandled mime-type")
             print(f"File format Commons (MIME type): {file_info.mime}")
@@ -535,33 +310,44 @@ for page in pages:
             continue
 
         # can't upload if identical to the one in commons:
-        # compare hash of converted image if necessary,
-        # need to compare full image for both (not thumbnails)
+        # compare sha1 of the file (converted file if necessary)
+        # to sha1 commons has for the current version
         if (local_file == False):
             # get full image before trying to upload:
             # code above might have switched to another
             # from multiple different images
-            local_image = downloadimage(finna_image_url)
-            if (isidentical(local_image, commons_image) == True):
-                print("Images are identical files, skipping: " + finnaid)
-                continue
-                
-            # verify that the image we have picked above is the same as in earlier step:
-            # internal consistency of the API has an error?
-            if (is_same_image(local_image, finna_image) == False):
-                print("WARN: Images are NOT same in the API! " + finnaid)
-                continue
+            with tempfile.NamedTemporaryFile(delete=False) as fp:
+                local_file_name = fp.name
+            try:
+                local_sha1 = downloadimagefile(finna_image_url, local_file_name)
+                if (isidentical(local_sha1, file_info) == True):
+                    print("Images are identical files, skipping: " + finnaid)
+                    continue
+
+                # verify that the image we have picked above is the same as in earlier step:
+                # internal consistency of the API has an error?
+                # finna_image is decoded at full size, so is this one
+                # (reduced decode can move hashes by a couple of bits)
+                local_image = Image.open(local_file_name)
+                if (is_same_image(local_image, finna_image) == False):
+                    print("WARN: Images are NOT same in the API! " + finnaid)
+                    continue
+            finally:
+                os.unlink(local_file_name)
         else:
-            converted_image = Image.open(image_file_name)
-            if (isidentical(converted_image, commons_image) == True):
+            if (isidentical(file_sha1(image_file_name), file_info) == True):
                 print("Images are identical files, skipping: " + finnaid)
+                os.unlink(image_file_name)
                 continue
-            # at least one image fails in conversion, see if there are others
-            if (is_same_image(converted_image, commons_image) == False):
+            # at least one image fails in conversion, see if there are others:
+            # compare to finna image which was matched to commons image
+            converted_image = Image.open(image_file_name)
+            if (is_same_image(converted_image, finna_image) == False):
                 print("ERROR! Images are NOT same after conversion! " + finnaid)
+                os.unlink(image_file_name)
                 continue
 
-        comment = "Overwriting image with better resolution version of the image from " + finna_record_url +" ; Licence in Finna " + imagesExtended['rights']['copyright']
+        comment = "Overwriting image with better resolution version of the image from " + finna_record_url +" ; Licence in Finna " + imagesExtended.copyright
         print(comment)
 
         # Ignore warnigs = True because we update files
@@ -580,3 +366,7 @@ for page in pages:
         #    break
         #rowcount += 1
 
+
+print_payload_stats()
+print_download_stats()
+worklist.finish()
@@ -11,6 +11,11 @@ from PIL import Image
 from io import BytesIO
 from pywikibot import config
 
+from ratelimit import limit
+from fingerprint import ImageFingerprint
+from imagematch import downloadhashimage, openhashimage
+from commonssha1 import find_commons_files_by_sha1
+
 # Get subalbums
 
 def getFolderChilds(headers, folderName=""):
@@ -194,24 +199,11 @@ def searchPhotographer(photo, firstName, lastName):
 
 
 def getCommonsFilenameBySha1(sha1_hash):
-    url="https://commons.wikimedia.org/w/api.php?action=query&list=allimages&aiprop=sha1&format=json&aisha1=" + sha1_hash
-    response = session.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        if data and "query" in data and "allimages" in data["query"] and len(data["query"]["allimages"]):
-            return data["query"]["allimages"][0]["name"]
+    names = find_commons_files_by_sha1(sha1_hash, session)
+    if names:
+        return names[0]
            
 
-def calculatePhash(im):
-    hash = imagehash.phash(im)
-    hash_int=int(str(hash),16)
-    return hash_int
-
-def calculateDhash(im):
-    hash = imagehash.dhash(im)
-    hash_int=int(str(hash),16)
-    return hash_int
-
 def uploadFileToCommons(response, filename, wikitext, comment):
     # Save the file locally
     with open('temp.jpg', 'wb') as f:
@@ -254,6 +246,8 @@ def getValtioneuvostoImagefile(headers, id, wikitext, uploadfilename,comment):
     print(url)
 
     # Fetch the file as binary data
+    # (shared rate limit per host instead of sleeping between files)
+    limit(url)
     response = session.get(url, headers=headers)
 
     # Check if the request was successful
@@ -280,26 +274,16 @@ def getValtioneuvostoImagefile(headers, id, wikitext, uploadfilename,comment):
             commons_url=getCommonsThumbnailUrl(commons_filename)
             print(commons_url)
 
-            # Open the image with Pillow
-            commons_im = Image.open(urllib.request.urlopen(commons_url))
-
-            # Calculate hash
-            commons_phash_int=calculatePhash(commons_im)
-            commons_dhash_int=calculateDhash(commons_im)
+            # Open the images with Pillow, only at size needed for hashing
+            commons_im = downloadhashimage(commons_url)
+            valtioneuvosto_im = openhashimage(response.content)
 
+            # Calculate phash and dhash of both images
+            valtioneuvosto_fingerprint, commons_fingerprint = ImageFingerprint.from_images([valtioneuvosto_im, commons_im])
+            phash_diff, dhash_diff = valtioneuvosto_fingerprint.distance(commons_fingerprint)
 
-            # Create a BytesIO object from the response content
-            image_data = BytesIO(response.content)
-
-            # Open the image with Pillow
-            valtioneuvosto_im = Image.open(image_data)
-
-            # Calculate phash
-            valtioneuvosto_phash_int=calculatePhash(valtioneuvosto_im)
-            valtioneuvosto_dhash_int=calculateDhash(valtioneuvosto_im)
-
-            print("Phash diff: " + str(bin(valtioneuvosto_phash_int ^ commons_phash_int).count('1')))
-            print("Dhash diff: " + str(bin(valtioneuvosto_dhash_int ^ commons_dhash_int).count('1')))
+            print("Phash diff: " + str(phash_diff))
+            print("Dhash diff: " + str(dhash_diff))
 
 
 #            exit(1)
@@ -633,10 +617,6 @@ for f in files:
     print(filename)
 
     imgfile=getValtioneuvostoImagefile(headers, f['download_id'], wikitext, filename, comment)       
-    time.sleep(3)
-
-
-    time.sleep(5)
 
 if 1:
     exit(1)
@@ -681,5 +661,4 @@ def handleFile(f):
     print(comment)
 
     imgfile=getValtioneuvostoImagefile(headers, f['download_id'], wikitext, filename, comment)       
-    time.sleep(3)
 
@@ -0,0 +1,132 @@
+# Incremental work list from links of a list page
+#
+# Scripts processing links of User:FinnaUploadBot/filelist or
+# User:FinnaUploadBot/kuvakokoelmat.fi went through every link on each run.
+# WorkList remembers the links which have been processed and the revision of
+# the list page they were read from:
+# - if the list page has a new revision, links are listed and only the ones
+#   not processed before are yielded (links added since the last run)
+# - if the revision is same, links are not listed at all
+# - pages marked failed, and pages of runs which didn't finish, are yielded
+#   again on the next run
+#
+# Yielded pages are pending until finish() is called at the end of the run,
+# then they are done unless mark_failed() was called for them. Revision is
+# stored only if all links were yielded, so a run stopped early continues
+# from the list on the next run.
+#
+# With incremental=False all links are yielded, but processed links are
+# still recorded so that the next incremental run starts from there.
+#
+## Usage
+# from worklist import WorkList
+#
+# worklist = WorkList(commonssite, 'User:FinnaUploadBot/kuvakokoelmat.fi', incremental='--incremental' in sys.argv)
+# for page in prefetch_pages(commonssite, worklist.pages(skip=isblockedimage)):
+#     if not process(page):
+#         worklist.mark_failed(page)
+# worklist.finish()
+
+import time
+
+import pywikibot
+
+from cachedb import CacheDB
+from commonspages import iter_linked_pages
+
+DEFAULT_WORKLIST_PATH = 'worklist.db'
+
+PENDING = 'pending'
+FAILED = 'failed'
+DONE = 'done'
+
+# schema versions, see cachedb.py
+MIGRATIONS = [
+    # 1: last fully processed revision of list pages and status of linked pages
+    [
+        '''CREATE TABLE IF NOT EXISTS worklist_revisions (
+           listpage TEXT PRIMARY KEY,
+           revid INTEGER NOT NULL,
+           updated INTEGER NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS worklist_pages (
+           listpage TEXT NOT NULL,
+           title TEXT NOT NULL,
+           status TEXT NOT NULL,
+           updated INTEGER NOT NULL,
+           PRIMARY KEY (listpage, title))''',
+    ],
+]
+
+class WorkList:
+    def __init__(self, site, listpage, path=DEFAULT_WORKLIST_PATH, incremental=True):
+        self.site = site
+        self.listpage = pywikibot.Page(site, listpage)
+        self.key = self.listpage.title()
+        self.incremental = incremental
+        self.db = CacheDB(path, MIGRATIONS)
+        self.revid = None
+        self.complete = False
+        self.stats = {'new': 0, 'retried': 0, 'done': 0}
+
+    def stored_revid(self):
+        row = self.db.fetchone('SELECT revid FROM worklist_revisions WHERE listpage = ?', (self.key,))
+        return row[0] if row else None
+
+    # titles with status, only the ones with given statuses if set
+    def statuses(self, statuses=None):
+        rows = self.db.fetchall('SELECT title, status FROM worklist_pages WHERE listpage = ?', (self.key,))
+        return {title: status for title, status in rows if statuses is None or status in statuses}
+
+    def set_status(self, title, status):
+        self.db.write('INSERT OR REPLACE INTO worklist_pages (listpage, title, status, updated) VALUES (?, ?, ?, ?)',
+                      (self.key, title, status, int(time.time())))
+
+    def _candidates(self, skip, old_revid):
+        if self.incremental and old_revid == self.revid:
+            # list has not changed, only failed and unfinished ones
+            for title in self.statuses((PENDING, FAILED)):
+                page = pywikibot.Page(self.site, title)
+                if skip is None or not skip(page):
+                    yield page
+            return
+        yield from iter_linked_pages(self.site, self.key, skip=skip)
+
+    # Generator of linked pages to process
+    def pages(self, skip=None):
+        old_revid = self.stored_revid()
+        self.revid = self.listpage.latest_revision_id
+        known = self.statuses()
+        print("Work list " + self.key + ": revision " + str(old_revid) + " -> " + str(self.revid)
+              + (", incremental" if self.incremental else ", all links"))
+
+        self.complete = False
+        for page in self._candidates(skip, old_revid):
+            title = page.title()
+            status = known.get(title)
+            if status == DONE:
+                self.stats['done'] += 1
+                if self.incremental:
+                    continue
+            elif status is None:
+                self.stats['new'] += 1
+            else:
+                self.stats['retried'] += 1
+            self.set_status(title, PENDING)
+            yield page
+        self.complete = True
+
+    def mark_failed(self, page):
+        self.set_status(page.title(), FAILED)
+
+    # End of run: pending pages are done, revision is stored if all pages
+    # were yielded
+    def finish(self):
+        self.db.write('UPDATE worklist_pages SET status = ? WHERE listpage = ? AND status = ?', (DONE, self.key, PENDING))
+        if self.complete and self.revid is not None:
+            self.db.write('INSERT OR REPLACE INTO worklist_revisions (listpage, revid, updated) VALUES (?, ?, ?)',
+                          (self.key, self.revid, int(time.time())))
+        self.db.commit()
+        failed = len(self.statuses((FAILED,)))
+        self.db.close()
+        print("Work list " + self.key + ": " + str(self.stats['new']) + " new, " + str(self.stats['retried'])
+              + " retried, " + str(self.stats['done']) + " done before, " + str(failed) + " failed")
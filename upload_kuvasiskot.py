@@ -9,6 +9,16 @@
 #
 ## Running the script
 # python upload_kuvasiskot.py
+#
+# Using local copy of the collection instead of Finna search
+# (python scripts/finnamirror.py kuvasiskot)
+# python upload_kuvasiskot.py --mirror
+#
+# Duplicate check uses local hash index of Commons files first and
+# imagehash.toolforge.org for images not found from it
+# (python scripts/hashindex.py Category:Kuvasiskot)
+# Only local index, no toolforge queries
+# python upload_kuvasiskot.py --offline
 
 
 import mwparserfromhell
@@ -16,38 +26,59 @@ import requests
 import urllib
 import json
 import imagehash
+import io
 import time
 import pywikibot
 import tempfile
 import os
+import sys
 from PIL import Image
 
-# difference hashing
-# http://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
-
-def calculate_dhash(im):
-    hash = imagehash.dhash(im)
-    hash_int=int(str(hash),16)
-    return hash_int
+# shared Finna client is in scripts directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from finnaapi import iter_finna_search, FinnaError
+from finnamirror import FinnaMirror
+from ratelimit import limit
+from fingerprint import ImageFingerprint
+from hashindex import HashIndex
+from imagematch import downloadimagedata, openhashimage
 
 # Perceptual hashing 
 # http://www.hackerfactor.com/blog/index.php?/archives/432-Looks-Like-It.html
+# difference hashing
+# http://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
 
-def calculate_phash(im):
-    hash = imagehash.phash(im)
-    hash_int=int(str(hash),16)
-    return hash_int
-
-def check_imagehash(url):
+# perceptual and difference hashes of finna thumbnail, local index has
+# hashes of reduced decodes (see hashindex.py)
+def get_fingerprint(content):
     # Open the image1 with Pillow
-    im = Image.open(urllib.request.urlopen(url))
-    phash=calculate_phash(im)
-    dhash=calculate_dhash(im)
+    im = openhashimage(content)
+    return ImageFingerprint.from_image(im)
+
+# content is the thumbnail file, imagehash.toolforge.org has hashes of
+# full size decodes and it is compared with a full decode
+def check_imagehash(fingerprint, content):
+    # local index of known commons files first
+    # (python scripts/hashindex.py Category:Kuvasiskot)
+    duplicates = hash_index.search(fingerprint)
+    if duplicates:
+        print("Found in local hash index: " + ", ".join(title for title, phash_diff, dhash_diff in duplicates))
+        return True
+
+    # without network queries only local index is used
+    if '--offline' in sys.argv:
+        return False
+
+    # perceptual and difference hashes as 64bit integers
+    full_fingerprint = ImageFingerprint.from_image(Image.open(io.BytesIO(content)))
+    phash=full_fingerprint.phash
+    dhash=full_fingerprint.dhash
 
     # Format the URL with the provided dhash and phash values
     url = f"https://imagehash.toolforge.org/search?dhash={dhash}&phash={phash}"
 
     # Make a GET request to the URL
+    limit(url)
     response = requests.get(url)
 
     # Check the status of the response
@@ -159,64 +190,38 @@ def create_categories(r):
     return flatten_wikicode
 
 
-# urlencode Finna parameters
-def finna_api_parameter(name, value):
-   return "&" + urllib.parse.quote_plus(name) + "=" + urllib.parse.quote_plus(value)
-
 # Finnan Swagger dokumentaation recordin example outputista mahdolliset kentät 
 # https://api.finna.fi/swagger-ui/?url=%2Fapi%2Fv1%3Fswagger#/List/get_list
-def get_finna_by_filter(page):
-    data = None
-    url="https://api.finna.fi/v1/search?" 
-    url+= finna_api_parameter('filter[]', '~format_ext_str_mv:"0/Image/"') 
-    url+= finna_api_parameter('filter[]', 'free_online_boolean:"1"') 
-    url+= finna_api_parameter('filter[]', '~hierarchy_parent_title:"Studio Kuvasiskojen kokoelma"')  
-    url+= finna_api_parameter('filter[]', '~usage_rights_str_mv:"usage_B"') 
-    url+= finna_api_parameter('lookfor','"professorit"+"miesten+puvut"')      # Searchkey
-    url+= finna_api_parameter('type','Subjects')                              # Search only from subjects
-#    url+= finna_api_parameter('type','AllFields')
-    url+= finna_api_parameter('field[]', 'id')
-    url+= finna_api_parameter('field[]', 'title')
-    url+= finna_api_parameter('field[]', 'subTitle')
-    url+= finna_api_parameter('field[]', 'shortTitle')
-    url+= finna_api_parameter('field[]', 'summary')
-    url+= finna_api_parameter('field[]', 'imageRights')
-    url+= finna_api_parameter('field[]', 'images')
-    url+= finna_api_parameter('field[]', 'imagesExtended')
-    url+= finna_api_parameter('field[]', 'onlineUrls')
-    url+= finna_api_parameter('field[]', 'openUrl')
-    url+= finna_api_parameter('field[]', 'nonPresenterAuthors')
-    url+= finna_api_parameter('field[]', 'onlineUrls')
-    url+= finna_api_parameter('field[]', 'subjects')
-    url+= finna_api_parameter('field[]', 'subjectsExtendet')
-    url+= finna_api_parameter('field[]', 'subjectPlaces')
-    url+= finna_api_parameter('field[]', 'subjectActors')
-    url+= finna_api_parameter('field[]', 'subjectDetails')
-    url+= finna_api_parameter('field[]', 'geoLocations')
-    url+= finna_api_parameter('field[]', 'buildings')
-    url+= finna_api_parameter('field[]', 'identifierString')
-    url+= finna_api_parameter('field[]', 'collections')
-    url+= finna_api_parameter('field[]', 'institutions')
-    url+= finna_api_parameter('field[]', 'classifications')
-    url+= finna_api_parameter('field[]', 'events')
-    url+= finna_api_parameter('field[]', 'languages')
-    url+= finna_api_parameter('field[]', 'originalLanguages')
-    url+= finna_api_parameter('field[]', 'year')
-    url+= finna_api_parameter('field[]', 'hierarchicalPlaceNames')
-    url+= finna_api_parameter('field[]', 'formats')
-    url+= finna_api_parameter('field[]', 'physicalDescriptions')
-    url+= finna_api_parameter('field[]', 'measurements')
-    url+= finna_api_parameter('limit','100') 
-    url+= finna_api_parameter('page',str(page)) 
-
-
-    with urllib.request.urlopen(url) as file:
-        try:
-            data = json.loads(file.read().decode())
-        except Exception as e:
-            print(e)
-            data = None
-    return data
+#
+# Generator, records are yielded while the rest of the result pages are
+# still being loaded
+def get_finna_by_filter():
+    filters = [
+        '~format_ext_str_mv:"0/Image/"',
+        'free_online_boolean:"1"',
+        '~hierarchy_parent_title:"Studio Kuvasiskojen kokoelma"',
+        '~usage_rights_str_mv:"usage_B"',
+    ]
+    try:
+        yield from iter_finna_search(
+            lookfor='"professorit"+"miesten+puvut"',    # Searchkey
+            search_type='Subjects',                     # Search only from subjects
+            filters=filters,
+            fields='upload',
+            refresh=True                                # new records since the last run
+        )
+    except FinnaError as e:
+        print(e)
+
+# Similar search from the local mirror. The mirror matches whole subjects,
+# Finna Subjects search matches words in them, so the live search finds
+# more records (see finnamirror.py)
+def get_mirror_by_filter():
+    mirror = FinnaMirror()
+    if mirror.refreshed('kuvasiskot') is None:
+        print("Mirror kuvasiskot is empty, run: python scripts/finnamirror.py kuvasiskot")
+        exit(1)
+    yield from mirror.find(subjects=['professorit', 'miesten puvut'], mirror='kuvasiskot')
 
 def get_author(nonPresenterAuthors):
     for nonPresenterAuthor in nonPresenterAuthors:
@@ -280,10 +285,26 @@ def upload_file_to_commons(source_file_url, file_name, wikitext, comment):
         temp_file.write(response.content)
         temp_file_path = temp_file.name
 
-    file_page.upload(temp_file_path, comment=comment,asynchronous=True)
+    uploaded = file_page.upload(temp_file_path, comment=comment,asynchronous=True)
 
     # Delete the temporary file
     os.unlink(temp_file_path)
+    return uploaded
+
+# Uploaded files are added to the local hash index when Commons has them,
+# asynchronous upload is not necessarily published yet. Index has hashes
+# of Commons thumbnails (see hashindex.py), not of the finna thumbnail.
+def index_uploaded_files():
+    for title in list(uploaded_files):
+        file_page = pywikibot.FilePage(site, title)
+        if not file_page.exists():
+            continue
+        try:
+            hash_index.add_filepage(file_page)
+        except Exception as e:
+            print("Could not hash " + title + ": " + str(e))
+        uploaded_files.remove(title)
+    hash_index.commit()
 
 def get_comment_text(r):
     author="unknown"
@@ -317,16 +338,19 @@ site.login()
 print("Loading 5000 most recent edit summaries for skipping already uploaded photos")
 uploadsummary=get_upload_summary()
 images=[]
-for page in range(1,101):
-    # Prevent looping too fast for Finna server
-    time.sleep(0.2)
-    data=get_finna_by_filter(page)
-    if not data or not 'records' in data:
-        break
-
-    for record in data['records']:
+hash_index = HashIndex()
+# titles of uploaded files not in the index yet
+uploaded_files = []
+if '--mirror' in sys.argv:
+    records = get_mirror_by_filter()
+else:
+    records = get_finna_by_filter()
+
+# queued hash index writes are committed also when the script exits early
+try:
+    for record in records:
         # Not photo
-        if not 'imagesExtended' in record:
+        if not record.images:
             continue
 
         if record['id'] in uploadsummary:
@@ -338,9 +362,9 @@ for page in range(1,101):
         r['title']=record['title']
         r['shortTitle']=record['shortTitle']
         r['copyright']=record['imageRights']['copyright']
-        r['thumbnail']="https://finna.fi" + record['imagesExtended'][0]['urls']['small']
-        r['image_url']= record['imagesExtended'][0]['highResolution']['original'][0]['url']
-        r['image_format']= record['imagesExtended'][0]['highResolution']['original'][0]['format']
+        r['thumbnail']=record.images[0].small_url
+        r['image_url']= record.images[0].original['url']
+        r['image_format']= record.images[0].original['format']
         r['collections']=record['collections']
         r['institutions']=record['institutions']
         r['institution_template']=get_institution(record['institutions'])
@@ -358,7 +382,7 @@ for page in range(1,101):
         # Check copyright
         if r['copyright'] == "CC BY 4.0":
             r['copyright_template']="{{CC-BY-4.0}}\n{{FinnaReview}}"
-            r['copyright_description']=record['imagesExtended'][0]['rights']['description'][0]
+            r['copyright_description']=record.images[0].rights_description
         else:
             print("Unknown copyright: " + r['copyright'])
             exit(1)
@@ -373,7 +397,10 @@ for page in range(1,101):
             exit(1)
 
         # Skip image already exits in Wikimedia Commons 
-        if check_imagehash(r['thumbnail']):
+        index_uploaded_files()
+        thumbnail, headers = downloadimagedata(r['thumbnail'])
+        fingerprint = get_fingerprint(thumbnail)
+        if check_imagehash(fingerprint, thumbnail):
             print("Skipping (already exists based on imagehash) : " + r['id'])
             continue
 
@@ -414,5 +441,12 @@ for page in range(1,101):
 
         # Save
         if choice == 'y':
-            upload_file_to_commons(r['image_url'], r['file_name'], wikitext, comment)
-
+            if upload_file_to_commons(r['image_url'], r['file_name'], wikitext, comment):
+                # uploaded file is found from the index on next runs
+                uploaded_files.append(pywikibot.FilePage(site, 'File:' + r['file_name']).title())
+
+    index_uploaded_files()
+    if uploaded_files:
+        print("Not in Commons yet, add them to the hash index later (python scripts/hashindex.py Category:Kuvasiskot): " + ", ".join(uploaded_files))
+finally:
+    hash_index.close()